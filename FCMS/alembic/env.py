@@ -47,6 +47,10 @@ def run_migrations_online():
 
     try:
         with context.begin_transaction():
+            if connection.dialect.name == 'postgresql':
+                # The trigram index on carriers.searchName needs pg_trgm. create_all makes it in a
+                # before_create hook, which migrations don't run.
+                connection.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
             context.run_migrations()
     finally:
         connection.close()
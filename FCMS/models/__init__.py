@@ -17,6 +17,11 @@ from .calendar import Calendar
 from .webhooks import Webhook
 from .resettokens import ResetToken
 from .routes import Route, Region
+from .jobs import Job
+from .snapshots import Snapshot, SnapshotBlob
+from .freshness import CarrierFreshness
+from .locations import CmdrLocation
+from .systems import StarSystem
 
 # run configure_mappers after defining all of the models to ensure
 # all relationships can be setup
@@ -1,5 +1,11 @@
+import math
+from datetime import datetime
+
 from sqlalchemy import (
+    event,
+    inspect,
     Column,
+    DDL,
     Index,
     Integer,
     Text,
@@ -10,6 +16,46 @@ from sqlalchemy import (
 
 from .meta import Base
 
+# Edge length in ly of the grid cells carriers are filed under (cellX, cellY, cellZ), so searches by
+# position are index range scans. Changing it means recomputing every carrier's cell.
+GRID_CELL = 1000
+
+
+def grid_cell(x, y, z):
+    """
+    :return: The (cellX, cellY, cellZ) a position falls in, or Nones if it has no position
+    """
+    if x is None or y is None or z is None:
+        return None, None, None
+    return math.floor(x / GRID_CELL), math.floor(y / GRID_CELL), math.floor(z / GRID_CELL)
+
+
+# The columns the carrier searches filter on. Writing any of them stamps searchUpdated, which the search
+# indexes of other processes sync on.
+SEARCH_COLUMNS = ('x', 'y', 'z', 'showSearch', 'isDSSA')
+
+
+def normalize_name(name):
+    """
+    Normalizes a carrier name or search term for substring matching: case folded, with runs of whitespace
+    collapsed to one space.
+    """
+    return ' '.join(name.casefold().split()) if name else None
+
+
+def search_name(name):
+    """
+    :param name: A carrier name as stored: hex encoded UTF-8, or plain text for carriers only seen on EDDN
+    :return: The decoded, normalized name for searchName
+    """
+    if not name:
+        return None
+    try:
+        name = bytes.fromhex(name).decode('utf-8')
+    except ValueError:
+        pass
+    return normalize_name(name)
+
 
 class EDDNCarrier(Base):
     __tablename__ = 'carrier_eddn'
@@ -75,7 +121,35 @@ class Carrier(Base):
     lastUpdated = Column(DateTime)
     cachedJson = Column(Text)
     marketId = Column(BigInteger)
+    marketUpdated = Column(DateTime)
+    searchName = Column(Text)
+    cellX = Column(Integer)
+    cellY = Column(Integer)
+    cellZ = Column(Integer)
+    searchUpdated = Column(DateTime)
 
 
 Index('carrier_index', Carrier.id, unique=True)
 Index('carrier_callsign_index', Carrier.callsign)
+Index('carrier_owner_index', Carrier.owner)
+Index('carrier_cell_index', Carrier.cellX, Carrier.cellY, Carrier.cellZ)
+Index('carrier_search_name_index', Carrier.searchName, postgresql_using='gin',
+      postgresql_ops={'searchName': 'gin_trgm_ops'})
+Index('carrier_search_name_order_index', Carrier.searchName, Carrier.id)
+Index('carrier_search_updated_index', Carrier.searchUpdated)
+# Migrations don't fire this; FCMS/alembic/env.py creates the extension for them.
+event.listen(Carrier.__table__, 'before_create',
+             DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(dialect='postgresql'))
+
+
+@event.listens_for(Carrier, 'before_insert')
+@event.listens_for(Carrier, 'before_update')
+def derive_columns(mapper, connection, target):
+    """
+    Keeps the columns derived from a carrier's position, search flags and name up to date.
+    """
+    target.cellX, target.cellY, target.cellZ = grid_cell(target.x, target.y, target.z)
+    target.searchName = search_name(target.name)
+    state = inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in SEARCH_COLUMNS):
+        target.searchUpdated = datetime.now()
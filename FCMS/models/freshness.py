@@ -0,0 +1,30 @@
+from sqlalchemy import (
+    Column,
+    Index,
+    Integer,
+    Float, DateTime, ForeignKey,
+)
+
+from .meta import Base
+
+
+class CarrierFreshness(Base):
+    """
+    Inputs and result of the per-carrier refresh interval model, see utils/freshness.py.
+    """
+    __tablename__ = 'carrier_freshness'
+    id = Column(Integer, primary_key=True)
+    carrier_id = Column(Integer, ForeignKey('carriers.id'), nullable=False)
+    changeRate = Column(Float, default=1.0)
+    refreshes = Column(Integer, default=0)
+    changes = Column(Integer, default=0)
+    viewScore = Column(Float, default=0.0)
+    viewsAt = Column(DateTime)
+    eddnScore = Column(Float, default=0.0)
+    eddnAt = Column(DateTime)
+    refreshInterval = Column(Integer)
+    updatedAt = Column(DateTime)
+
+
+Index('carrier_freshness_index', CarrierFreshness.id, unique=True)
+Index('carrier_freshness_cid_index', CarrierFreshness.carrier_id, unique=True)
@@ -0,0 +1,31 @@
+from sqlalchemy import (
+    Column,
+    Index,
+    Integer,
+    Text, DateTime, ForeignKey,
+)
+
+from .meta import Base
+
+
+class Job(Base):
+    __tablename__ = 'jobs'
+    id = Column(Integer, primary_key=True)
+    job_type = Column(Text)
+    carrier_id = Column(Integer, ForeignKey('carriers.id'))
+    user_id = Column(Integer, ForeignKey('users.id'))
+    status = Column(Text, default='queued')
+    progress = Column(Integer, default=0)
+    message = Column(Text)
+    attempts = Column(Integer, default=0)
+    createdAt = Column(DateTime)
+    startedAt = Column(DateTime)
+    finishedAt = Column(DateTime)
+
+
+Index('jobs_index', Job.id, unique=True)
+Index('jobs_status_index', Job.status, Job.createdAt)
+Index('jobs_cid_index', Job.carrier_id)
+# At most one queued or running job of each type per carrier, so concurrent enqueues can't both add one.
+Index('jobs_active_index', Job.job_type, Job.carrier_id, unique=True,
+      postgresql_where=Job.status.in_(['queued', 'running']), sqlite_where=Job.status.in_(['queued', 'running']))
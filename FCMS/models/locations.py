@@ -0,0 +1,28 @@
+from sqlalchemy import (
+    Column,
+    Index,
+    Integer,
+    BigInteger, Float, Text, DateTime, ForeignKey,
+)
+
+from .meta import Base
+
+
+class CmdrLocation(Base):
+    """
+    Last known system of a commander, see utils/locations.py. Coordinates are null until resolved.
+    """
+    __tablename__ = 'cmdr_locations'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    systemName = Column(Text)
+    systemAddress = Column(BigInteger)
+    x = Column(Float)
+    y = Column(Float)
+    z = Column(Float)
+    source = Column(Text)
+    updatedAt = Column(DateTime)
+
+
+Index('cmdr_locations_index', CmdrLocation.id, unique=True)
+Index('cmdr_locations_user_index', CmdrLocation.user_id, unique=True)
@@ -24,3 +24,4 @@ class Market(Base):
 
 Index('market_index', Market.id, unique=True)
 Index('market_cid_index', Market.carrier_id)
+Index('market_name_index', Market.name)
@@ -0,0 +1,41 @@
+from sqlalchemy import (
+    Column,
+    Index,
+    Integer,
+    Text, DateTime, ForeignKey, LargeBinary,
+)
+
+from .meta import Base
+
+
+class SnapshotBlob(Base):
+    """
+    A raw CAPI payload, zlib compressed and stored once per distinct content.
+    """
+    __tablename__ = 'capi_blobs'
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(Text, nullable=False)
+    data = Column(LargeBinary)
+    size = Column(Integer)
+    createdAt = Column(DateTime)
+
+
+class Snapshot(Base):
+    """
+    A CAPI fetch: which payload we got, for whom, and when.
+    """
+    __tablename__ = 'capi_snapshots'
+    id = Column(Integer, primary_key=True)
+    blob_id = Column(Integer, ForeignKey('capi_blobs.id'), nullable=False)
+    endpoint = Column(Text)
+    carrier_id = Column(Integer, ForeignKey('carriers.id'))
+    user_id = Column(Integer, ForeignKey('users.id'))
+    fetchedAt = Column(DateTime)
+
+
+Index('capi_blobs_index', SnapshotBlob.id, unique=True)
+Index('capi_blobs_sha_index', SnapshotBlob.sha256, unique=True)
+Index('capi_snapshots_index', Snapshot.id, unique=True)
+Index('capi_snapshots_carrier_index', Snapshot.carrier_id, Snapshot.endpoint, Snapshot.fetchedAt)
+Index('capi_snapshots_user_index', Snapshot.user_id, Snapshot.endpoint, Snapshot.fetchedAt)
+Index('capi_snapshots_blob_index', Snapshot.blob_id)
@@ -0,0 +1,29 @@
+from sqlalchemy import (
+    Column,
+    Index,
+    Integer,
+    BigInteger, Float, Text, DateTime,
+)
+
+from .meta import Base
+
+
+class StarSystem(Base):
+    """
+    Star system names, id64s and coordinates, see utils/sapi.py. A row without coordinates records that
+    the system was not found, as of checkedAt.
+    """
+    __tablename__ = 'systems'
+    id = Column(Integer, primary_key=True)
+    id64 = Column(BigInteger)
+    name = Column(Text)
+    nameLower = Column(Text, nullable=False)
+    x = Column(Float)
+    y = Column(Float)
+    z = Column(Float)
+    checkedAt = Column(DateTime)
+
+
+Index('systems_index', StarSystem.id, unique=True)
+Index('systems_name_index', StarSystem.nameLower, unique=True)
+Index('systems_id64_index', StarSystem.id64)
@@ -1,4 +1,5 @@
 from sqlalchemy import (
+    func,
     Column,
     Index,
     Integer,
@@ -32,3 +33,4 @@ class User(Base):
 
 
 Index('user_index', User.username, unique=True)
+Index('user_cmdr_name_lower_index', func.lower(User.cmdr_name))
@@ -17,10 +17,15 @@ def includeme(config):
     config.add_route('settings', '/settings')
     config.add_route('terms', '/terms')
     config.add_route('api', '/api')
+    config.add_route('carrier_status', '/api/carrier/{cid}/status')
+    config.add_route('search_api', '/api/search')
+    config.add_route('metrics', '/metrics')
+    config.add_route('typeahead', '/typeahead')
     config.add_route('forgot-password', '/forgot-password')
     config.add_route('dssa', '/search/dssa')
     config.add_route('closest_search', '/search/closest')
     config.add_route('search_system', '/search/system')
+    config.add_route('commodity_search', '/search/commodity')
     config.add_route('galmap', 'galmap')
     config.add_route('route_search', '/search/route')
     config.add_route('home', '/fallback')
@@ -0,0 +1,111 @@
+# Microbenchmark for the search result builder (views.search.fill_data), on synthetic carriers.
+# Runs against an in-memory SQLite database holding the carriers' systems, so it needs no database or network;
+# the config file only provides the settings the view modules read at import.
+import argparse
+import random
+import sys
+import time
+
+import numpy
+from pyramid import testing
+from pyramid.paster import get_appsettings
+
+
+def make_carriers(count, systems, seed):
+    """
+    Builds unsaved carriers scattered around the bubble, with a mix of services.
+    :param count: Number of carriers
+    :param systems: Number of distinct systems to put them in
+    :param seed: Random seed
+    :return: A list of Carrier
+    """
+    from ..models import Carrier
+    from ..utils import util
+
+    rng = random.Random(seed)
+    carriers = []
+    for i in range(count):
+        n = rng.randrange(systems)
+        carriers.append(Carrier(id=i, callsign=f'{i // 1000:03}-{i % 1000:03}',
+                                name=util.to_hex(f'BENCH CARRIER {i}').decode('utf8'),
+                                currentStarSystem=f'Bench System {n}',
+                                x=rng.gauss(0, 2000), y=rng.gauss(0, 200), z=rng.gauss(0, 2000),
+                                hasShipyard=rng.random() < 0.3, hasOutfitting=rng.random() < 0.3,
+                                hasRepair=rng.random() < 0.8, hasRefuel=rng.random() < 0.8,
+                                hasRearm=rng.random() < 0.8, hasExploration=rng.random() < 0.5,
+                                hasVoucherRedemption=rng.random() < 0.5, hasBlackMarket=rng.random() < 0.1,
+                                notoriousAccess=rng.random() < 0.5,
+                                dockingAccess=rng.choice(['all', 'squadronfriends', 'friends', 'none']),
+                                taxation=rng.choice([0, 3, 5, 10, 15, 25, 50]), isDSSA=rng.random() < 0.1))
+    return carriers
+
+
+def setup_request(systems):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from ..models import StarSystem
+    from ..models.meta import Base
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    dbsession = sessionmaker(bind=engine)()
+    for n in range(systems):
+        name = f'Bench System {n}'
+        dbsession.add(StarSystem(id64=n, name=name, nameLower=name.lower(), x=n, y=0, z=0))
+    dbsession.commit()
+    request = testing.DummyRequest()
+    request.dbsession = dbsession
+    return request
+
+
+def per_row_distances(candidates, source):
+    """
+    The one numpy.linalg.norm per row approach fill_data used to take, for comparison.
+    """
+    return [round(numpy.linalg.norm(source - numpy.array((row.x, row.y, row.z))), 2) for row in candidates]
+
+
+def best_of(repeat, func, *args):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark building search results.')
+    parser.add_argument('config_uri', help='Configuration file, e.g., development.ini')
+    parser.add_argument('--candidates', type=int, default=10000)
+    parser.add_argument('--systems', type=int, default=2000, help='Distinct systems the carriers are in')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement; the best is reported')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    testing.setUp(settings=get_appsettings(args.config_uri))
+    try:
+        from ..views import search
+
+        request = setup_request(args.systems)
+        candidates = make_carriers(args.candidates, args.systems, args.seed)
+        source = numpy.array((100.0, -20.0, 300.0))
+        # Warm the process system cache, as a running site would have.
+        search.fill_data(request, candidates, source)
+
+        timings = [('distances, per row', best_of(args.repeat, per_row_distances, candidates, source)),
+                   ('distances, vectorized', best_of(args.repeat, search.distances, candidates, source)),
+                   ('fill_data', best_of(args.repeat, search.fill_data, request, candidates, source))]
+        print(f"{args.candidates} candidates, best of {args.repeat}:")
+        for name, elapsed in timings:
+            print(f"  {name:24} {elapsed * 1000:9.2f} ms  {elapsed / args.candidates * 1e6:7.2f} us/row")
+        print(f"  service badge templates: {search.service_badges.cache_info().currsize}")
+    finally:
+        testing.tearDown()
+
+
+if __name__ == '__main__':
+    main()
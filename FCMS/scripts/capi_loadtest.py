@@ -0,0 +1,199 @@
+# Drives update_carrier / oauth_finalize against the fake CAPI server and reports throughput and latency.
+# Creates throwaway loadtest-* users and carriers; point sqlalchemy.url at a scratch database.
+import argparse
+import math
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pyramid.paster import get_appsettings, setup_logging
+from pyramid.scripting import prepare
+import transaction
+
+from .fake_capi import fake_callsign
+
+USER_PREFIX = 'loadtest-'
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, math.ceil(pct / 100.0 * len(values)) - 1))
+    return values[rank]
+
+
+def delete_carriers(dbsession, cids):
+    """
+    Deletes carriers along with the rows hanging off them: imported data, jobs, snapshots and refresh state.
+    :param dbsession: Database session
+    :param cids: Carrier IDs
+    """
+    from ..models import (Carrier, CarrierExtra, CarrierFreshness, Itinerary, Cargo, Job, Market, Ship, Module,
+                          Snapshot)
+
+    if not cids:
+        return
+    for model in (Itinerary, Cargo, Market, Ship, Module, Job, Snapshot, CarrierFreshness):
+        dbsession.query(model).filter(model.carrier_id.in_(cids)).delete(synchronize_session=False)
+    dbsession.query(CarrierExtra).filter(CarrierExtra.cid.in_(cids)).delete(synchronize_session=False)
+    dbsession.query(Carrier).filter(Carrier.id.in_(cids)).delete(synchronize_session=False)
+
+
+def setup_users(registry, count, with_carriers):
+    """
+    (Re)creates the synthetic users, with far-future fake tokens.
+    :param registry: The application registry
+    :param count: Number of users
+    :param with_carriers: Also create an empty carrier row per user
+    :return: A list of (user_id, carrier_id) tuples
+    """
+    from ..models import User, Carrier, CmdrLocation, Job, Snapshot
+
+    env = prepare(registry=registry)
+    request = env['request']
+    ids = []
+    try:
+        with request.tm:
+            dbsession = request.dbsession
+            old = [u.id for u in dbsession.query(User).filter(User.username.like(f'{USER_PREFIX}%'))]
+            if old:
+                delete_carriers(dbsession, [c.id for c in dbsession.query(Carrier).filter(Carrier.owner.in_(old))])
+                for model in (Job, Snapshot, CmdrLocation):
+                    dbsession.query(model).filter(model.user_id.in_(old)).delete(synchronize_session=False)
+                dbsession.query(User).filter(User.id.in_(old)).delete(synchronize_session=False)
+            for i in range(count):
+                user = User(username=f'{USER_PREFIX}{i}@example.invalid', cmdr_name=f'LOADTEST {i}', userlevel=1,
+                            has_validated=True, public_carrier=True, banned=False)
+                dbsession.add(user)
+                dbsession.flush()
+                token = {'access_token': f'fake.{user.id}.0', 'refresh_token': f'refresh.{user.id}',
+                         'token_type': 'Bearer', 'expires_in': 14400, 'expires_at': int(time.time()) + 14400}
+                user.access_token = str(token)
+                user.refresh_token = token['refresh_token']
+                user.token_expiration = token['expires_at']
+                cid = None
+                if with_carriers:
+                    mycarrier = Carrier(owner=user.id, callsign=fake_callsign(user.id), trackedOnly=False)
+                    dbsession.add(mycarrier)
+                    dbsession.flush()
+                    user.carrierid = mycarrier.id
+                    cid = mycarrier.id
+                ids.append((user.id, cid))
+    finally:
+        env['closer']()
+    return ids
+
+
+def run_update_carrier(registry, user_id, carrier_id):
+    from ..models import User
+    from ..utils import carrier_data
+
+    env = prepare(registry=registry)
+    request = env['request']
+    try:
+        with request.tm:
+            request.user = None
+            owner = request.dbsession.query(User).get(user_id)
+            start = time.perf_counter()
+            result = carrier_data.update_carrier(request, carrier_id, owner)
+            elapsed = time.perf_counter() - start
+    finally:
+        env['closer']()
+    return elapsed, bool(result)
+
+
+def run_oauth_finalize(registry, user_id, carrier_id):
+    from ..models import User, Carrier
+    from ..views.login import oauth_finalize
+
+    env = prepare(registry=registry)
+    request = env['request']
+    try:
+        with request.tm:
+            user = request.dbsession.query(User).get(user_id)
+            # Reset to a brand new login: no carrier known for this user.
+            delete_carriers(request.dbsession,
+                            [c.id for c in request.dbsession.query(Carrier).filter(Carrier.owner == user_id)])
+            user.carrierid = None
+            request.user = user
+            start = time.perf_counter()
+            result = oauth_finalize(request)
+            elapsed = time.perf_counter() - start
+            ok = isinstance(result, dict) and 'Carrier added' in result.get('project', '')
+    finally:
+        env['closer']()
+    return elapsed, ok
+
+
+SCENARIOS = {'update_carrier': run_update_carrier, 'oauth_finalize': run_oauth_finalize}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Load test the CAPI refresh and OAuth paths.')
+    parser.add_argument('config_uri', help='Configuration file, e.g., development.ini')
+    parser.add_argument('--fake-url', default='http://127.0.0.1:6580', help='Base URL of the fake_capi server')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='update_carrier')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='Total scenario calls')
+    parser.add_argument('--users', type=int, default=50, help='Synthetic users to spread calls over')
+    parser.add_argument('--keep-cache', action='store_true',
+                        help="Don't disable the CAPI payload cache (measures cache hits instead of fetches)")
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    settings.update({'capiURL': args.fake_url, 'authURL': args.fake_url,
+                     'sapiURL': args.fake_url.rstrip('/') + '/api/'})
+    if not args.keep_cache:
+        settings.update({'capi_profile_ttl': '0', 'capi_fleetcarrier_ttl': '0'})
+
+    # Building the app imports the CAPI helpers with the overridden settings.
+    from .. import main as make_app
+    app = make_app({}, **settings)
+    registry = app.registry
+
+    users = setup_users(registry, args.users, with_carriers=args.scenario == 'update_carrier')
+    scenario = SCENARIOS[args.scenario]
+    latencies = []
+    failures = 0
+    lock = threading.Lock()
+
+    def task(n):
+        nonlocal failures
+        user_id, carrier_id = users[n % len(users)]
+        try:
+            elapsed, ok = scenario(registry, user_id, carrier_id)
+        except Exception as e:
+            print(f"Call {n} raised {type(e).__name__}: {e}")
+            elapsed, ok = 0.0, False
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+            else:
+                failures = failures + 1
+
+    print(f"Running {args.requests} x {args.scenario} over {len(users)} users at concurrency {args.concurrency}...")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(task, range(args.requests)))
+    wall = time.perf_counter() - start
+    transaction.abort()
+
+    latencies.sort()
+    print(f"Completed: {len(latencies)} ok, {failures} failed in {wall:.2f}s")
+    print(f"Throughput: {len(latencies) / wall if wall else 0:.1f} ok/s")
+    if latencies:
+        print(f"Latency ms: mean {sum(latencies) / len(latencies) * 1000:.1f}  "
+              f"p50 {percentile(latencies, 50) * 1000:.1f}  p90 {percentile(latencies, 90) * 1000:.1f}  "
+              f"p99 {percentile(latencies, 99) * 1000:.1f}  max {latencies[-1] * 1000:.1f}")
+
+
+if __name__ == '__main__':
+    main()
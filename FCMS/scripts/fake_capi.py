@@ -0,0 +1,227 @@
+# Local stand-in for Frontier's CAPI and auth servers (and the systems API), for load testing.
+# Point capiURL, authURL and sapiURL at this server. Never use it in production.
+import argparse
+import json
+import random
+import sys
+import time
+from functools import lru_cache
+from urllib.parse import urlencode
+
+from pyramid.config import Configurator
+from pyramid.response import Response
+import pyramid.httpexceptions as exc
+
+LETTERS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+SERVICES = ['rearm', 'shipyard', 'outfitting', 'blackmarket', 'voucherredemption', 'exploration', 'repair',
+            'refuel', 'commodities', 'carrierfuel']
+
+
+def fake_callsign(subject):
+    """
+    Derives a stable, unique callsign for a token subject (the user ID the token was issued to).
+    :param subject: Integer subject
+    :return: A callsign like ABC-123
+    """
+    n = int(subject)
+    return f"{LETTERS[n // 676 % 26]}{LETTERS[n // 26 % 26]}{LETTERS[n % 26]}-{n % 1000:03d}"
+
+
+def fake_token(subject, lifetime):
+    """
+    Issues a synthetic OAuth2 token. The subject is embedded so the fake can tell users apart.
+    :param subject: Integer subject
+    :param lifetime: Seconds until the access token expires
+    :return: A token dict in the shape Frontier's auth server returns
+    """
+    return {'access_token': f'fake.{subject}.{random.getrandbits(32):08x}',
+            'refresh_token': f'refresh.{subject}',
+            'token_type': 'Bearer',
+            'expires_in': lifetime,
+            'expires_at': int(time.time()) + lifetime}
+
+
+@lru_cache(maxsize=4096)
+def fake_carrier(subject, commodities, modules, ships, itinerary, cargo):
+    """
+    Builds a synthetic /fleetcarrier payload of the requested size.
+    :return: The encoded JSON payload
+    """
+    rnd = random.Random(subject)
+    callsign = fake_callsign(subject)
+    data = {
+        'name': {'callsign': callsign, 'vanityName': f'LOADTEST {callsign}'.encode().hex().upper(),
+                 'filteredVanityName': f'LOADTEST {callsign}'},
+        'currentStarSystem': 'Sol',
+        'balance': rnd.randint(10 ** 8, 10 ** 10),
+        'fuel': rnd.randint(0, 1000),
+        'state': 'normalOperation',
+        'theme': 'Default',
+        'dockingAccess': 'all',
+        'notoriousAccess': False,
+        'capacity': {'shipPacks': 0, 'modulePacks': 0, 'cargoForSale': 0, 'cargoNotForSale': 0,
+                     'cargoSpaceReserved': 0, 'crew': 1790, 'freeSpace': 23210},
+        'itinerary': {'completed': [{'departureTime': '2020-06-10 10:00:00', 'arrivalTime': '2020-06-10 09:00:00',
+                                     'state': 'success', 'visitDurationSeconds': 3600,
+                                     'starsystem': f'Loadtest System {i}'} for i in range(itinerary)],
+                      'totalDistanceJumpedLY': rnd.randint(0, 100000), 'currentJump': None},
+        'finance': {'bankBalance': 0, 'bankReservedBalance': 0, 'taxation': rnd.randint(0, 100),
+                    'numJumps': rnd.randint(0, 500), 'coreCost': 5000000, 'servicesCost': 1500000,
+                    'servicesCostToDate': 0, 'jumpsCost': 100000},
+        'servicesCrew': {'refuel': {'crewMember': {'name': 'Loadtest Crew', 'enabled': 'Active'}}},
+        'cargo': [{'commodity': f'Commodity{i}', 'locName': f'Commodity {i}', 'qty': rnd.randint(1, 500),
+                   'stolen': i % 7 == 0, 'value': rnd.randint(100, 10000), 'mission': False}
+                  for i in range(cargo)],
+        'market': {'id': 3700000000 + int(subject), 'name': callsign, 'outpostType': 'fleetcarrier',
+                   'services': {service: 'ok' for service in SERVICES},
+                   'commodities': [{'id': 128000000 + i, 'name': f'Commodity{i}', 'locName': f'Commodity {i}',
+                                    'categoryname': 'Loadtest', 'stock': rnd.randint(0, 20000),
+                                    'demand': rnd.randint(0, 20000), 'buyPrice': rnd.randint(100, 100000),
+                                    'sellPrice': rnd.randint(100, 100000), 'meanPrice': 5000,
+                                    'stockBracket': 2, 'demandBracket': 2, 'statusFlags': []}
+                                   for i in range(commodities)]},
+        'ships': {'shipyard_list': {f'Ship{i}': {'id': 128049000 + i, 'name': f'Ship{i}',
+                                                 'basevalue': rnd.randint(10 ** 5, 10 ** 8), 'stock': 1}
+                                    for i in range(ships)}},
+        'modules': {str(128064000 + i): {'id': 128064000 + i, 'category': 'weapon',
+                                         'name': f'Hpt_Loadtest_Module{i}', 'cost': rnd.randint(1000, 10 ** 7),
+                                         'stock': rnd.randint(0, 50)} for i in range(modules)},
+    }
+    return json.dumps(data).encode()
+
+
+class FakeFrontier(object):
+    def __init__(self, args):
+        self.args = args
+
+    def delay(self):
+        """Sleeps for the configured latency, with jitter."""
+        latency = self.args.latency + random.uniform(-self.args.jitter, self.args.jitter)
+        if latency > 0:
+            time.sleep(latency / 1000.0)
+
+    def failure(self, allow_no_content=False):
+        """
+        Rolls for an injected failure.
+        :return: An error response, or None to proceed normally
+        """
+        roll = random.random()
+        if roll < self.args.error_rate:
+            return Response(status=500, json_body={'message': 'Injected failure'})
+        roll = roll - self.args.error_rate
+        if roll < self.args.unauthorized_rate:
+            return Response(status=401, json_body={'message': 'Injected unauthorized'})
+        roll = roll - self.args.unauthorized_rate
+        if allow_no_content and roll < self.args.no_content_rate:
+            return Response(status=204)
+        return None
+
+    def subject(self, request):
+        """
+        Extracts the token subject from the Authorization header.
+        :return: Integer subject or None
+        """
+        auth = request.headers.get('Authorization', '')
+        parts = auth.replace('Bearer ', '').split('.')
+        if len(parts) == 3 and parts[0] == 'fake' and parts[1].isdigit():
+            return int(parts[1])
+        return None
+
+    def fleetcarrier(self, request):
+        self.delay()
+        subject = self.subject(request)
+        if subject is None:
+            return Response(status=401, json_body={'message': 'No valid token'})
+        failed = self.failure(allow_no_content=True)
+        if failed:
+            return failed
+        a = self.args
+        return Response(body=fake_carrier(subject, a.commodities, a.modules, a.ships, a.itinerary, a.cargo),
+                        content_type='application/json')
+
+    def profile(self, request):
+        self.delay()
+        subject = self.subject(request)
+        if subject is None:
+            return Response(status=401, json_body={'message': 'No valid token'})
+        failed = self.failure()
+        if failed:
+            return failed
+        return Response(json_body={'commander': {'id': subject, 'name': f'LOADTEST {subject}'},
+                                   'lastSystem': {'id': 10477373803, 'name': 'Sol', 'faction': 'Federation'}})
+
+    def token(self, request):
+        self.delay()
+        failed = self.failure()
+        if failed:
+            return failed
+        grant = request.POST.get('grant_type')
+        if grant == 'refresh_token':
+            parts = request.POST.get('refresh_token', '').split('.')
+        elif grant == 'authorization_code':
+            parts = request.POST.get('code', '').split('.')
+        else:
+            parts = []
+        if len(parts) != 2 or not parts[1].isdigit():
+            return Response(status=400, json_body={'message': 'invalid_grant'})
+        return Response(json_body=fake_token(int(parts[1]), self.args.token_lifetime))
+
+    def auth(self, request):
+        self.delay()
+        subject = request.params.get('subject', '1')
+        query = urlencode({'code': f'code.{subject}', 'state': request.params.get('state', '')})
+        return exc.HTTPFound(location=f"{request.params.get('redirect_uri', '/')}?{query}")
+
+    def systems(self, request):
+        self.delay()
+        failed = self.failure()
+        if failed:
+            return failed
+        name = request.params.get('filter[name:eq]') or request.params.get('filter[id64:eq]') or 'Sol'
+        return Response(json_body={'data': [{'id': '10477373803', 'type': 'systems',
+                                             'attributes': {'name': name, 'id64': 10477373803,
+                                                            'coords': {'x': 0.0, 'y': 0.0, 'z': 0.0}}}]})
+
+
+def make_app(args):
+    fake = FakeFrontier(args)
+    with Configurator() as config:
+        for name, path in [('fleetcarrier', '/fleetcarrier'), ('profile', '/profile'), ('token', '/token'),
+                           ('auth', '/auth'), ('systems', '/api/systems')]:
+            config.add_route(name, path)
+            config.add_view(getattr(fake, name), route_name=name)
+    return config.make_wsgi_app()
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Fake CAPI/auth server for load testing.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6580)
+    parser.add_argument('--threads', type=int, default=32, help='Waitress worker threads')
+    parser.add_argument('--commodities', type=int, default=40, help='Market entries per carrier')
+    parser.add_argument('--modules', type=int, default=100, help='Outfitting entries per carrier')
+    parser.add_argument('--ships', type=int, default=10, help='Shipyard entries per carrier')
+    parser.add_argument('--itinerary', type=int, default=20, help='Completed jumps per carrier')
+    parser.add_argument('--cargo', type=int, default=10, help='Cargo entries per carrier')
+    parser.add_argument('--latency', type=float, default=150.0, help='Mean response latency in ms')
+    parser.add_argument('--jitter', type=float, default=50.0, help='Latency jitter in ms (+/-)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 500')
+    parser.add_argument('--unauthorized-rate', type=float, default=0.0,
+                        help='Fraction of requests answered with 401')
+    parser.add_argument('--no-content-rate', type=float, default=0.0,
+                        help='Fraction of /fleetcarrier requests answered with 204')
+    parser.add_argument('--token-lifetime', type=int, default=14400, help='Seconds issued tokens stay valid')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    from waitress import serve
+
+    args = parse_args(argv)
+    print(f"Fake CAPI listening on http://{args.host}:{args.port} (sample payload: "
+          f"{len(fake_carrier(1, args.commodities, args.modules, args.ships, args.itinerary, args.cargo))} bytes)")
+    serve(make_app(args), host=args.host, port=args.port, threads=args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+# Fills in the derived search columns (grid cells and search names) of carriers saved before they existed.
+import argparse
+import sys
+
+from pyramid.paster import bootstrap, setup_logging
+from sqlalchemy.exc import OperationalError
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+
+    try:
+        from ..utils import namesearch, spatial
+
+        with env['request'].tm:
+            dbsession = env['request'].dbsession
+            cells = spatial.fill_cells(dbsession)
+            names = namesearch.fill_names(dbsession)
+        print(f"Filled in grid cells for {cells} and search names for {names} carriers.")
+    except OperationalError:
+        print('''
+Pyramid is having a problem using your SQL database.  The problem
+might be caused by one of the following things:
+
+1.  You may need to initialize your database tables with `alembic`.
+    Check your README.txt for description and try to run it.
+
+2.  Your database server may not be running.  Check that the
+    database server referred to by the "sqlalchemy.url" setting in
+    your "development.ini" file is running.
+            ''')
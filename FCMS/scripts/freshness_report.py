@@ -0,0 +1,104 @@
+# Reports per-carrier refresh intervals and the CAPI calls they save over the old fixed 15 minutes.
+import argparse
+import sys
+from datetime import datetime, timedelta
+
+from pyramid.paster import bootstrap, setup_logging
+from sqlalchemy.exc import OperationalError
+
+FIXED_INTERVAL = 900
+
+
+def history(dbsession, days):
+    """
+    Counts recent /fleetcarrier fetches per carrier, and how many of them returned the same payload as
+    the fetch before.
+    :param dbsession: Database session
+    :param days: Days of snapshot history to look at
+    :return: A dict of carrier ID to (fetches, unchanged)
+    """
+    from ..models import Snapshot
+
+    since = datetime.now() - timedelta(days=days)
+    rows = dbsession.query(Snapshot.carrier_id, Snapshot.blob_id).\
+        filter(Snapshot.endpoint == '/fleetcarrier', Snapshot.carrier_id != None, Snapshot.fetchedAt >= since).\
+        order_by(Snapshot.carrier_id, Snapshot.fetchedAt, Snapshot.id)
+    stats = {}
+    last = (None, None)
+    for cid, blob_id in rows:
+        fetches, unchanged = stats.get(cid, (0, 0))
+        stats[cid] = (fetches + 1, unchanged + (1 if last == (cid, blob_id) else 0))
+        last = (cid, blob_id)
+    return stats
+
+
+def report(dbsession, days=7, top=20):
+    from ..models import Carrier, CarrierFreshness
+    from ..utils import freshness
+
+    now = datetime.now()
+    fetched = history(dbsession, days)
+    rows = dbsession.query(CarrierFreshness, Carrier.callsign).\
+        join(Carrier, Carrier.id == CarrierFreshness.carrier_id).all()
+    fixed_total = 0.0
+    adaptive_total = 0.0
+    lines = []
+    for row, callsign in rows:
+        interval = freshness.compute_interval(row, now)
+        fixed = freshness.expected_calls(row, FIXED_INTERVAL, now)
+        adaptive = freshness.expected_calls(row, interval, now)
+        fixed_total = fixed_total + fixed
+        adaptive_total = adaptive_total + adaptive
+        fetches, unchanged = fetched.get(row.carrier_id, (0, 0))
+        lines.append((fixed - adaptive, callsign, interval, row.changeRate or 0.0, freshness.views_per_day(row, now),
+                      fetches, unchanged, fixed, adaptive))
+
+    total_fetches = sum(f for f, u in fetched.values())
+    total_unchanged = sum(u for f, u in fetched.values())
+    print(f"Carriers modelled: {len(rows)}")
+    print(f"/fleetcarrier fetches in the last {days} days: {total_fetches}, "
+          f"{total_unchanged} of them ({100.0 * total_unchanged / total_fetches if total_fetches else 0:.1f}%) "
+          f"returned an unchanged payload.")
+    print(f"Estimated CAPI calls per day: fixed {FIXED_INTERVAL // 60} min {fixed_total:.0f}, "
+          f"adaptive {adaptive_total:.0f}, saving {fixed_total - adaptive_total:.0f} "
+          f"({100.0 * (fixed_total - adaptive_total) / fixed_total if fixed_total else 0:.1f}%).")
+    print()
+    print(f"{'Callsign':<10}{'Interval':>10}{'Change':>8}{'Views/d':>9}{'Fetches':>9}{'Same':>6}"
+          f"{'Fixed/d':>9}{'Adapt/d':>9}")
+    for saved, callsign, interval, rate, views, fetches, unchanged, fixed, adaptive in \
+            sorted(lines, key=lambda line: line[0], reverse=True)[:top]:
+        print(f"{callsign or '?':<10}{interval // 60:>8}m {rate:>7.2f}{views:>9.1f}{fetches:>9}{unchanged:>6}"
+              f"{fixed:>9.1f}{adaptive:>9.1f}")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument('--days', type=int, default=7, help='Days of fetch history to summarise')
+    parser.add_argument('--top', type=int, default=20, help='Carriers to list, by calls saved')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+
+    try:
+        with env['request'].tm:
+            report(env['request'].dbsession, days=args.days, top=args.top)
+    except OperationalError:
+        print('''
+Pyramid is having a problem using your SQL database.  The problem
+might be caused by one of the following things:
+
+1.  You may need to initialize your database tables with `alembic`.
+    Check your README.txt for description and try to run it.
+
+2.  Your database server may not be running.  Check that the
+    database server referred to by the "sqlalchemy.url" setting in
+    your "development.ini" file is running.
+            ''')
@@ -0,0 +1,66 @@
+# Loads a galaxy systems dump into the systems table and writes the coordinate array.
+import argparse
+import sys
+import time
+
+from pyramid.paster import bootstrap, setup_logging
+from sqlalchemy.exc import OperationalError
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument('dump', help='Systems dump: NDJSON or CSV (name, id64, x, y, z), optionally gzipped')
+    parser.add_argument('--format', choices=['ndjson', 'csv'], default=None,
+                        help='Dump format (default: guessed from the file name)')
+    parser.add_argument('--batch', type=int, default=10000, help='Rows per batch and transaction')
+    parser.add_argument('--coords', default=None,
+                        help='Where to write the coordinate array (default: systems_coords_path)')
+    parser.add_argument('--no-coords', action='store_true', help="Don't build the coordinate array")
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+
+    try:
+        from ..utils import systemdb
+
+        fmt = args.format or ('csv' if '.csv' in args.dump else 'ndjson')
+        parse = systemdb.parse_csv if fmt == 'csv' else systemdb.parse_ndjson
+        coords_path = args.coords or systemdb.coords_path
+        builder = systemdb.CoordBuilder() if coords_path and not args.no_coords else None
+        start = time.monotonic()
+        tm = env['request'].tm
+        tm.begin()
+        dbsession = env['request'].dbsession
+
+        def commit():
+            tm.commit()
+            tm.begin()
+
+        with systemdb.open_dump(args.dump) as stream:
+            count = systemdb.load(dbsession, parse(stream), batch_size=args.batch, commit=commit,
+                                  coords=builder)
+        tm.commit()
+        print(f"Loaded {count} systems in {time.monotonic() - start:.1f}s.")
+        if builder:
+            written = builder.save(coords_path)
+            print(f"Wrote coordinates for {written} systems to {coords_path}.")
+    except OperationalError:
+        print('''
+Pyramid is having a problem using your SQL database.  The problem
+might be caused by one of the following things:
+
+1.  You may need to initialize your database tables with `alembic`.
+    Check your README.txt for description and try to run it.
+
+2.  Your database server may not be running.  Check that the
+    database server referred to by the "sqlalchemy.url" setting in
+    your "development.ini" file is running.
+            ''')
@@ -0,0 +1,74 @@
+# Runs queued background jobs (deferred carrier refreshes and the like) outside the web processes.
+import argparse
+import sys
+import time
+
+from pyramid.paster import bootstrap, setup_logging
+from sqlalchemy.exc import OperationalError
+
+
+def run_pass(env, batch_size=10):
+    """
+    Requeues stale jobs, then runs queued jobs until the queue is empty.
+    :param env: Bootstrapped pyramid environment
+    :param batch_size: Jobs fetched per queue read
+    :return: Number of jobs run
+    """
+    from ..utils import jobs
+
+    ran = 0
+    with env['request'].tm:
+        requeued = jobs.requeue_stale(env['request'].dbsession)
+        if requeued:
+            print(f"Requeued {requeued} stale jobs.")
+    while True:
+        with env['request'].tm:
+            queued = jobs.next_queued(env['request'].dbsession, limit=batch_size)
+        if not queued:
+            break
+        for job_id in queued:
+            status = jobs.execute(env['registry'], job_id)
+            if status:
+                ran = ran + 1
+                print(f"Job {job_id}: {status}")
+    return ran
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument('--poll', type=float, default=2.0,
+                        help='Seconds to sleep when the queue is empty')
+    parser.add_argument('--once', action='store_true',
+                        help='Empty the queue once and exit')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+    # Importing carrier_data registers its job handlers.
+    from ..utils import carrier_data  # noqa: F401
+
+    try:
+        while True:
+            run_pass(env)
+            if args.once:
+                break
+            time.sleep(args.poll)
+    except OperationalError:
+        print('''
+Pyramid is having a problem using your SQL database.  The problem
+might be caused by one of the following things:
+
+1.  You may need to initialize your database tables with `alembic`.
+    Check your README.txt for description and try to run it.
+
+2.  Your database server may not be running.  Check that the
+    database server referred to by the "sqlalchemy.url" setting in
+    your "development.ini" file is running.
+            ''')
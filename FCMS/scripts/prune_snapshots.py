@@ -0,0 +1,42 @@
+# Drops old CAPI snapshot history and payloads nothing refers to any more.
+import argparse
+import sys
+
+from pyramid.paster import bootstrap, setup_logging
+from sqlalchemy.exc import OperationalError
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument('--days', type=int, default=None,
+                        help='Days of history to keep (default: snapshot_keep_days)')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+
+    try:
+        from ..utils import snapshots
+
+        with env['request'].tm:
+            deleted, blobs = snapshots.prune(env['request'].dbsession, days=args.days)
+        print(f"Deleted {deleted} snapshots and {blobs} unreferenced payloads.")
+    except OperationalError:
+        print('''
+Pyramid is having a problem using your SQL database.  The problem
+might be caused by one of the following things:
+
+1.  You may need to initialize your database tables with `alembic`.
+    Check your README.txt for description and try to run it.
+
+2.  Your database server may not be running.  Check that the
+    database server referred to by the "sqlalchemy.url" setting in
+    your "development.ini" file is running.
+            ''')
@@ -0,0 +1,86 @@
+# Proactively refreshes CAPI access tokens before they expire, so the request path doesn't have to.
+import argparse
+import sys
+import time
+
+from pyramid.paster import bootstrap, setup_logging
+from sqlalchemy.exc import OperationalError
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def refresh_batches(env, window=None, batch_size=None):
+    """
+    Refreshes all tokens expiring within the window, one transaction per batch.
+    :param env: Bootstrapped pyramid environment
+    :param window: Seconds ahead of expiry to refresh tokens
+    :param batch_size: Users per batch
+    :return: A tuple of (refreshed, failed) counts
+    """
+    from ..utils import capi
+
+    refreshed = 0
+    failed = 0
+    after = None
+    while True:
+        with env['request'].tm:
+            dbsession = env['request'].dbsession
+            users = capi.get_expiring_users(dbsession, window=window, after=after, limit=batch_size)
+            if not users:
+                break
+            # Keyset on the pre-refresh expiry, so failed rows don't get picked up again this run.
+            after = (users[-1].token_expiration, users[-1].id)
+            for user in users:
+                # One bad token or auth server response must not cost the rest of the batch its refresh.
+                try:
+                    ok = capi.refresh_user_token(user)
+                except Exception:
+                    log.exception(f"Token refresh for {user.username} failed.")
+                    ok = False
+                if ok:
+                    refreshed = refreshed + 1
+                else:
+                    failed = failed + 1
+    return refreshed, failed
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument('--window', type=int, default=None,
+                        help='Refresh tokens expiring within this many seconds (default: token_refresh_window)')
+    parser.add_argument('--batch', type=int, default=None,
+                        help='Users per transaction (default: token_refresh_batch)')
+    parser.add_argument('--loop', type=int, default=0,
+                        help='Keep running, sleeping this many seconds between passes')
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+
+    try:
+        while True:
+            refreshed, failed = refresh_batches(env, window=args.window, batch_size=args.batch)
+            print(f"Refreshed {refreshed} tokens, {failed} failed.")
+            if not args.loop:
+                break
+            time.sleep(args.loop)
+    except OperationalError:
+        print('''
+Pyramid is having a problem using your SQL database.  The problem
+might be caused by one of the following things:
+
+1.  You may need to initialize your database tables with `alembic`.
+    Check your README.txt for description and try to run it.
+
+2.  Your database server may not be running.  Check that the
+    database server referred to by the "sqlalchemy.url" setting in
+    your "development.ini" file is running.
+            ''')
@@ -40,6 +40,34 @@ class BaseTest(unittest.TestCase):
         Base.metadata.drop_all(self.engine)
 
 
+# Settings capi, encryption and the modules importing them read at import.
+SETTINGS = {'capiURL': None, 'authURL': None, 'redirectURL': None, 'client_id': 'test', 'client_secret': 'test',
+            'crypt_method': 'sha256_crypt'}
+
+
+class SQLiteTest(unittest.TestCase):
+    """
+    Runs each test against a fresh in-memory SQLite database, through a plain session, with the
+    process-wide search indexes emptied.
+    """
+    url = 'sqlite://'
+
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        from .models.meta import Base
+        from .utils import commodities, namesearch, spatial
+        self.config = testing.setUp(settings=dict(SETTINGS))
+        self.engine = create_engine(self.url)
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        commodities._index = namesearch._index = spatial._index = None
+
+    def tearDown(self):
+        self.session.close()
+        testing.tearDown()
+
+
 class TestMyViewSuccessCondition(BaseTest):
 
     def setUp(self):
@@ -64,3 +92,1134 @@ class TestMyViewFailureCondition(BaseTest):
         from .views.default import my_view
         info = my_view(dummy_request(self.session))
         self.assertEqual(info.status_int, 500)
+
+
+class TestTokenRefresh(SQLiteTest):
+    def setUp(self):
+        import time
+        from .models import User
+        super(TestTokenRefresh, self).setUp()
+        self.now = int(time.time())
+        for i, expires in enumerate([100, 4000, 50, 100, None, -20]):
+            token = {'access_token': f'access.{i}', 'refresh_token': f'refresh.{i}', 'token_type': 'Bearer'}
+            self.session.add(User(id=i + 1, username=f'user{i}', cmdr_name=f'Cmdr {i}',
+                                  access_token=str(token), refresh_token=f'refresh.{i}',
+                                  token_expiration=self.now + expires if expires is not None else None))
+        self.session.flush()
+
+    def test_window(self):
+        from .utils import capi
+        users = capi.get_expiring_users(self.session, window=1800)
+        self.assertEqual([user.id for user in users], [6, 3, 1, 4])
+        first = capi.get_expiring_users(self.session, window=1800, limit=2)
+        self.assertEqual([user.id for user in first], [6, 3])
+        after = (first[-1].token_expiration, first[-1].id)
+        self.assertEqual([user.id for user in capi.get_expiring_users(self.session, window=1800, after=after)],
+                         [1, 4])
+        self.assertEqual([user.id for user in capi.get_expiring_users(self.session, window=10)], [6])
+
+    def test_batches(self):
+        import time
+        from unittest import mock
+        from .models import User
+        from .scripts.refresh_tokens import refresh_batches
+        from .utils import capi
+        env = {'request': testing.DummyRequest(dbsession=self.session, tm=transaction.TransactionManager())}
+        # As the manual fallback returns it: the auth server's JSON, without expires_at.
+        fallback = {'access_token': 'new', 'refresh_token': 'refresh.new', 'token_type': 'Bearer',
+                    'expires_in': 14400}
+        with mock.patch.object(capi, 'update_token',
+                               side_effect=[fallback, RuntimeError('boom'), None, fallback]) as update:
+            self.assertEqual(refresh_batches(env, window=1800, batch_size=3), (2, 2))
+            self.assertEqual(update.call_count, 4)
+        refreshed = self.session.query(User).get(6)
+        self.assertEqual(refreshed.refresh_token, 'refresh.new')
+        self.assertAlmostEqual(refreshed.token_expiration, int(time.time()) + 14400, delta=5)
+        self.assertIn("'expires_at'", refreshed.access_token)
+        self.assertEqual(self.session.query(User).get(3).token_expiration, self.now + 50)
+
+
+class TestCapiClient(unittest.TestCase):
+    def setUp(self):
+        testing.setUp(settings=dict(SETTINGS))
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_client_per_thread(self):
+        import threading
+        from .utils import capi
+        clients = []
+        worker = threading.Thread(target=lambda: clients.extend([capi.get_client(), capi.get_client()]))
+        worker.start()
+        worker.join()
+        self.assertIs(clients[0], clients[1])
+        self.assertIs(capi.get_client(), capi.get_client())
+        self.assertIsNot(capi.get_client(), clients[0])
+
+
+class TestLoadTest(SQLiteTest):
+    def test_percentile(self):
+        from .scripts.capi_loadtest import percentile
+        values = list(range(1, 11))
+        self.assertEqual([percentile(values, pct) for pct in (0, 10, 14, 50, 54, 90, 99, 100)],
+                         [1, 1, 2, 5, 6, 9, 10, 10])
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertEqual(percentile([], 50), 0.0)
+
+    def test_delete_carriers(self):
+        from .models import Carrier, CarrierExtra, CarrierFreshness, Job, Market, Ship, Snapshot
+        from .scripts.capi_loadtest import delete_carriers
+        from .utils import snapshots
+        for cid in (1, 2):
+            self.session.add_all([Carrier(id=cid, callsign=f'DEL-00{cid}'), CarrierExtra(cid=cid),
+                                  CarrierFreshness(carrier_id=cid), Job(carrier_id=cid),
+                                  Market(carrier_id=cid), Ship(carrier_id=cid)])
+            snapshots.store(self.session, '/fleetcarrier', '{}', carrier_id=cid)
+        self.session.flush()
+        delete_carriers(self.session, [1])
+        for model in (CarrierFreshness, Job, Market, Ship, Snapshot):
+            self.assertEqual([row.carrier_id for row in self.session.query(model)], [2])
+        self.assertEqual([row.cid for row in self.session.query(CarrierExtra)], [2])
+        self.assertEqual([row.id for row in self.session.query(Carrier)], [2])
+
+    def test_fake_capi(self):
+        import json
+        from webtest import TestApp
+        from .scripts import fake_capi
+        args = fake_capi.parse_args(['fake_capi', '--latency', '0', '--jitter', '0', '--modules', '3',
+                                     '--ships', '0'])
+        app = TestApp(fake_capi.make_app(args))
+        app.get('/fleetcarrier', status=401)
+        token = app.post('/token', {'grant_type': 'refresh_token', 'refresh_token': 'refresh.42'}).json
+        self.assertTrue(token['access_token'].startswith('fake.42.'))
+        self.assertEqual(token['expires_in'], 14400)
+        app.post('/token', {'grant_type': 'refresh_token', 'refresh_token': 'nonsense'}, status=400)
+        headers = {'Authorization': f"Bearer {token['access_token']}"}
+        carrier = json.loads(app.get('/fleetcarrier', headers=headers).body)
+        self.assertEqual(carrier['name']['callsign'], fake_capi.fake_callsign(42))
+        self.assertEqual(len(carrier['modules']), 3)
+        self.assertEqual(carrier['ships']['shipyard_list'], {})
+        self.assertEqual(app.get('/profile', headers=headers).json['commander']['id'], 42)
+        location = app.get('/auth', {'subject': '7', 'state': 'xyz', 'redirect_uri': '/back'}).location
+        self.assertIn('code=code.7', location)
+        self.assertEqual(app.get('/api/systems', {'filter[name:eq]': 'Achenar'}).json['data'][0]['attributes']
+                         ['name'], 'Achenar')
+        args.error_rate = 1.0
+        app.get('/profile', headers=headers, status=500)
+
+
+class TestJobs(SQLiteTest):
+    def setUp(self):
+        import os
+        import tempfile
+        from sqlalchemy.orm import sessionmaker
+        from .models import get_tm_session
+        # execute() works through sessions of its own, so they need a database they can all see.
+        self.dir = tempfile.TemporaryDirectory()
+        self.url = f"sqlite:///{os.path.join(self.dir.name, 'jobs.sqlite')}"
+        super(TestJobs, self).setUp()
+        self.config.registry.settings['tm.manager_hook'] = 'pyramid_tm.explicit_manager'
+        self.config.include('pyramid_tm')
+        factory = sessionmaker(bind=self.engine)
+        self.config.registry['dbsession_factory'] = factory
+        self.config.add_request_method(lambda r: get_tm_session(factory, r.tm), 'dbsession', reify=True)
+        self.config.commit()
+
+    def tearDown(self):
+        super(TestJobs, self).tearDown()
+        self.engine.dispose()
+        self.dir.cleanup()
+
+    def test_enqueue_and_claim(self):
+        from sqlalchemy.exc import IntegrityError
+        from .models import Job
+        from .utils import jobs
+        request = testing.DummyRequest(dbsession=self.session)
+        job = jobs.enqueue(request, 'update_carrier', 1)
+        self.assertIs(jobs.enqueue(request, 'update_carrier', 1), job)
+        self.assertIsNot(jobs.enqueue(request, 'import_carrier', 1), job)
+        # What a concurrent request that missed the first job would try.
+        with self.assertRaises(IntegrityError):
+            with self.session.begin_nested():
+                self.session.add(Job(job_type='update_carrier', carrier_id=1, status='queued'))
+        self.assertTrue(jobs.claim(self.session, job.id))
+        self.assertFalse(jobs.claim(self.session, job.id))
+        self.session.expire_all()
+        self.assertEqual((job.status, job.attempts), ('running', 1))
+        self.assertIs(jobs.enqueue(request, 'update_carrier', 1), job)
+        job.status = 'done'
+        self.assertIsNot(jobs.enqueue(request, 'update_carrier', 1), job)
+
+    def test_requeue_stale(self):
+        from datetime import datetime, timedelta
+        from .models import Job
+        from .utils import jobs
+        old = datetime.now() - timedelta(seconds=jobs.stale_after + 1)
+        retry = Job(job_type='a', carrier_id=1, status='running', attempts=1, startedAt=old)
+        spent = Job(job_type='b', carrier_id=1, status='running', attempts=jobs.max_attempts, startedAt=old)
+        busy = Job(job_type='c', carrier_id=1, status='running', attempts=1, startedAt=datetime.now())
+        self.session.add_all([retry, spent, busy])
+        self.session.flush()
+        self.assertEqual(jobs.requeue_stale(self.session), 2)
+        self.assertEqual([retry.status, spent.status, busy.status], ['queued', 'failed', 'running'])
+
+    def test_execute(self):
+        from .models import Job
+        from .utils import jobs
+        seen = []
+
+        def work(request, job):
+            report = jobs.reporter(request, job)
+            report(50, 'Halfway')
+            seen.append((job.progress, job.message))
+            if job.job_type == 'test_fails':
+                raise RuntimeError('Broken')
+            return True
+
+        self.session.add_all([Job(id=1, job_type='test_works', carrier_id=1, status='queued', attempts=0),
+                              Job(id=2, job_type='test_fails', carrier_id=1, status='queued', attempts=0),
+                              Job(id=3, job_type='test_unknown', carrier_id=1, status='queued', attempts=0)])
+        self.session.commit()
+        registry = self.config.registry
+        try:
+            jobs.handlers.update({'test_works': work, 'test_fails': work})
+            self.assertEqual(jobs.execute(registry, 1), 'done')
+            self.assertIsNone(jobs.execute(registry, 1))
+            self.assertEqual(jobs.execute(registry, 2), 'queued')
+            self.assertEqual(jobs.execute(registry, 3), 'failed')
+        finally:
+            del jobs.handlers['test_works'], jobs.handlers['test_fails']
+        self.assertEqual(seen, [(50, 'Halfway'), (50, 'Halfway')])
+        self.session.expire_all()
+        done, failed = self.session.query(Job).get(1), self.session.query(Job).get(2)
+        self.assertEqual((done.progress, done.message, done.attempts), (100, None, 1))
+        self.assertEqual((failed.status, failed.message, failed.attempts), ('queued', 'Broken', 1))
+
+
+class TestLazyJSON(unittest.TestCase):
+    payload = ('{"name": {"callsign": "ABC-123"}, "tricky": ["]", "\\"}", {"a": "["}], '
+               '"market": {"services": {"refuel": "ok"}, "id": 37, "commodities": [{"id": 1}, {"id": 2}]}, '
+               '"modules": {"128": {"id": 128}}, "ships": {"shipyard_list": []}, "empty": null}')
+
+    def test_members(self):
+        from .utils.jsonscan import LazyJSON
+        data = LazyJSON(self.payload)
+        self.assertEqual(data['name'], {'callsign': 'ABC-123'})
+        self.assertEqual(data['tricky'], [']', '"}', {'a': '['}])
+        self.assertEqual(data.value('market', 'id'), 37)
+        self.assertNotIn('cargo', data)
+        self.assertRaises(KeyError, data.value, 'market', 'nope')
+
+    def test_iter_values(self):
+        from .utils.jsonscan import LazyJSON
+        data = LazyJSON(self.payload.encode())
+        self.assertEqual(list(data.iter_values('market', 'commodities')), [{'id': 1}, {'id': 2}])
+        self.assertEqual(list(data.iter_values('modules')), [{'id': 128}])
+        self.assertEqual(list(data.iter_values('ships', 'shipyard_list')), [])
+        self.assertEqual(list(data.iter_values('empty')), [])
+
+    def test_invalid(self):
+        from json import JSONDecodeError
+        from .utils.jsonscan import LazyJSON
+        self.assertRaises(JSONDecodeError, LazyJSON, b'')
+        self.assertRaises(JSONDecodeError, LazyJSON, '{"a": [1, 2}')
+
+
+class TestUpdateCarrier(SQLiteTest):
+    def setUp(self):
+        from .models import Carrier, Ship, User
+        super(TestUpdateCarrier, self).setUp()
+        self.user = User(id=1, username='test', cmdr_name='Test')
+        self.carrier = Carrier(id=1, owner=1, callsign='AAB-001')
+        self.session.add_all([self.user, self.carrier, Ship(carrier_id=1, name='Old', ship_id=1, stock=1)])
+        self.session.flush()
+
+    def update(self, payload):
+        import json
+        from unittest import mock
+        from .utils import capi, carrier_data, sapi
+        from .utils.jsonscan import LazyJSON
+        request = testing.DummyRequest(dbsession=self.session, user=None)
+        with mock.patch.object(capi, 'fetch_carrier_payload', return_value=LazyJSON(json.dumps(payload))), \
+                mock.patch.object(sapi, 'get_coords', return_value={'x': 1.0, 'y': 2.0, 'z': 3.0}):
+            return carrier_data.update_carrier(request, self.carrier.id, self.user)
+
+    def test_without_shipyard(self):
+        import json
+        from .models import Market, Module, Ship
+        from .scripts.fake_capi import fake_carrier
+        payload = json.loads(fake_carrier(1, 5, 3, 2, 0, 1))
+        del payload['ships']['shipyard_list']
+        self.assertIsNotNone(self.update(payload))
+        self.assertEqual(self.session.query(Ship).count(), 0)
+        self.assertEqual(self.session.query(Module).count(), 3)
+        self.assertEqual(self.session.query(Market).count(), 5)
+        # The market was streamed into its table and the commodity index entries collected on the way.
+        self.assertEqual(len(self.session.info['commodities_changed'][1]),
+                         self.session.query(Market).filter(Market.categoryname != 'NonMarketable').count())
+        self.assertIsNotNone(self.carrier.marketUpdated)
+        del payload['ships']
+        payload['modules'] = None
+        self.assertIsNotNone(self.update(payload))
+        self.assertEqual(self.session.query(Module).count(), 0)
+        self.assertEqual(self.carrier.x, 1.0)
+
+    def test_changed(self):
+        import json
+        from unittest import mock
+        from .models import Snapshot
+        from .scripts.fake_capi import fake_carrier
+        from .utils import freshness
+        payload = json.loads(fake_carrier(1, 5, 3, 2, 0, 1))
+        with mock.patch.object(freshness, 'record_refresh') as record:
+            self.update(payload)
+            self.update(payload)
+            payload['balance'] = payload['balance'] + 1
+            self.update(payload)
+        self.assertEqual([call[0][2] for call in record.call_args_list], [True, False, True])
+        self.assertEqual(self.session.query(Snapshot).count(), 3)
+
+
+class TestCarrierRefresh(SQLiteTest):
+    def test_refresh_asks_capi(self):
+        from datetime import datetime, timedelta
+        from unittest import mock
+        from .models import Carrier, Snapshot, User
+        from .scripts.fake_capi import fake_callsign, fake_carrier
+        from .utils import capi, carrier_data, sapi, snapshots
+        user = User(id=1, username='test', cmdr_name='Test')
+        mycarrier = Carrier(id=1, owner=1, callsign=fake_callsign(1))
+        self.session.add_all([user, mycarrier])
+        self.session.flush()
+        raw = fake_carrier(1, 5, 3, 2, 0, 1)
+        snapshots.store(self.session, '/fleetcarrier', raw, carrier_id=1, user_id=1,
+                        fetched_at=datetime.now() - timedelta(seconds=capi.cache_ttl['/fleetcarrier'] + 60))
+        with mock.patch.object(capi, 'capi', return_value=raw) as remote:
+            # An expired snapshot isn't served from the cache...
+            self.assertEqual(capi.get_carrier_payload(user).raw, raw.decode('utf8'))
+            self.assertEqual(remote.call_count, 1)
+            # ...and refreshes always go to CAPI, even with a snapshot the cache would still serve.
+            snapshots.store(self.session, '/fleetcarrier', raw, carrier_id=1, user_id=1,
+                            fetched_at=datetime.now() - timedelta(seconds=700))
+            request = testing.DummyRequest(dbsession=self.session, user=None)
+            with mock.patch.object(sapi, 'get_coords', return_value={'x': 1.0, 'y': 2.0, 'z': 3.0}):
+                for i in range(3):
+                    self.assertIsNotNone(carrier_data.update_carrier(request, 1, None))
+            self.assertEqual(remote.call_count, 4)
+        self.assertEqual(self.session.query(Snapshot).count(), 5)
+
+
+class TestOAuthFinalize(SQLiteTest):
+    def test_new_carrier(self):
+        from unittest import mock
+        from .models import Carrier, Job, Snapshot, User
+        from .scripts.fake_capi import fake_callsign, fake_carrier
+        from .utils import capi, jobs, spatial
+        from .utils.jsonscan import LazyJSON
+        from .views.login import oauth_finalize
+        user = User(id=3, username='test', cmdr_name='Test')
+        self.session.add(user)
+        self.session.flush()
+        request = testing.DummyRequest(dbsession=self.session, user=user)
+        with mock.patch.object(capi, 'fetch_carrier_payload', return_value=LazyJSON(fake_carrier(3, 5, 3, 2, 0, 1))):
+            result = oauth_finalize(request)
+        self.assertIn('Carrier added', result['project'])
+        added = self.session.query(Carrier).one()
+        self.assertEqual((added.callsign, added.owner, user.carrierid), (fake_callsign(3), 3, added.id))
+        # Not placed at Sol until the import job has located it.
+        self.assertEqual((added.x, added.y, added.z, added.cellX), (None, None, None, None))
+        job = jobs.get_active(self.session, 'import_carrier', added.id)
+        self.assertEqual((job.status, job.user_id), ('queued', 3))
+        self.assertEqual(self.session.query(Job).count(), 1)
+        self.assertEqual(self.session.query(Snapshot).filter(Snapshot.carrier_id == added.id).count(), 1)
+        self.session.commit()
+        self.assertEqual(spatial.nearest_carriers(self.session, (0, 0, 0), 5), [])
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        from .utils.breaker import CircuitBreaker
+        self.now = 0.0
+        self.breaker = CircuitBreaker('test.invalid', window=60, min_calls=4, error_rate=0.5, slow_call=5,
+                                      slow_rate=0.5, open_for=30, probes=1, clock=lambda: self.now)
+
+    def trip(self):
+        for ok in (True, False, True, False):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.success() if ok else self.breaker.failure()
+
+    def test_trips_on_errors(self):
+        from .utils.breaker import OPEN
+        self.trip()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertTrue(self.breaker.is_open())
+
+    def test_trips_on_latency(self):
+        from .utils.breaker import OPEN
+        for elapsed in (1, 6, 1, 7):
+            self.breaker.allow()
+            self.breaker.success(elapsed)
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_old_calls_expire(self):
+        from .utils.breaker import CLOSED
+        for ok in (False, False, True):
+            self.breaker.allow()
+            self.breaker.success() if ok else self.breaker.failure()
+        self.now = 100.0
+        self.breaker.allow()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_half_open_probe(self):
+        from .utils.breaker import CLOSED, OPEN, HALF_OPEN
+        self.trip()
+        self.now = 31.0
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.now = 62.0
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success(0.2)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+
+class TestHttpAdapter(unittest.TestCase):
+    host = 'adapter.invalid'
+
+    def setUp(self):
+        from .utils import breaker
+        self.now = 0.0
+        breaker._breakers[self.host] = self.breaker = breaker.CircuitBreaker(
+            self.host, min_calls=2, error_rate=0.5, open_for=30, clock=lambda: self.now)
+
+    def tearDown(self):
+        from .utils import breaker
+        del breaker._breakers[self.host]
+
+    def send(self, status=200, error=None, acquired=True):
+        from unittest import mock
+        import requests
+        from requests.adapters import HTTPAdapter
+        from .utils import http, ratelimit
+        response = requests.Response()
+        response.status_code = status
+        prepared = requests.Request('GET', f'http://{self.host}/path').prepare()
+        with mock.patch.object(HTTPAdapter, 'send', return_value=response, side_effect=error) as sent, \
+                mock.patch.object(ratelimit, 'acquire', return_value=acquired) as acquire, \
+                mock.patch.object(ratelimit, 'pause') as pause:
+            try:
+                return http.InstrumentedAdapter().send(prepared)
+            finally:
+                self.calls = sent.call_count, acquire.call_count, pause.call_count
+
+    def test_retry_policy(self):
+        from .utils import http
+        self.assertEqual(http.retry_policy().read, http.retries)
+        self.assertEqual(http.retry_policy(read=0).read, 0)
+        self.assertEqual(http.InstrumentedAdapter(read_retries=0).max_retries.read, 0)
+
+    def test_breaker_before_rate_limit(self):
+        import requests
+        from .utils import http
+        from .utils.breaker import CLOSED, HALF_OPEN, OPEN
+        self.assertEqual(self.send(503).status_code, 503)
+        self.assertRaises(requests.ConnectionError, self.send, error=requests.ConnectionError('down'))
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertRaises(http.CircuitOpenError, self.send)
+        # Rejected by the breaker without waiting for a rate limit token.
+        self.assertEqual(self.calls, (0, 0, 0))
+        self.now = 31.0
+        self.assertRaises(http.RateLimitedError, self.send, acquired=False)
+        self.assertEqual(self.calls, (0, 1, 0))
+        # The probe slot went back, so the next call may still probe.
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertEqual(self.send(429).status_code, 429)
+        self.assertEqual(self.calls, (1, 1, 1))
+        self.assertEqual(self.breaker.state, CLOSED)
+
+
+class TestWebhooks(unittest.TestCase):
+    def test_discord(self):
+        from unittest import mock
+        from discord_webhook import DiscordEmbed
+        from .utils import http, webhooks
+        url = 'https://discord.invalid/api/webhooks/1/abc?thread_id=42'
+        with mock.patch.object(http, 'post') as post:
+            webhooks.send_webhook(url, 'Jump', hooktype='discord', myembed=DiscordEmbed(title='Jumping'))
+        (hookurl,), kwargs = post.call_args
+        self.assertEqual(hookurl, url)
+        self.assertEqual(set(kwargs['json']), {'embeds'})
+        self.assertEqual(kwargs['json']['embeds'][0]['title'], 'Jumping')
+        self.assertEqual(kwargs['params'], {'wait': 'true'})
+        payload, params = webhooks.discord_request(webhooks.DiscordWebhook(url=url, content='Hi', thread_id='7',
+                                                                           wait=False, timeout=5))
+        self.assertEqual(payload, {'content': 'Hi', 'embeds': []})
+        self.assertEqual(params, {'thread_id': '7'})
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        from .utils import metrics
+        metrics.counter('fcms_test_total', 'Test counter').inc(endpoint='/x')
+        metrics.histogram('fcms_test_seconds', 'Test histogram').observe(0.3, endpoint='/x')
+        text = metrics.render()
+        self.assertIn('# TYPE fcms_test_total counter', text)
+        self.assertIn('fcms_test_total{endpoint="/x"} 1', text)
+        self.assertIn('fcms_test_seconds_bucket{endpoint="/x",le="0.25"} 0', text)
+        self.assertIn('fcms_test_seconds_bucket{endpoint="/x",le="0.5"} 1', text)
+        self.assertIn('fcms_test_seconds_count{endpoint="/x"} 1', text)
+
+
+class TestSnapshots(SQLiteTest):
+    def test_dedup_and_latest(self):
+        from datetime import datetime, timedelta
+        from .models import SnapshotBlob, Snapshot
+        from .utils import snapshots
+        old = datetime.now() - timedelta(hours=1)
+        snapshots.store(self.session, '/fleetcarrier', '{"finance": {"taxation": 5}}', carrier_id=1, fetched_at=old)
+        snapshots.store(self.session, '/fleetcarrier', b'{"finance": {"taxation": 5}}', carrier_id=1)
+        snapshots.store(self.session, '/fleetcarrier', '{"finance": {"taxation": 7}}', carrier_id=2)
+        self.assertEqual(self.session.query(Snapshot).count(), 3)
+        self.assertEqual(self.session.query(SnapshotBlob).count(), 2)
+        payload = snapshots.latest_payload(self.session, '/fleetcarrier', carrier_id=2)
+        self.assertEqual(payload.value('finance', 'taxation'), 7)
+        self.assertIsNone(snapshots.latest_payload(self.session, '/fleetcarrier', carrier_id=3))
+        self.assertIsNone(snapshots.latest_payload(self.session, '/profile', carrier_id=1))
+        self.assertEqual(snapshots.prune(self.session, days=0), (1, 0))
+
+
+class TestCapiCache(SQLiteTest):
+    def test_ttl_and_owner(self):
+        from datetime import datetime, timedelta
+        from .models import Carrier, User
+        from .utils import capi, snapshots
+        alice, bob = User(username='alice', cmdr_name='Alice'), User(username='bob', cmdr_name='Bob')
+        self.session.add_all([alice, bob])
+        self.session.flush()
+        mine, theirs = Carrier(callsign='AAA-001', owner=alice.id), Carrier(callsign='BBB-002', owner=bob.id)
+        self.session.add_all([mine, theirs])
+        self.session.flush()
+        stale = datetime.now() - timedelta(seconds=capi.cache_ttl['/profile'] + 60)
+        snapshots.store(self.session, '/profile', '{"commander": {"name": "Alice"}}', user_id=alice.id,
+                        fetched_at=stale)
+        snapshots.store(self.session, '/fleetcarrier', '{"name": {"callsign": "AAA-001"}}', carrier_id=mine.id,
+                        user_id=alice.id)
+        self.assertIsNone(capi.get_cached(alice, '/profile'))
+        self.assertEqual(capi.get_cached(alice, '/profile', max_age=3600)['commander']['name'], 'Alice')
+        self.assertEqual(capi.get_cached(alice, '/fleetcarrier')['name']['callsign'], 'AAA-001')
+        self.assertIsNone(capi.get_cached_raw(alice, '/fleetcarrier', max_age=0))
+        self.assertIsNone(capi.get_cached_raw(alice, '/journal', max_age=3600))
+        # Bob never fetched anything, so he mustn't be served Alice's payloads.
+        self.assertIsNone(capi.get_cached(bob, '/profile', max_age=3600))
+        self.assertIsNone(capi.get_cached(bob, '/fleetcarrier', max_age=3600))
+        self.session.delete(theirs)
+        self.session.flush()
+        self.assertIsNone(capi.get_cached_raw(bob, '/fleetcarrier', max_age=3600))
+
+
+class TestEddn(SQLiteTest):
+    def docked(self, callsign, system, **extra):
+        return dict({'event': 'Docked', 'StationType': 'FleetCarrier', 'StationName': callsign,
+                     'StarSystem': system, 'StationServices': ['dock', 'commodities', 'refuel'],
+                     'timestamp': '2026-10-19T12:00:00Z'}, **extra)
+
+    def test_docked(self):
+        from datetime import datetime, timedelta
+        from .models import Carrier, CarrierFreshness
+        from .utils import eddn
+        refreshed = datetime.now() - timedelta(hours=2)
+        mycarrier = Carrier(callsign='AAA-001', currentStarSystem='Sol', x=0, y=0, z=0, lastUpdated=refreshed,
+                            hasRefuel=False)
+        self.session.add(mycarrier)
+        self.session.flush()
+        result = eddn.process_eddn(self.session, self.docked('AAA-001', 'Achenar',
+                                                             StarPos=[67.5, -119.46875, 24.84375]))
+        self.assertEqual(result['updated_carriers'], 1)
+        self.session.flush()
+        self.assertEqual((mycarrier.currentStarSystem, mycarrier.x, mycarrier.hasRefuel), ('Achenar', 67.5, True))
+        # Seeing the carrier on EDDN doesn't count as a CAPI refresh.
+        self.assertEqual(mycarrier.lastUpdated, refreshed)
+        self.assertEqual(self.session.query(CarrierFreshness).one().eddnScore, 1)
+        result = eddn.process_eddn(self.session, self.docked('BBB-002', 'Sol', StarPos=[0, 0, 0]))
+        self.assertEqual(result['new_carriers'], 1)
+        self.session.flush()
+        added = self.session.query(Carrier).filter(Carrier.callsign == 'BBB-002').one()
+        self.assertEqual(added.lastUpdated, eddn.parse_timestamp('2026-10-19T12:00:00Z'))
+        self.assertIsInstance(added.lastUpdated, datetime)
+
+
+    def test_system_address(self):
+        from .models import Carrier, StarSystem
+        from .utils import eddn, id64
+        self.session.add(StarSystem(name='Sol', nameLower='sol', id64=10477373803, x=0, y=0, z=0))
+        mycarrier = Carrier(callsign='AAA-001', currentStarSystem='Colonia', x=-9530.5, y=-910.28125, z=19808.125)
+        self.session.add(mycarrier)
+        self.session.flush()
+        eddn.process_eddn(self.session, self.docked('BBB-002', 'Sol', SystemAddress=10477373803))
+        self.session.flush()
+        added = self.session.query(Carrier).filter(Carrier.callsign == 'BBB-002').one()
+        self.assertEqual((added.x, added.y, added.z), (0, 0, 0))
+        # Colonia isn't in the systems table: the boxel centre mustn't replace the exact position...
+        eddn.process_eddn(self.session, self.docked('AAA-001', 'Colonia', SystemAddress=3238296097059))
+        self.session.flush()
+        self.assertEqual(mycarrier.x, -9530.5)
+        # ...unless the carrier has moved there.
+        mycarrier.currentStarSystem = 'Sol'
+        eddn.process_eddn(self.session, self.docked('AAA-001', 'Colonia', SystemAddress=3238296097059))
+        self.session.flush()
+        self.assertEqual(mycarrier.x, id64.approximate_coords(3238296097059)['x'])
+
+
+class TestFreshness(unittest.TestCase):
+    def test_interval(self):
+        from datetime import datetime, timedelta
+        from .models import CarrierFreshness
+        from .utils import freshness
+        now = datetime.now()
+        busy = CarrierFreshness(changeRate=1.0, viewScore=0.0, eddnScore=0.0)
+        parked = CarrierFreshness(changeRate=0.0, viewScore=0.0, eddnScore=0.0)
+        seen = CarrierFreshness(changeRate=0.0, viewScore=0.0, eddnScore=1.0, eddnAt=now - timedelta(minutes=1))
+        self.assertEqual(freshness.compute_interval(busy, now), freshness.min_interval)
+        self.assertEqual(freshness.compute_interval(parked, now), freshness.max_interval)
+        self.assertLess(freshness.compute_interval(seen, now), 2 * freshness.min_interval)
+        parked.viewScore = 100.0
+        parked.viewsAt = now
+        self.assertLess(freshness.compute_interval(parked, now), freshness.max_interval)
+
+    def test_decay(self):
+        from datetime import datetime, timedelta
+        from .utils.freshness import decay
+        now = datetime.now()
+        self.assertAlmostEqual(decay(8.0, now - timedelta(hours=2), now, 3600), 2.0)
+        self.assertEqual(decay(8.0, None, now, 3600), 0.0)
+
+
+class TestLocations(SQLiteTest):
+    def test_journal_and_resolve(self):
+        from .models import User
+        from .utils import locations
+        user = User(username='test', cmdr_name='Test')
+        self.session.add(user)
+        self.session.flush()
+        self.assertIsNone(locations.record_journal(self.session, user.id, {'event': 'Docked'}))
+        locations.record_journal(self.session, user.id, {'event': 'FSDJump', 'StarSystem': 'Colonia',
+                                                         'SystemAddress': 3238296097059,
+                                                         'StarPos': [-9530.5, -910.28125, 19808.125]})
+        # Served straight from the table, without touching CAPI or the systems API.
+        self.assertEqual(locations.resolve(self.session, user),
+                         {'name': 'Colonia', 'x': -9530.5, 'y': -910.28125, 'z': 19808.125})
+        row = locations.update(self.session, user.id, 'Colonia', source='capi')
+        self.assertEqual(row.x, -9530.5)
+        row = locations.update(self.session, user.id, 'Sol', source='capi')
+        self.assertIsNone(row.x)
+        self.assertIsNone(row.systemAddress)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.TemporaryDirectory()
+        self.now = 1000.0
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def bucket(self):
+        import os
+        from .utils.ratelimit import TokenBucket
+        return TokenBucket(os.path.join(self.dir.name, 'test.bucket'), rate=2, burst=3, clock=lambda: self.now)
+
+    def test_reserve(self):
+        first, second = self.bucket(), self.bucket()
+        # Both share the state file, like two worker processes would.
+        self.assertEqual([first.reserve(), second.reserve(), first.reserve()], [0, 0, 0])
+        self.assertEqual(second.reserve(), 0.5)
+        self.assertEqual(first.reserve(), 1.0)
+        self.assertIsNone(first.reserve(max_wait=1))
+        self.now += 1.5
+        self.assertEqual(second.reserve(), 0)
+
+    def test_pause(self):
+        bucket = self.bucket()
+        bucket.pause(5)
+        self.assertEqual(bucket.reserve(), 5.5)
+
+
+class TestTracing(unittest.TestCase):
+    def test_spans(self):
+        from .utils import tracing
+        traces = []
+
+        @tracing.traced('test')
+        def work():
+            with tracing.span('outer'):
+                with tracing.span('inner'):
+                    tracing.annotate(rows=3)
+            traces.append(tracing.current())
+
+        work()
+        self.assertIsNone(tracing.current())
+        record = traces[0].record()
+        self.assertEqual([entry['name'] for entry in record['spans']], ['outer.inner', 'outer'])
+        self.assertEqual(record['attrs'], {'rows': 3})
+        # Outside a trace, spans and annotations are harmless.
+        with tracing.span('untraced'):
+            tracing.annotate(rows=1)
+
+
+class TestSystemCache(SQLiteTest):
+    def tearDown(self):
+        from .utils import sapi
+        sapi._cache.clear()
+        super(TestSystemCache, self).tearDown()
+
+    def test_lookup(self):
+        from unittest import mock
+        from .models import StarSystem
+        from .utils import sapi
+        sol = {'data': [{'id': '10477373803', 'attributes': {'name': 'Sol', 'coords': {'x': 0, 'y': 0, 'z': 0}}}]}
+        with mock.patch.object(sapi, 'get_system_by_name', side_effect=[sol, {'data': []}]) as remote:
+            self.assertEqual(sapi.get_coords('Sol', self.session), {'x': 0.0, 'y': 0.0, 'z': 0.0})
+            self.assertEqual(sapi.lookup('SOL', self.session)['id64'], 10477373803)
+            self.assertEqual(sapi.get_coords('Nowhere', self.session)['error'], 'Not found')
+            self.assertEqual(sapi.get_coords('nowhere', self.session)['error'], 'Not found')
+            sapi._cache.clear()
+            # The table answers for hits and recent misses alike.
+            self.assertEqual(sapi.lookup('sol', self.session)['name'], 'Sol')
+            self.assertIsNone(sapi.lookup('Nowhere', self.session))
+            self.assertEqual(remote.call_count, 2)
+        self.assertEqual(self.session.query(StarSystem).count(), 2)
+
+    def test_lookup_many(self):
+        from unittest import mock
+        from .models import StarSystem
+        from .utils import sapi
+        self.session.add(StarSystem(name='Sol', nameLower='sol', id64=10477373803, x=0, y=0, z=0))
+        self.session.add(StarSystem(name='Achenar', nameLower='achenar', id64=164098653, x=67.5, y=-119.46875,
+                                    z=24.84375))
+        self.session.flush()
+        with mock.patch.object(sapi, 'get_system_by_name', return_value={'data': []}) as remote:
+            found = sapi.lookup_many(['Sol', 'SOL', 'Achenar', 'Nowhere', 'Elsewhere', None], self.session,
+                                     remote_limit=1)
+            self.assertEqual(remote.call_count, 1)
+            remote.assert_called_with('Elsewhere')
+        self.assertEqual(found['sol']['id64'], 10477373803)
+        self.assertEqual(found['achenar']['x'], 67.5)
+        self.assertIsNone(found['nowhere'])
+        self.assertIsNone(found['elsewhere'])
+
+    def test_by_id(self):
+        from unittest import mock
+        from .models import StarSystem
+        from .utils import sapi
+        self.session.add(StarSystem(name='Sol', nameLower='sol', id64=10477373803, x=0, y=0, z=0))
+        self.session.flush()
+        with mock.patch.object(sapi, 'query_sapi') as remote:
+            self.assertEqual(sapi.get_system_by_id(10477373803, self.session)['data'][0]['attributes']['name'],
+                             'Sol')
+            self.assertEqual(sapi.coords_by_id(10477373803, self.session), {'x': 0, 'y': 0, 'z': 0})
+            self.assertTrue(sapi.coords_by_id(3238296097059, self.session)['approximate'])
+            sapi.get_system_by_id(3238296097059, self.session)
+            remote.assert_called_once_with('systems', 'id64:eq', 3238296097059, '')
+
+    def test_coords_fall_back_to_address(self):
+        from unittest import mock
+        from .models import StarSystem
+        from .utils import sapi
+        self.session.add(StarSystem(name='Sol', nameLower='sol', id64=10477373803, x=0, y=0, z=0))
+        self.session.flush()
+        with mock.patch.object(sapi, 'get_system_by_name', return_value={'data': []}):
+            self.assertEqual(sapi.get_coords('Nowhere', self.session)['error'], 'Not found')
+            self.assertEqual(sapi.get_coords('Nowhere', self.session, address=10477373803), {'x': 0, 'y': 0, 'z': 0})
+            self.assertTrue(sapi.get_coords(None, self.session, address=3238296097059)['approximate'])
+            self.assertEqual(sapi.get_coords(None, self.session)['error'], 'No system provided')
+
+    def test_lookup_many_keeps_spelling(self):
+        from unittest import mock
+        from .utils import sapi
+        data = {'data': [{'id': '3238296097059', 'attributes': {'coords': {'x': -9530.5, 'y': -910.28125,
+                                                                           'z': 19808.125}}}]}
+        with mock.patch.object(sapi, 'get_system_by_name', return_value=data) as remote:
+            found = sapi.lookup_many([' Colonia '], self.session, remote_limit=1)
+            remote.assert_called_once_with('Colonia')
+        self.assertEqual(found['colonia']['name'], 'Colonia')
+
+
+class TestSystemImport(SQLiteTest):
+    def test_load(self):
+        import io
+        from .models import StarSystem
+        from .utils import systemdb
+        ndjson = io.StringIO('[\n{"id64": 10477373803, "name": "Sol", "coords": {"x": 0, "y": 0, "z": 0}},\n'
+                             '{"id64": 3238296097059, "name": "Colonia", "coords": {"x": -9530.5, "y": -910.28125, '
+                             '"z": 19808.125}},\n{"name": "No coordinates"}\n]\n')
+        csv = io.StringIO('name,id64,x,y,z\nSOL,10477373803,0,0,0\nAchenar,164098653,67.5,-119.46875,24.84375\n')
+        builder = systemdb.CoordBuilder()
+        self.assertEqual(systemdb.load(self.session, systemdb.parse_ndjson(ndjson), batch_size=1,
+                                       coords=builder), 2)
+        self.assertEqual(systemdb.load(self.session, systemdb.parse_csv(csv), coords=builder), 2)
+        self.assertEqual(self.session.query(StarSystem).count(), 3)
+        self.assertEqual(self.session.query(StarSystem).filter(StarSystem.nameLower == 'sol').one().name, 'SOL')
+        coords = builder.build()
+        self.assertEqual(list(coords['id64']), [164098653, 10477373803, 3238296097059])
+        found, xyz = systemdb.find_coords([3238296097059, 42], coords)
+        self.assertEqual(list(found), [True, False])
+        self.assertEqual(list(xyz[0]), [-9530.5, -910.28125, 19808.125])
+
+
+class TestTypeahead(unittest.TestCase):
+    def test_search(self):
+        from .utils.typeahead import PrefixIndex
+        index = PrefixIndex(['Sol', 'Colonia', 'Col 285 Sector AB-C d1', 'colonia', 'Achenar', 'Soltaka'])
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.search('col'), ['Col 285 Sector AB-C d1', 'Colonia'])
+        self.assertEqual(index.search('SOL', count=1), ['Sol'])
+        self.assertEqual(index.search('zz'), [])
+        # Names past the budget are dropped, highest priority first in.
+        self.assertEqual(len(PrefixIndex(['Sol', 'Achenar', 'Colonia'], max_bytes=30)), 2)
+
+
+class TestId64(unittest.TestCase):
+    def test_decode(self):
+        import numpy
+        from .utils import id64
+        systems = {10477373803: (0.0, 0.0, 0.0), 3238296097059: (-9530.5, -910.28125, 19808.125),
+                   164098653: (67.5, -119.46875, 24.84375)}
+        for address, real in systems.items():
+            x, y, z, masscode, size = id64.decode(address)
+            for decoded, actual in zip((x, y, z), real):
+                self.assertLessEqual(abs(decoded - actual), size / 2)
+        x, y, z, masscode, size = id64.decode(numpy.array(list(systems), dtype=numpy.uint64))
+        self.assertEqual(list(masscode), [3, 3, 5])
+        self.assertEqual(x[1], -9545.0)
+
+
+class TestSpatialIndex(SQLiteTest):
+    def test_nearest(self):
+        import math
+        import random
+        from .utils.spatial import GridIndex
+        rng = random.Random(4)
+        index = GridIndex(cell_size=500)
+        points = {}
+        for key in range(2000):
+            # A dense bubble plus a thin scattering across the galaxy.
+            spread = 2000 if key % 10 else 40000
+            points[key] = (rng.gauss(0, spread), rng.gauss(0, spread / 10), rng.gauss(0, spread))
+            index.update(key, *points[key], data={'even': key % 2 == 0})
+        index.update(5, None, None, None)
+        del points[5]
+        for origin in [(0, 0, 0), (1234.5, -20, 800), (-30000, 500, 40000)]:
+            expected = sorted((math.dist(origin, p), key) for key, p in points.items())
+            self.assertEqual([key for dist, key in index.nearest(origin, 25)], [key for dist, key in expected[:25]])
+            evens = [key for dist, key in expected if key % 2 == 0][:10]
+            self.assertEqual([key for dist, key in index.nearest(origin, 10, lambda d: d['even'])], evens)
+            self.assertEqual([key for dist, key in index.within(origin, 1500)],
+                             [key for dist, key in expected if dist <= 1500])
+        self.assertEqual(len(index), 1999)
+
+    def test_follows_commits(self):
+        from .models import Carrier
+        from .utils import spatial
+        self.session.add(Carrier(callsign='AAA-001', x=0, y=0, z=0, showSearch=True))
+        self.session.add(Carrier(callsign='AAA-002', x=100, y=0, z=0, showSearch=True))
+        self.session.commit()
+        self.assertEqual([c.callsign for d, c in spatial.nearest_carriers(self.session, (90, 0, 0), 1)], ['AAA-002'])
+        moved = self.session.query(Carrier).filter(Carrier.callsign == 'AAA-001').one()
+        moved.x = 95
+        self.session.flush()
+        self.session.rollback()
+        self.assertEqual([c.callsign for d, c in spatial.nearest_carriers(self.session, (90, 0, 0), 1)], ['AAA-002'])
+        moved.x = 95
+        self.session.commit()
+        self.assertEqual([c.callsign for d, c in spatial.nearest_carriers(self.session, (90, 0, 0), 1)], ['AAA-001'])
+
+    def test_syncs_flags(self):
+        from datetime import datetime, timedelta
+        from .models import Carrier
+        from .utils import spatial
+        carrier = Carrier(callsign='AAA-001', x=0, y=0, z=0, showSearch=True,
+                          lastUpdated=datetime.now() - timedelta(days=1))
+        self.session.add(carrier)
+        other = Carrier(callsign='AAA-002', x=5000, y=0, z=0, showSearch=True, lastUpdated=datetime.now())
+        self.session.add(other)
+        self.session.commit()
+        stamped = carrier.searchUpdated
+        self.assertIsNotNone(stamped)
+        carrier.name = '414141'
+        self.session.commit()
+        self.assertEqual(carrier.searchUpdated, stamped)
+        spatial._index, spatial._watermark = spatial._load(self.session)
+        carrier.showSearch = False
+        self.session.commit()
+        self.assertGreater(carrier.searchUpdated, stamped)
+        # As seen by a process that didn't make the change.
+        spatial._index.update(carrier.id, 0, 0, 0, spatial.flags(True, None))
+        spatial._sync(self.session)
+        self.assertEqual([key for dist, key in spatial._index.nearest((0, 0, 0), 1, spatial.searchable)],
+                         [other.id])
+
+    def test_sql_matches_index(self):
+        import random
+        from .models import Carrier
+        from .utils import spatial
+        rng = random.Random(7)
+        for i in range(300):
+            spread = 3000 if i % 5 else 30000
+            self.session.add(Carrier(callsign=f'SQL-{i:03}', x=rng.gauss(0, spread), y=rng.gauss(0, 300),
+                                     z=rng.gauss(0, spread), showSearch=i % 7 != 0, isDSSA=i % 3 == 0))
+        self.session.add(Carrier(callsign='NOW-HRE', showSearch=True))
+        self.session.commit()
+        moved = self.session.query(Carrier).filter(Carrier.callsign == 'SQL-001').one()
+        moved.x = 12345
+        self.session.commit()
+        self.assertEqual(moved.cellX, 12)
+        for origin in [(0, 0, 0), (2500, 10, -800), (-40000, 0, 60000)]:
+            for k, predicate in [(25, spatial.searchable), (5, spatial.dssa), (None, spatial.dssa)]:
+                expected = [c.callsign for d, c in spatial.nearest_carriers(self.session, origin, k, predicate)]
+                found = [c.callsign for d, c in spatial.nearest_sql(self.session, origin, k, predicate)]
+                self.assertEqual(found, expected)
+            expected = spatial.nearest_carriers(self.session, origin, None)
+            after, paged = None, []
+            while True:
+                page = spatial.nearest_sql(self.session, origin, 20, after=after)
+                paged.extend(page)
+                if len(page) < 20:
+                    break
+                after = (page[-1][0], page[-1][1].id)
+            self.assertEqual([c.callsign for d, c in paged], [c.callsign for d, c in expected])
+
+
+class TestSearchResults(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp(settings=dict(SETTINGS))
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_distances(self):
+        import numpy
+        from .models import Carrier
+        from .views import search
+        rows = [Carrier(x=3, y=4, z=0), Carrier(x=None, y=1, z=1), Carrier(x=0, y=0, z=0),
+                Carrier(x=1.0001, y=1, z=1)]
+        self.assertEqual(search.distances(rows, numpy.array((0, 0, 0))).tolist(), [5.0, 99999, 0.0, 1.73])
+        self.assertEqual(len(search.distances([], numpy.array((0, 0, 0)))), 0)
+
+    def test_services(self):
+        from .models import Carrier
+        from .views import search
+        row = Carrier(hasShipyard=True, hasOutfitting=None, hasRepair=True, hasRefuel=False, hasRearm=True,
+                      hasExploration=True, hasVoucherRedemption=False, hasBlackMarket=True, notoriousAccess=False,
+                      dockingAccess='squadronfriends', taxation=10)
+        badges = search.services(row)
+        self.assertEqual(len(badges), 11)
+        self.assertEqual(badges[0], {'color': '#00A000', 'svg': 'inline_svgs/shipyard.jinja2',
+                                     'title': 'Shipyard  available'})
+        self.assertEqual(badges[1]['title'], 'Outfitting NOT available')
+        self.assertEqual(badges[9]['title'], 'Docking available for Squadron and Friends')
+        self.assertEqual(badges[10], {'color': '#DAD55E', 'svg': 'inline_svgs/taxation.jinja2',
+                                      'title': 'Taxation is 10%'})
+        self.assertIs(search.services(row)[0], badges[0])
+
+
+class TestCommodityIndex(SQLiteTest):
+    def test_find(self):
+        from .utils.commodities import CommodityIndex
+        index = CommodityIndex()
+        index.replace(1, [('Tritium', 'Tritium', 500, 0, 50000, 0), ('painite', None, 0, 200, 0, 300000)])
+        index.replace(2, [('tritium', 'Tritium', 20, 0, 45000, 0)])
+        self.assertEqual(set(index.find('tritium')), {1, 2})
+        self.assertEqual(set(index.find('TRITIUM ', quantity=100)), {1})
+        self.assertEqual(set(index.find('Tritium', price=48000)), {2})
+        self.assertEqual(index.find('Tritium', 'sell'), {})
+        self.assertEqual(set(index.find('Painite', 'sell', price=250000)), {1})
+        index.replace(1, [])
+        self.assertEqual(set(index.find('tritium')), {2})
+        self.assertEqual(index.find('painite', 'sell'), {})
+        self.assertEqual(len(index), 1)
+
+    def test_nearest_offers(self):
+        from .models import Carrier, Market
+        from .utils import commodities
+        for i, (x, stock, public) in enumerate([(100, 500, True), (10, 5, True), (50, 500, False),
+                                                 (500, 900, True), (20, 900, True)]):
+            self.session.add(Carrier(id=i + 1, callsign=f'COM-00{i + 1}', x=x, y=0, z=0, showSearch=True,
+                                     showMarket=public))
+            self.session.add(Market(carrier_id=i + 1, name='Tritium', locName='Tritium', stock=stock,
+                                    buyPrice=50000, sellPrice=0, demand=0, categoryname='Chemicals'))
+        self.session.commit()
+        found = commodities.nearest_offers(self.session, 'tritium', (0, 0, 0), quantity=100, k=2)
+        self.assertEqual([(round(dist), row.callsign) for dist, row, offer in found],
+                         [(20, 'COM-005'), (100, 'COM-001')])
+        # A market update committed in this process shows up straight away.
+        carrier = self.session.query(Carrier).get(5)
+        self.session.query(Market).filter(Market.carrier_id == 5).delete()
+        markets = [Market(carrier_id=5, name='Tritium', locName='Tritium', stock=50, buyPrice=50000,
+                          categoryname='Chemicals')]
+        self.session.add_all(markets)
+        commodities.record(self.session, carrier, markets)
+        self.session.commit()
+        self.assertIsNotNone(carrier.marketUpdated)
+        found = commodities.nearest_offers(self.session, 'tritium', (0, 0, 0), quantity=100, k=2)
+        self.assertEqual([row.callsign for dist, row, offer in found], ['COM-001', 'COM-004'])
+
+    def test_nearest_offers_sql(self):
+        from unittest import mock
+        from .models import Carrier, Market
+        from .utils import commodities, spatial
+        for i, (x, search) in enumerate([(100, True), (10, False), (50, None), (None, True)]):
+            self.session.add(Carrier(id=i + 1, callsign=f'COM-00{i + 1}', x=x, y=0 if x else None,
+                                     z=0 if x else None, showSearch=search))
+            self.session.add(Market(carrier_id=i + 1, name='Tritium', locName='Tritium', stock=500,
+                                    buyPrice=50000, sellPrice=0, demand=0, categoryname='Chemicals'))
+        self.session.commit()
+        with mock.patch.object(spatial, 'memory_index', False):
+            found = commodities.nearest_offers(self.session, 'tritium', (0, 0, 0))
+        self.assertEqual([(round(dist), row.callsign) for dist, row, offer in found],
+                         [(50, 'COM-003'), (100, 'COM-001')])
+        self.assertIsNone(spatial._index)
+
+
+class TestNameSearch(SQLiteTest):
+    def test_index(self):
+        from .utils.namesearch import NgramIndex
+        index = NgramIndex()
+        for key, name in enumerate(['the hauler', 'hauler', 'big hauler co', 'haulers of sol', 'ha', 'mothership']):
+            index.update(key, name)
+        self.assertEqual(index.search('hauler'), [1, 3, 0, 2])
+        self.assertEqual(index.search('hauler', 2), [1, 3])
+        self.assertEqual(index.search('ha'), [4, 1, 3, 0, 2])
+        index.update(1, 'tritium depot')
+        index.update(3, None)
+        self.assertEqual(index.search('hauler'), [0, 2])
+        self.assertEqual(index.search('depot'), [1])
+        self.assertEqual(len(index), 5)
+
+    def test_search(self):
+        from .models import Carrier
+        from .models.carrier import search_name
+        from .utils import namesearch, util
+        self.assertEqual(search_name(util.to_hex('The  Void Runner').decode('utf8')), 'the void runner')
+        self.assertEqual(search_name('Unknown Name'), 'unknown name')
+        for i, name in enumerate(['VOID RUNNER', 'The Void', 'Avoidance', 'Elsewhere']):
+            self.session.add(Carrier(callsign=f'NAM-00{i}', name=util.to_hex(name).decode('utf8')))
+        self.session.add(Carrier(callsign='NAM-009', name='Unknown Name'))
+        self.session.commit()
+        self.assertEqual([c.callsign for c in namesearch.search(self.session, 'void')],
+                         ['NAM-000', 'NAM-001', 'NAM-002'])
+        self.assertEqual([c.callsign for c in namesearch.search(self.session, ' Void   R')], ['NAM-000'])
+        self.assertEqual([c.callsign for c in namesearch.search(self.session, 'unknown')], ['NAM-009'])
+        renamed = self.session.query(Carrier).filter(Carrier.callsign == 'NAM-003').one()
+        renamed.name = util.to_hex('Void Walker').decode('utf8')
+        self.session.commit()
+        self.assertEqual([c.callsign for c in namesearch.search(self.session, 'void', 2)], ['NAM-000', 'NAM-003'])
+        self.assertEqual([c.callsign for c in namesearch.search(self.session, 'walker')], ['NAM-003'])
+
+
+class TestCmdrSearch(SQLiteTest):
+    def setUp(self):
+        from sqlalchemy import event
+        from .models import Carrier, User
+        from .utils import util
+        super(TestCmdrSearch, self).setUp()
+        self.config.add_route('carrier', '/carrier/{cid}')
+        for i, (cmdr, callsign) in enumerate([('Wolf', 'WLF-001'), ('WOLF', 'WLF-002'), ('wolf', None),
+                                              ('Lone Rat', 'RAT-001'), ('Walker', None)]):
+            self.session.add(User(id=i + 1, username=f'user{i}', cmdr_name=cmdr))
+            if callsign:
+                self.session.add(Carrier(owner=i + 1, callsign=callsign,
+                                         name=util.to_hex(f'{cmdr} carrier').decode('utf8'),
+                                         currentStarSystem='Sol'))
+        self.session.commit()
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args: self.statements.append(statement))
+
+    def search(self, term):
+        from .views.search import search_view
+        request = testing.DummyRequest(params={'term': term})
+        request.dbsession = self.session
+        request.user = None
+        request.current_route_path = lambda: '/search'
+        return search_view(request)
+
+    def test_many_cmdrs(self):
+        result = self.search('wolf')
+        self.assertEqual(len(self.statements), 1)
+        self.assertEqual([(item['col1'], item['col2'], item['col3']) for item in result['items']],
+                         [('WOLF', 'WLF-002', 'WOLF carrier'), ('Wolf', 'WLF-001', 'Wolf carrier')])
+
+    def test_single_cmdr(self):
+        from pyramid.httpexceptions import HTTPFound
+        with self.assertRaises(HTTPFound) as found:
+            self.search('lone rat')
+        self.assertTrue(found.exception.location.endswith('/carrier/RAT-001'))
+        self.assertEqual(self.search('WALKER'), {'error': 'Player does not have a carrier.'})
+
+
+class TestSearchApi(SQLiteTest):
+    def setUp(self):
+        import random
+        from .models import Carrier
+        from .utils import util
+        super(TestSearchApi, self).setUp()
+        rng = random.Random(3)
+        for i in range(120):
+            self.session.add(Carrier(callsign=f'API-{i:03}', name=util.to_hex(f'Carrier {i % 40}').decode('utf8'),
+                                     x=rng.choice([0, 10, 20]) * 100, y=0, z=rng.uniform(-5000, 5000),
+                                     showSearch=i % 10 != 0, hasRepair=True))
+        self.session.commit()
+
+    def fetch(self, **params):
+        import json
+        from .views.search_api import search_api_view
+        request = testing.DummyRequest(params=params)
+        request.dbsession = self.session
+        return json.loads(b''.join(search_api_view(request).app_iter))
+
+    def pages(self, **params):
+        results = []
+        page = self.fetch(**params)
+        results.extend(page['results'])
+        while page['next']:
+            page = self.fetch(cursor=page['next'], limit=params['limit'])
+            results.extend(page['results'])
+        return results
+
+    def test_distance_pages(self):
+        from .utils import spatial
+        everything = self.fetch(x='500', y='0', z='-100', limit='500')['results']
+        self.assertEqual(len(everything), 108)
+        self.assertIsNone(self.fetch(x='500', y='0', z='-100', limit='500')['next'])
+        for limit in ('7', '25'):
+            self.assertEqual(self.pages(x='500', y='0', z='-100', limit=limit), everything)
+        spatial.memory_index = False
+        try:
+            self.assertEqual(self.pages(x='500', y='0', z='-100', limit='30'), everything)
+        finally:
+            spatial.memory_index = True
+        self.assertEqual(everything[0]['services'], ['hasRepair'])
+
+    def test_name_pages(self):
+        everything = self.pages(order='name', limit='500')
+        self.assertEqual(len(everything), 108)
+        names = [r['name'].lower() for r in everything]
+        self.assertEqual(names, sorted(names))
+        self.assertEqual(self.pages(order='name', limit='11'), everything)
+        filtered = self.pages(name='CARRIER 3', limit='4')
+        # Carrier 30 is only on carriers hidden from search.
+        self.assertEqual({r['name'] for r in filtered}, {'Carrier 3'} | {f'Carrier {i}' for i in range(31, 40)})
+        self.assertEqual(len(filtered), 30)
+
+    def test_bad_requests(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        for params in ({'cursor': 'nonsense'}, {'order': 'distance'}, {'order': 'size'}, {'limit': 'ten'},
+                       {'x': '1', 'y': '2', 'z': 'three'}):
+            with self.assertRaises(HTTPBadRequest):
+                self.fetch(**params)
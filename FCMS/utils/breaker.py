@@ -0,0 +1,164 @@
+# Circuit breakers for outbound hosts (Frontier's CAPI and auth servers, the systems API, webhooks).
+# A breaker trips when too many recent calls failed or were slow, rejects calls while open, and lets a
+# few probe calls through once it has been open for a while to find out if the host is back.
+import threading
+import time
+from collections import deque
+
+from pyramid import threadlocal
+
+from . import metrics
+import logging
+
+log = logging.getLogger(__name__)
+
+settings = threadlocal.get_current_registry().settings or {}
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+state_gauge = metrics.gauge('fcms_breaker_state', 'Circuit breaker state (0 closed, 1 open, 2 half open)')
+transitions = metrics.counter('fcms_breaker_transitions_total', 'Circuit breaker state changes')
+rejected = metrics.counter('fcms_breaker_rejected_total', 'Calls rejected by an open circuit breaker')
+calls = metrics.counter('fcms_breaker_calls_total', 'Calls recorded by circuit breakers')
+
+
+class CircuitBreaker(object):
+    def __init__(self, name, window=60, min_calls=10, error_rate=0.5, slow_call=5.0, slow_rate=0.8,
+                 open_for=30, probes=1, clock=time.monotonic):
+        """
+        :param name: Name of the guarded host, used in logs and metrics
+        :param window: Seconds of call history to consider
+        :param min_calls: Calls needed in the window before the breaker may trip
+        :param error_rate: Fraction of failed calls that trips the breaker
+        :param slow_call: Calls taking longer than this many seconds count as slow
+        :param slow_rate: Fraction of slow calls that trips the breaker
+        :param open_for: Seconds to stay open before letting probe calls through
+        :param probes: Concurrent probe calls allowed while half open
+        :param clock: Time source, for tests
+        """
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.open_for = open_for
+        self.probes = probes
+        self.clock = clock
+        self.state = CLOSED
+        self.opened_at = None
+        self.probing = 0
+        self.history = deque()
+        self.lock = threading.Lock()
+        state_gauge.set(0, host=name)
+
+    def _transition(self, state):
+        log.warning(f"Circuit breaker for {self.name}: {self.state} -> {state}")
+        self.state = state
+        state_gauge.set(STATE_VALUES[state], host=self.name)
+        transitions.inc(host=self.name, state=state)
+        if state == OPEN:
+            self.opened_at = self.clock()
+        if state != HALF_OPEN:
+            self.probing = 0
+        if state == CLOSED:
+            self.history.clear()
+
+    def _trim(self, now):
+        while self.history and self.history[0][0] < now - self.window:
+            self.history.popleft()
+
+    def is_open(self):
+        """
+        Checks whether calls are currently being rejected, without claiming a probe slot.
+        :return: True if open (and not yet due for probing)
+        """
+        with self.lock:
+            return self.state == OPEN and self.clock() - self.opened_at < self.open_for
+
+    def allow(self):
+        """
+        Asks to make a call. Every allowed call must be followed by success(), failure() or release().
+        :return: True if the call may go ahead
+        """
+        with self.lock:
+            if self.state == OPEN:
+                if self.clock() - self.opened_at < self.open_for:
+                    rejected.inc(host=self.name)
+                    return False
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self.probing >= self.probes:
+                    rejected.inc(host=self.name)
+                    return False
+                self.probing = self.probing + 1
+            return True
+
+    def release(self):
+        """
+        Hands back an allowed call that was never made, so it doesn't hold on to a probe slot.
+        """
+        with self.lock:
+            if self.state == HALF_OPEN and self.probing > 0:
+                self.probing = self.probing - 1
+
+    def success(self, elapsed=0.0):
+        """
+        Records a call that reached the host and got a sane answer.
+        :param elapsed: Seconds the call took
+        """
+        self._record(True, elapsed)
+
+    def failure(self, elapsed=0.0):
+        """
+        Records a call that failed (timeout, connection error, 5xx).
+        :param elapsed: Seconds the call took
+        """
+        self._record(False, elapsed)
+
+    def _record(self, ok, elapsed):
+        slow = elapsed >= self.slow_call
+        calls.inc(host=self.name, outcome='slow' if ok and slow else 'ok' if ok else 'error')
+        with self.lock:
+            if self.state == HALF_OPEN:
+                # A probe decides alone: healthy closes the breaker, anything else reopens it.
+                self._transition(CLOSED if ok and not slow else OPEN)
+                return
+            if self.state == OPEN:
+                return
+            now = self.clock()
+            self.history.append((now, ok, slow))
+            self._trim(now)
+            total = len(self.history)
+            if total < self.min_calls:
+                return
+            errors = sum(1 for entry in self.history if not entry[1])
+            slows = sum(1 for entry in self.history if entry[2])
+            if errors / total >= self.error_rate or slows / total >= self.slow_rate:
+                self._transition(OPEN)
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """
+    Gets the process-wide breaker for a host, configured from the breaker_* settings.
+    :param name: Host name
+    :return: A CircuitBreaker
+    """
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name,
+                                             window=int(settings.get('breaker_window', 60)),
+                                             min_calls=int(settings.get('breaker_min_calls', 10)),
+                                             error_rate=float(settings.get('breaker_error_rate', 0.5)),
+                                             slow_call=float(settings.get('breaker_slow_call', 5)),
+                                             slow_rate=float(settings.get('breaker_slow_rate', 0.8)),
+                                             open_for=int(settings.get('breaker_open_for', 30)),
+                                             probes=int(settings.get('breaker_probes', 1)))
+        return _breakers[name]
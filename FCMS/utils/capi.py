@@ -1,13 +1,21 @@
 import ast
 import json
+import threading
+import time
+from datetime import datetime
 from json import JSONDecodeError
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlparse
 import requests
 from authlib.integrations.base_client import UnsupportedTokenTypeError
 from authlib.integrations.requests_client import OAuth2Session
 from pyramid import threadlocal
+from sqlalchemy.orm import object_session
 import logging
 
+from ..models import User, Carrier
+from . import breaker, http, metrics, snapshots, tracing
+from .jsonscan import LazyJSON
+
 log = logging.getLogger(__name__)
 
 settings = threadlocal.get_current_registry().settings
@@ -18,19 +26,52 @@ client_id = settings['client_id']
 client_secret = settings['client_secret']
 token_endpoint = authURL+'/token'
 auth_endpoint = authURL+'/auth'
+token_refresh_window = int(settings.get('token_refresh_window', 1800))
+token_refresh_batch = int(settings.get('token_refresh_batch', 50))
+capi_timeout = int(settings.get('capi_timeout', 10))
+cache_ttl = {'/profile': int(settings.get('capi_profile_ttl', 300)),
+             '/fleetcarrier': int(settings.get('capi_fleetcarrier_ttl', 900))}
+capi_breaker = breaker.get_breaker(urlparse(capiURL).netloc)
+capi_requests = metrics.counter('fcms_capi_requests_total', 'CAPI requests by endpoint and HTTP status')
+capi_seconds = metrics.histogram('fcms_capi_request_seconds', 'CAPI request latency by endpoint')
+
+
+def available():
+    """
+    Checks whether CAPI calls are currently going through, i.e. its circuit breaker isn't open.
+    :return: True if CAPI is believed to be up
+    """
+    return not capi_breaker.is_open()
 
 
-def update_token(token, ref_token=None, user=None):
+def update_token(token, ref_token=None, user=None, timeout=None):
+    """
+    Refreshes an access token through the auth server. Fails fast while its circuit breaker is open.
+    :param token: The current token
+    :param ref_token: The refresh token
+    :param user: The user object (For logging)
+    :param timeout: Request timeout in seconds (default: capi_timeout)
+    :return: The new token, or None
+    """
+    try:
+        return _refresh_token(token, ref_token, user, timeout or capi_timeout)
+    except requests.RequestException as err:
+        log.error(f"Auth server request failed: {err}")
+        return None
+
+
+def _refresh_token(token, ref_token, user, timeout):
     log.info(f"update_token called! User: {user}")
     log.debug(f"Token: {token}")
+    client = get_client()
     client.token = token
     try:
-        new_token = client.refresh_token(token_endpoint, ref_token)
+        new_token = client.refresh_token(token_endpoint, ref_token, timeout=timeout)
         if 'message' in new_token:
             log.warning(f"Authlib refresh token Failed! {new_token}: Retrying with request.")
             data = {'grant_type': 'refresh_token', 'refresh_token': ref_token,
                     'client_id': client_id, }
-            r = requests.post(urljoin(authURL, token_endpoint), data=data)
+            r = http.post(urljoin(authURL, token_endpoint), data=data, timeout=timeout)
             if r.status_code == requests.codes.ok:
                 new_token = r.json()
                 log.debug(f"Manual refresh: {new_token}")
@@ -45,30 +86,102 @@ def update_token(token, ref_token=None, user=None):
         # Failed, let's do it manually.
         data = {'grant_type': 'refresh_token', 'refresh_token': ref_token,
                 'client_id': client_id}
-        r = requests.post(urljoin(authURL, token_endpoint), data=data)
+        r = http.post(urljoin(authURL, token_endpoint), data=data, timeout=timeout)
         if r.status_code == requests.codes.ok:
             new_token = r.json()
             log.info(f"Unsupported token type from authlib. Manual refresh: {new_token}")
             return new_token
 
 
-client = OAuth2Session(client_id=client_id, client_secret=client_secret, scope='auth capi',
-                       token_endpoint_auth_method='client_secret_post',
-                       redirect_uri=redirectURL)
+_local = threading.local()
+
+
+def get_client():
+    """
+    Gets this thread's OAuth2 session. The session carries the token of the user being served, so each
+    thread (web server worker, load test worker) needs its own.
+    :return: An OAuth2Session
+    """
+    client = getattr(_local, 'client', None)
+    if client is None:
+        client = OAuth2Session(client_id=client_id, client_secret=client_secret, scope='auth capi',
+                               token_endpoint_auth_method='client_secret_post',
+                               redirect_uri=redirectURL)
+        # A CAPI read timeout means a slow server; trying again would only make the user wait longer.
+        http.mount(client, read_retries=0)
+        _local.client = client
+    return client
 
 
-def capi(endpoint, user):
+def store_token(user, token):
+    """
+    Stores a (refreshed) OAuth2 token on the user row.
+    :param user: The user object
+    :param token: Token dict or authlib token object
+    """
+    token = dict(token)
+    if not token.get('expires_at'):
+        # The manual refresh fallbacks return the auth server's JSON as is, which only has expires_in.
+        token['expires_at'] = int(time.time()) + int(token.get('expires_in') or 0)
+    user.access_token = str(token)
+    user.refresh_token = token['refresh_token']
+    user.token_expiration = token['expires_at']
+
+
+def refresh_user_token(user):
+    """
+    Refreshes a user's access token ahead of expiry, outside of the request path.
+    :param user: The user object
+    :return: True if a new token was stored, else False
+    """
+    try:
+        token = ast.literal_eval(user.access_token)
+    except (SyntaxError, ValueError):
+        log.error(f"Unparseable access token for {user.username}, can't refresh.")
+        return False
+    newtoken = update_token(token, ref_token=token.get('refresh_token') or user.refresh_token, user=user)
+    if not newtoken or 'refresh_token' not in newtoken:
+        log.warning(f"Proactive token refresh failed for {user.username}.")
+        return False
+    store_token(user, newtoken)
+    return True
+
+
+def get_expiring_users(session, window=None, after=None, limit=None):
+    """
+    Finds users whose access token expires within the refresh window, ordered by expiry.
+    :param session: A database session
+    :param window: Seconds ahead of now to look for expiring tokens
+    :param after: (token_expiration, id) keyset of the last row of the previous batch
+    :param limit: Maximum number of users to return
+    :return: A list of User objects
+    """
+    horizon = int(time.time()) + (window if window is not None else token_refresh_window)
+    query = session.query(User).filter(User.token_expiration != None, User.token_expiration < horizon,
+                                       User.access_token != None, User.refresh_token != None)
+    if after:
+        query = query.filter((User.token_expiration > after[0]) |
+                             ((User.token_expiration == after[0]) & (User.id > after[1])))
+    return query.order_by(User.token_expiration, User.id).limit(limit or token_refresh_batch).all()
+
+
+def capi(endpoint, user, timeout=None):
     """
     Fetches data from CAPI.
     :param endpoint: What endpoint to query
     :param user: The user object
+    :param timeout: Request timeout in seconds (default: capi_timeout)
     :return: A string containing the response from CAPI
     """
     # Do a bloody song and dance, because can't be sure if the token passed with the user is a stored db string,
     # a dict fresh from the initial OAuth request, or an authlib token object...
     if not user:
         return None
+    if not available():
+        log.warning(f"CAPI circuit open, not fetching {endpoint} for {user.cmdr_name}.")
+        return None
     log.debug(f"User is of type {type(user)}")
+    client = get_client()
     try:
         if isinstance(user.access_token, str):
             log.debug(f"User has an access token of type str. {user.access_token}")
@@ -89,27 +202,33 @@ def capi(endpoint, user):
         log.debug(f"AT expiration: {client.token.is_expired()} and {client.token['expires_at']}")
         if client.token.is_expired():
             log.debug(f"Expired access token for {user.cmdr_name}!")
-            newtoken = update_token(client.token, ref_token=refresh_token, user=user)
+            with tracing.span('token_refresh'):
+                newtoken = update_token(client.token, ref_token=refresh_token, user=user, timeout=timeout)
+            if not newtoken:
+                log.error(f"Failed to refresh expired token for {user.cmdr_name}. Bailing.")
+                return None
             client.token = newtoken
-            user.access_token = str(dict(client.token))
-            user.refresh_token = client.token['refresh_token']
-            user.token_expiration = client.token['expires_at']
+            store_token(user, client.token)
             log.debug(f"Updated token: {newtoken}")
 
+        start = time.monotonic()
         try:
-            res = client.get(urljoin(capiURL, endpoint))
+            with tracing.span('http'):
+                res = client.get(urljoin(capiURL, endpoint), timeout=timeout or capi_timeout)
+            tracing.annotate(capi_status=res.status_code, capi_bytes=len(res.content))
+            capi_requests.inc(endpoint=endpoint, status=res.status_code)
+            capi_seconds.observe(time.monotonic() - start, endpoint=endpoint)
             res.raise_for_status()
             return res.content
         except requests.HTTPError as err:
             if res.status_code == 401:
                 log.warning(f"CAPI request for {user.cmdr_name} unauthorized. Attempting to refresh token.")
-                newtoken = update_token(client.token, ref_token=refresh_token, user=user)
+                with tracing.span('token_refresh'):
+                    newtoken = update_token(client.token, ref_token=refresh_token, user=user, timeout=timeout)
                 if newtoken:
                     log.debug(f"New token for {user.cmdr_name}: {newtoken}")
                     client.token = newtoken
-                    user.access_token = str(dict(client.token))
-                    user.refresh_token = client.token['refresh_token']
-                    user.token_expiration = client.token['expires_at']
+                    store_token(user, client.token)
                 else:
                     log.error(f"Failed to get new token for {user.cmdr_name} ({user.username}). Bailing.")
                     return None
@@ -117,42 +236,144 @@ def capi(endpoint, user):
             if res.status_code == 204:
                 log.warning(f"No content for {user.cmdr_name} ({user.username}). No fleet carrier?")
             return None
+        except requests.RequestException as err:
+            capi_requests.inc(endpoint=endpoint, status='error')
+            log.error(f"CAPI request for {user.cmdr_name} failed: {err}")
+            return None
     else:
         log.warning(f"No CAPI token for user {user.cmdr_name}. Bailing.")
         return None
 
 
-def get_carrier(user):
+def get_cached_raw(user, endpoint, max_age=None):
     """
-    Fetches carrier information for a player from CAPI. Needs the user's access token.
-    :param user: The user owning the carrier we're fetching.
-    :return: A dict with carrier information.
+    Returns a cached CAPI payload if it is younger than the endpoint's TTL. The cache is the snapshot
+    store, so it is shared by all worker processes. /profile is cached per user, /fleetcarrier per
+    carrier the user owns.
+    :param user: The user object
+    :param endpoint: CAPI endpoint
+    :param max_age: Override for the endpoint's TTL, in seconds
+    :return: The cached JSON string, or None on a miss
     """
+    ttl = max_age if max_age is not None else cache_ttl.get(endpoint, 0)
+    session = object_session(user) if user else None
+    if not session or ttl <= 0:
+        return None
+    if endpoint == '/profile':
+        payload = snapshots.latest_payload(session, endpoint, user_id=user.id, max_age=ttl)
+    elif endpoint == '/fleetcarrier':
+        mycarrier = session.query(Carrier.id).filter(Carrier.owner == user.id).first()
+        if not mycarrier:
+            return None
+        payload = snapshots.latest_payload(session, endpoint, carrier_id=mycarrier.id, max_age=ttl)
+    else:
+        return None
+    if not payload:
+        return None
+    log.debug(f"CAPI cache hit for {endpoint} ({user.cmdr_name})")
+    return payload.raw
+
+
+def get_cached(user, endpoint, max_age=None):
+    """
+    Returns a decoded cached CAPI payload, see get_cached_raw.
+    :param user: The user object
+    :param endpoint: CAPI endpoint
+    :param max_age: Override for the endpoint's TTL, in seconds
+    :return: A dict with the cached payload, or None on a miss
+    """
+    raw = get_cached_raw(user, endpoint, max_age)
+    if not raw:
+        return None
     try:
-        return json.loads(capi('/fleetcarrier', user))
-    except TypeError:
-        log.error(f"CAPI: User {user.username} - failed to fetch /fleetcarrier endpoint.")
+        return json.loads(raw)
+    except ValueError:
+        return None
+
+
+def get_carrier_payload(user, max_age=None, timeout=None):
+    """
+    Fetches carrier information for a player from CAPI, without decoding it up front. Full market and
+    outfitting lists are large, so callers pull out the sections they need from the returned LazyJSON.
+    :param user: The user owning the carrier we're fetching.
+    :param max_age: Accept a cached payload up to this many seconds old (default: capi_fleetcarrier_ttl)
+    :param timeout: CAPI request timeout in seconds
+    :return: A LazyJSON wrapping the payload, or None.
+    """
+    with tracing.span('cache'):
+        raw = get_cached_raw(user, '/fleetcarrier', max_age)
+    tracing.annotate(cached=bool(raw))
+    if not raw:
+        return fetch_carrier_payload(user, timeout)
+    return _decode_carrier(user, raw)
+
+
+def fetch_carrier_payload(user, timeout=None):
+    """
+    Fetches carrier information for a player from CAPI, never from the cache. Refreshes use this, so
+    every payload they store is one Frontier actually sent.
+    :param user: The user owning the carrier we're fetching.
+    :param timeout: CAPI request timeout in seconds
+    :return: A LazyJSON wrapping the payload, or None.
+    """
+    with tracing.span('capi'):
+        raw = capi('/fleetcarrier', user, timeout=timeout)
+    if raw is None:
+        log.error(f"CAPI: User {user.username if user else None} - failed to fetch /fleetcarrier endpoint.")
         return None
+    return _decode_carrier(user, raw)
+
+
+def _decode_carrier(user, raw):
+    try:
+        with tracing.span('decode'):
+            return LazyJSON(raw)
     except JSONDecodeError:
         log.error(f"Invalid CAPI data for {user.username} - Possibly 204?")
+        return None
 
 
-def get_cmdr(user):
+def get_carrier(user, max_age=None, timeout=None):
+    """
+    Fetches carrier information for a player from CAPI. Needs the user's access token.
+    :param user: The user owning the carrier we're fetching.
+    :param max_age: Accept a cached payload up to this many seconds old (default: capi_fleetcarrier_ttl)
+    :param timeout: CAPI request timeout in seconds
+    :return: A dict with carrier information.
+    """
+    payload = get_carrier_payload(user, max_age, timeout)
+    return json.loads(payload.raw) if payload else None
+
+
+def get_cmdr(user, max_age=None):
     """
     Fetches commander  information from FDev. Needs the user's access token.
     :param user: The user object for whom we're fetching data
+    :param max_age: Accept a cached profile up to this many seconds old (default: capi_profile_ttl)
     :return: A dict with player information.
     """
+    cached = get_cached(user, '/profile', max_age)
+    if cached:
+        return cached
     try:
         log.debug(f"Loading CMDR profile for {user.cmdr_name}")
-        return json.loads(capi('/profile', user))
+        res = capi('/profile', user)
+        profile = json.loads(res)
+        session = object_session(user)
+        if session:
+            snapshots.store(session, '/profile', res, user_id=user.id)
+        user.lastUpdated = datetime.now()
+        return profile
     except TypeError:
         log.error(f"CAPI: User {user} - failed to fetch /profile endpoint.")
         return None
+    except JSONDecodeError:
+        log.error(f"Invalid CAPI profile data for {user}.")
+        return None
 
 
 def get_auth_url():
-    uri, state = client.create_authorization_url(auth_endpoint)
+    uri, state = get_client().create_authorization_url(auth_endpoint)
     return uri, state
 
 
@@ -163,6 +384,7 @@ def get_token(authorization_response, state):
     :param authorization_response: The auth response string
     :return: The authorization token.
     """
+    client = get_client()
     client.state = state
     token = client.fetch_token(token_endpoint, authorization_response=authorization_response,
                                method='POST')
@@ -1,11 +1,11 @@
 # Various carrier data update convenience functions.
 # AKA "Get all the ugly shit out of the views."
-import json
 from datetime import datetime
 
 from sqlalchemy.orm.exc import MultipleResultsFound
 
-from . import capi
+from . import capi, commodities, freshness, jobs, snapshots, tracing
+from .jsonscan import LazyJSON
 from ..models import Carrier, User, Itinerary, Market, Module, Ship, Cargo, Calendar, CarrierExtra, Route
 import pyramid.httpexceptions as exc
 from ..utils import util, sapi, user as usr, menu, translation
@@ -74,6 +74,20 @@ def populate_calendar(request, cid):
         return data
 
 
+def cached_payload(request, carrier):
+    """
+    Gets the last /fleetcarrier payload we have for a carrier.
+    :param request: The request object
+    :param carrier: Carrier object
+    :return: A LazyJSON, or None if we never fetched the carrier
+    """
+    payload = snapshots.latest_payload(request.dbsession, '/fleetcarrier', carrier_id=carrier.id)
+    if not payload and carrier.cachedJson:
+        # Carriers not refreshed since the snapshot store was added.
+        payload = LazyJSON(carrier.cachedJson)
+    return payload
+
+
 def get_finances(request, cid):
     """
     Gets the financial information for a carrier.
@@ -83,11 +97,11 @@ def get_finances(request, cid):
     """
     carrier = request.dbsession.query(Carrier).filter(Carrier.id == cid).one_or_none()
     if carrier:
-        cdata = None
-        if not carrier.cachedJson:
+        cdata = cached_payload(request, carrier)
+        if not cdata:
             cdata = update_carrier(request, cid, request.user)
-        else:
-            cdata = json.loads(carrier.cachedJson)
+        if not cdata:
+            return None
         data = {}
         for key, val in cdata['finance'].items():
             data[key] = format_number(val)
@@ -106,11 +120,11 @@ def get_crew(request, cid):
     """
     carrier = request.dbsession.query(Carrier).filter(Carrier.id == cid).one_or_none()
     if carrier:
-        cdata = None
-        if not carrier.cachedJson:
+        cdata = cached_payload(request, carrier)
+        if not cdata:
             cdata = update_carrier(request, cid, request.user)
-        else:
-            cdata = json.loads(carrier.cachedJson)
+        if not cdata:
+            return None
         return cdata['servicesCrew']
     else:
         log.error("Attempt to get crew for non-existant carrier!")
@@ -346,33 +360,111 @@ def populate_view(request, cid, user):
 
 def deferred_update_carrier(request, cid, user):
     """
-    Runs a deferred carrier data update. This is allowed to slog on for far longer than the eager update,
-    and runs as a callback to the finished render of the page. The user has to manually update.
+    Schedules a deferred carrier data update. The page renders straight from the DB; the refresh runs as a
+    job once the response is out (or in job_runner), and is allowed to slog on for far longer than the
+    eager update. Pages poll the carrier status API to pick up the fresh data.
     :param request: The request object
     :param cid: carrier ID
     :param user: User object
-    :return: Nothing, data update is done directly on DB.
+    :return: The queued (or already active) Job.
     """
-    mycarrier = request.dbsession.query(Carrier).filter(Carrier.id == cid).one_or_none()
-    owner = request.dbsession.query(User).filter(User.id == mycarrier.owner).one_or_none()
-    if owner:
-        jcarrier = capi.get_carrier_deferred(owner)
+    return jobs.enqueue(request, 'update_carrier', cid, user.id if user else None)
+
+
+@jobs.handler('update_carrier')
+def run_update_job(request, job):
+    """
+    Job handler for deferred carrier updates.
+    :param request: The job's request object (For DB access)
+    :param job: The Job being run
+    :return: True if the carrier was updated.
+    """
+    jcarrier = update_carrier(request, job.carrier_id, None, timeout=jobs.capi_timeout)
+    if not jcarrier:
+        job.message = 'CAPI did not return carrier data.'
+    return bool(jcarrier)
+
+
+def deferred_import_carrier(request, cid, user):
+    """
+    Schedules the full import (position, itinerary, cargo, market, shipyard and outfitting) of a newly
+    added carrier, so adding it only has to create the carrier row.
+    :param request: The request object
+    :param cid: carrier ID
+    :param user: User object
+    :return: The queued (or already active) Job.
+    """
+    return jobs.enqueue(request, 'import_carrier', cid, user.id if user else None)
+
+
+@jobs.handler('import_carrier')
+def run_import_job(request, job):
+    """
+    Job handler for importing a new carrier. Reports its progress as it goes through the payload.
+    :param request: The job's request object (For DB access)
+    :param job: The Job being run
+    :return: True if the carrier was imported.
+    """
+    jcarrier = update_carrier(request, job.carrier_id, None, timeout=jobs.capi_timeout,
+                              progress=jobs.reporter(request, job))
+    if not jcarrier:
+        job.message = 'CAPI did not return carrier data.'
+    return bool(jcarrier)
 
 
-def update_carrier(request, cid, user):
+def replace_rows(dbsession, model, cid, rows, batch=500):
+    """
+    Replaces a carrier's rows in one of the per-carrier tables, flushing as it goes so only one batch of
+    new rows is held in memory at a time.
+    :param dbsession: Database session
+    :param model: The model class (Itinerary, Cargo, Market, ...)
+    :param cid: Carrier ID
+    :param rows: An iterable of model instances
+    :param batch: Rows per flush
+    :return: Number of rows added
+    """
+    with tracing.span(f'rows.{model.__tablename__}'):
+        dbsession.query(model).filter(model.carrier_id == cid).delete()
+        count = 0
+        for row in rows:
+            dbsession.add(row)
+            count = count + 1
+            if count % batch == 0:
+                dbsession.flush()
+        dbsession.flush()
+    tracing.annotate(**{f'rows_{model.__tablename__}': count})
+    return count
+
+
+@tracing.traced('update_carrier')
+def update_carrier(request, cid, user, timeout=None, progress=None):
     """
     Updates carrier data. If carrier update fails and the user owns the carrier in question, a new
     OAuth2 flow is initiated.
     :param request: The request object (For DB access)
     :param cid: Carrier ID to be updated
     :param user: The user executing the request
-    :return: Updated carrier JSON (from CAPI) or None if failed and not same user.
+    :param timeout: CAPI timeout in seconds (default: capi_timeout)
+    :param progress: Called as progress(percent, message) as the update goes along
+    :return: Updated carrier JSON (from CAPI, as a LazyJSON) or None if failed and not same user.
     """
     mycarrier = request.dbsession.query(Carrier).filter(Carrier.id == cid).one_or_none()
     owner = request.dbsession.query(User).filter(User.id == mycarrier.owner).one_or_none()
+    tracing.annotate(carrier=mycarrier.callsign)
+    if not progress:
+        def progress(percent, message=None):
+            pass
     if owner:
-        jcarrier = capi.get_carrier(owner)
+        progress(5, 'Fetching carrier data from Frontier')
+        with tracing.span('fetch'):
+            # Not through the cache: it is fed by refreshes, so a refresh served from it would only store
+            # the same payload again as a new fetch.
+            jcarrier = capi.fetch_carrier_payload(owner, timeout=timeout)
         if not jcarrier:
+            tracing.annotate(outcome='no_data')
+            if not capi.available():
+                log.warning("CAPI is unavailable (circuit open), keeping old carrier data.")
+                return None
             log.warning("CAPI update call failed, retry OAuth if owner.")
             if not request.user:
                 log.warning("Not logged in, can't refresh OAuth token.")
@@ -385,10 +477,11 @@ def update_carrier(request, cid, user):
                 log.warning(f"Not same owner! {mycarrier.owner} vs {request.user.id}.")
                 return None
         try:
-            if mycarrier.callsign != jcarrier['name']['callsign']:
+            name = jcarrier['name']
+            if mycarrier.callsign != name['callsign']:
                 # Actually, it may very well happen, because FDev decided to CHANGE ALL THE NAMES!
                 log.error(f"Carrier callsign has changed! This should not happen! {mycarrier.callsign} "
-                          f"stored, update has {jcarrier['name']['callsign']}. Refresh initiated by user {request.user.username if request.user else 'Not logged in'}.")
+                          f"stored, update has {name['callsign']}. Refresh initiated by user {request.user.username if request.user else 'Not logged in'}.")
                 # Doublecheck that the owner is equal to the carrier.
                 if mycarrier.owner:
                     ow = request.dbsession.query(User).filter(User.id == mycarrier.owner).one_or_none()
@@ -402,15 +495,17 @@ def update_carrier(request, cid, user):
                 else:
                     log.error("Couldn't find owner row, this means bad things. Abort.")
         except KeyError:
-            log.error(
-                f"No callsign set on already existing carrier? Requested CID: {cid} new carrier: {jcarrier['name']['callsign']} ")
+            log.error(f"No callsign in CAPI data for already existing carrier? Requested CID: {cid}")
             return None
-        log.info(f"New carrier: {jcarrier}")
-        coords = sapi.get_coords(jcarrier['currentStarSystem'])
-        services = jcarrier['market']['services']
+        log.info(f"New carrier data for {name['callsign']}: {len(jcarrier.raw)} bytes")
+        progress(20, 'Locating carrier')
+        with tracing.span('coords'):
+            coords = sapi.get_coords(jcarrier['currentStarSystem'], request.dbsession)
+        finance = jcarrier['finance']
+        services = jcarrier.value('market', 'services')
         mycarrier.owner = owner.id
-        mycarrier.callsign = jcarrier['name']['callsign']
-        mycarrier.name = jcarrier['name']['vanityName']
+        mycarrier.callsign = name['callsign']
+        mycarrier.name = name['vanityName']
         mycarrier.currentStarSystem = jcarrier['currentStarSystem']
         mycarrier.balance = jcarrier['balance']
         mycarrier.fuel = jcarrier['fuel']
@@ -418,13 +513,13 @@ def update_carrier(request, cid, user):
         mycarrier.theme = jcarrier['theme']
         mycarrier.dockingAccess = jcarrier['dockingAccess']
         mycarrier.notoriousAccess = jcarrier['notoriousAccess']
-        mycarrier.totalDistanceJumped = jcarrier['itinerary']['totalDistanceJumpedLY']
-        mycarrier.currentJump = jcarrier['itinerary']['currentJump']
-        mycarrier.taxation = jcarrier['finance']['taxation']
-        mycarrier.coreCost = jcarrier['finance']['coreCost']
-        mycarrier.servicesCost = jcarrier['finance']['servicesCost']
-        mycarrier.jumpsCost = jcarrier['finance']['jumpsCost']
-        mycarrier.numJumps = jcarrier['finance']['numJumps']
+        mycarrier.totalDistanceJumped = jcarrier.value('itinerary', 'totalDistanceJumpedLY')
+        mycarrier.currentJump = jcarrier.value('itinerary', 'currentJump')
+        mycarrier.taxation = finance['taxation']
+        mycarrier.coreCost = finance['coreCost']
+        mycarrier.servicesCost = finance['servicesCost']
+        mycarrier.jumpsCost = finance['jumpsCost']
+        mycarrier.numJumps = finance['numJumps']
         mycarrier.hasCommodities = True
         mycarrier.hasCarrierFuel = True
         mycarrier.hasRearm = True if services['rearm'] == 'ok' else False
@@ -435,63 +530,69 @@ def update_carrier(request, cid, user):
         mycarrier.hasExploration = True if services['exploration'] == 'ok' else False
         mycarrier.hasRepair = True if services['repair'] == 'ok' else False
         mycarrier.hasRefuel = True if services['refuel'] == 'ok' else False
-        mycarrier.marketId = jcarrier['market']['id']
+        mycarrier.marketId = jcarrier.value('market', 'id')
         if 'error' not in coords:
             mycarrier.x = coords['x']
             mycarrier.y = coords['y']
             mycarrier.z = coords['z']
         mycarrier.trackedOnly = False
-        mycarrier.cachedJson = json.dumps(jcarrier)
+        # jcarrier is fresh from CAPI. Store it as we got it, rather than decoding and re-encoding all of
+        # it, and tell the freshness model whether it differs from the last fetch.
+        with tracing.span('snapshot'):
+            previous = snapshots.latest(request.dbsession, '/fleetcarrier', carrier_id=mycarrier.id)
+            changed = not previous or previous.sha256 != snapshots.content_hash(jcarrier.raw)
+            snapshots.store(request.dbsession, '/fleetcarrier', jcarrier.raw, carrier_id=mycarrier.id,
+                            user_id=owner.id)
+        tracing.annotate(changed=changed)
+        freshness.record_refresh(request.dbsession, mycarrier.id, changed)
+        mycarrier.cachedJson = None
         mycarrier.lastUpdated = datetime.now()
         request.dbsession.autoflush = False
-        request.dbsession.query(Itinerary).filter(Itinerary.carrier_id
-                                                  == mycarrier.id).delete()
-        for item in jcarrier['itinerary']['completed']:
-            itm = Itinerary(carrier_id=mycarrier.id, starsystem=item['starsystem'],
-                            departureTime=item['departureTime'], arrivalTime=item['arrivalTime'],
-                            visitDurationSeconds=item['visitDurationSeconds'])
-            request.dbsession.add(itm)
-
-        request.dbsession.query(Cargo).filter(Cargo.carrier_id
-                                              == mycarrier.id).delete()
-        for item in jcarrier['cargo']:
-            cg = Cargo(carrier_id=mycarrier.id, commodity=item['commodity'],
-                       quantity=item['qty'], stolen=item['stolen'], locName=item['locName'], value=item['value'])
-            request.dbsession.add(cg)
-        request.dbsession.flush()
-        request.dbsession.query(Market).filter(Market.carrier_id
-                                               == mycarrier.id).delete()
-        for item in jcarrier['market']['commodities']:
-            mk = Market(carrier_id=mycarrier.id, commodity_id=item['id'],
-                        categoryname=item['categoryname'], name=item['name'],
-                        stock=item['stock'], buyPrice=item['buyPrice'],
-                        sellPrice=item['sellPrice'], demand=item['demand'],
-                        locName=item['locName'])
-            request.dbsession.add(mk)
-
-        request.dbsession.query(Ship).filter(Ship.carrier_id
-                                             == mycarrier.id).delete()
-        if 'ships' in jcarrier:
-            if jcarrier['ships']['shipyard_list']:
-                for item, it in jcarrier['ships']['shipyard_list'].items():
-
-                    sp = Ship(carrier_id=mycarrier.id, name=it['name'],
-                              ship_id=it['id'], basevalue=it['basevalue'],
-                              stock=it['stock'])
-                    request.dbsession.add(sp)
-
-        request.dbsession.query(Module).filter(Module.carrier_id
-                                               == mycarrier.id).delete()
-        if 'modules' in jcarrier:
-            try:
-                for item, it in jcarrier['modules'].items():
-                    md = Module(carrier_id=mycarrier.id, category=it['category'],
-                                name=it['name'], cost=it['cost'], stock=it['stock'],
-                                module_id=it['id'])
-                    request.dbsession.add(md)
-            except:
-                log.debug("Failed to get modules from jcarrier?!")
-        request.dbsession.flush()
+        # Each section is decoded one entry at a time and written out in batches.
+        progress(40, 'Importing itinerary')
+        replace_rows(request.dbsession, Itinerary, mycarrier.id,
+                     (Itinerary(carrier_id=mycarrier.id, starsystem=item['starsystem'],
+                                departureTime=item['departureTime'], arrivalTime=item['arrivalTime'],
+                                visitDurationSeconds=item['visitDurationSeconds'])
+                      for item in jcarrier.iter_values('itinerary', 'completed')))
+        progress(55, 'Importing cargo')
+        replace_rows(request.dbsession, Cargo, mycarrier.id,
+                     (Cargo(carrier_id=mycarrier.id, commodity=item['commodity'],
+                            quantity=item['qty'], stolen=item['stolen'], locName=item['locName'],
+                            value=item['value'])
+                      for item in jcarrier.iter_values('cargo')))
+        progress(65, 'Importing market')
+        replace_rows(request.dbsession, Market, mycarrier.id,
+                     commodities.stream(request.dbsession, mycarrier,
+                                        (Market(carrier_id=mycarrier.id, commodity_id=item['id'],
+                                                categoryname=item['categoryname'], name=item['name'],
+                                                stock=item['stock'], buyPrice=item['buyPrice'],
+                                                sellPrice=item['sellPrice'], demand=item['demand'],
+                                                locName=item['locName'])
+                                         for item in jcarrier.iter_values('market', 'commodities'))))
+        # The shipyard and outfitting sections are missing when the service is off. They are short, so
+        # decode them in full before the old rows are deleted, where a missing section can't abort the
+        # refresh halfway through.
+        progress(80, 'Importing shipyard')
+        try:
+            ships = [Ship(carrier_id=mycarrier.id, name=it['name'], ship_id=it['id'],
+                          basevalue=it['basevalue'], stock=it['stock'])
+                     for it in jcarrier.iter_values('ships', 'shipyard_list')]
+        except KeyError:
+            log.debug("No shipyard list in jcarrier.")
+            ships = []
+        replace_rows(request.dbsession, Ship, mycarrier.id, ships)
+        progress(90, 'Importing outfitting')
+        try:
+            modules = [Module(carrier_id=mycarrier.id, category=it['category'], name=it['name'],
+                              cost=it['cost'], stock=it['stock'], module_id=it['id'])
+                       for it in jcarrier.iter_values('modules')]
+        except (KeyError, TypeError):
+            log.debug("Failed to get modules from jcarrier?!")
+            modules = []
+        replace_rows(request.dbsession, Module, mycarrier.id, modules)
         request.dbsession.autoflush = True
+        tracing.annotate(outcome='updated')
         return jcarrier or None
+    tracing.annotate(outcome='no_owner')
     return None
@@ -0,0 +1,248 @@
+# In-memory inverted index of carrier markets, for the nearest-carrier commodity search.
+# Maps each commodity (by lower case name and localised name) to the carriers trading it, with their stock,
+# demand and prices, so finding every carrier selling Tritium is one dict lookup rather than a scan of the
+# market table. Results are ranked by distance using the carrier positions (see spatial.positions).
+#
+# Like the spatial index, each process keeps its own. update_carrier and process_eddn call stream() or
+# record() when they replace a carrier's market; that stamps Carrier.marketUpdated and applies the new
+# market to this process' index once the transaction commits. Other processes see the stamp in a delta
+# sync every commodity_sync seconds, and the index is rebuilt every commodity_refresh seconds as a backstop.
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy
+from pyramid import threadlocal
+from sqlalchemy import event, or_
+from sqlalchemy.orm import Session
+
+from . import spatial
+from ..models import Carrier, Market
+import logging
+
+log = logging.getLogger(__name__)
+
+settings = threadlocal.get_current_registry().settings or {}
+sync_interval = int(settings.get('commodity_sync', 15))
+refresh_interval = int(settings.get('commodity_refresh', 900))
+
+# marketUpdated is always stamped with the local clock, so a little slack covers transactions that
+# committed out of order.
+SYNC_SLACK = 60
+
+Offer = namedtuple('Offer', ['name', 'stock', 'demand', 'buyPrice', 'sellPrice'])
+
+# What the carrier does with the commodity, as seen by the player: carriers sell what has stock and a
+# buy price, and buy what has demand and a sell price.
+MODES = ('buy', 'sell')
+
+
+def entry(market):
+    """
+    :param market: A Market row
+    :return: The (name, locName, stock, demand, buyPrice, sellPrice) tuple the index keeps
+    """
+    return market.name, market.locName, market.stock, market.demand, market.buyPrice, market.sellPrice
+
+
+class CommodityIndex(object):
+    def __init__(self):
+        self.offers = {}
+        self.carriers = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.carriers)
+
+    def replace(self, cid, entries):
+        """
+        Replaces a carrier's market.
+        :param cid: Carrier ID
+        :param entries: (name, locName, stock, demand, buyPrice, sellPrice) tuples; empty to drop the carrier
+        """
+        with self.lock:
+            for key in self.carriers.pop(cid, ()):
+                offers = self.offers.get(key)
+                if offers is not None:
+                    offers.pop(cid, None)
+                    if not offers:
+                        del self.offers[key]
+            keys = set()
+            for name, locName, stock, demand, buyPrice, sellPrice in entries:
+                offer = Offer(locName or name, stock or 0, demand or 0, buyPrice or 0, sellPrice or 0)
+                for key in {name.lower() if name else None, locName.lower() if locName else None}:
+                    if key:
+                        self.offers.setdefault(key, {})[cid] = offer
+                        keys.add(key)
+            if keys:
+                self.carriers[cid] = keys
+
+    def find(self, commodity, mode='buy', quantity=1, price=None):
+        """
+        Finds the carriers trading a commodity.
+        :param commodity: Commodity name or localised name, any case
+        :param mode: 'buy' for carriers selling it, 'sell' for carriers buying it
+        :param quantity: Least stock (buy) or demand (sell)
+        :param price: Highest buy price (buy) or lowest sell price (sell)
+        :return: A dict of carrier ID: Offer
+        """
+        with self.lock:
+            offers = dict(self.offers.get(commodity.strip().lower(), {}))
+        if mode == 'buy':
+            return {cid: offer for cid, offer in offers.items() if offer.buyPrice > 0 and
+                    offer.stock >= quantity and (price is None or offer.buyPrice <= price)}
+        return {cid: offer for cid, offer in offers.items() if offer.sellPrice > 0 and
+                offer.demand >= quantity and (price is None or offer.sellPrice >= price)}
+
+
+_index = None
+_loaded_at = 0.0
+_synced_at = 0.0
+_watermark = None
+_state_lock = threading.Lock()
+
+
+def _markets(dbsession, cids=None):
+    """
+    Reads markets from the database.
+    :param dbsession: Database session
+    :param cids: Carrier IDs to read (default: all)
+    :return: A dict of carrier ID: list of entries
+    """
+    query = dbsession.query(Market.carrier_id, Market.name, Market.locName, Market.stock, Market.demand,
+                            Market.buyPrice, Market.sellPrice). \
+        filter(or_(Market.categoryname == None, Market.categoryname != 'NonMarketable'))
+    if cids is not None:
+        query = query.filter(Market.carrier_id.in_(cids))
+    markets = {cid: [] for cid in cids} if cids is not None else {}
+    for row in query.yield_per(10000):
+        markets.setdefault(row.carrier_id, []).append(tuple(row)[1:])
+    return markets
+
+
+def _load(dbsession):
+    index = CommodityIndex()
+    watermark = dbsession.query(Carrier.marketUpdated).order_by(Carrier.marketUpdated.desc()). \
+        filter(Carrier.marketUpdated != None).limit(1).scalar()
+    for cid, entries in _markets(dbsession).items():
+        index.replace(cid, entries)
+    return index, watermark
+
+
+def _sync(dbsession):
+    """
+    Reloads the markets of carriers stamped since the last sync, by other processes too.
+    """
+    global _watermark
+    query = dbsession.query(Carrier.id, Carrier.marketUpdated).filter(Carrier.marketUpdated != None)
+    if _watermark:
+        query = query.filter(Carrier.marketUpdated > _watermark - timedelta(seconds=SYNC_SLACK))
+    changed = {}
+    for row in query:
+        changed[row.id] = row.marketUpdated
+        if not _watermark or row.marketUpdated > _watermark:
+            _watermark = row.marketUpdated
+    if changed:
+        for cid, entries in _markets(dbsession, list(changed)).items():
+            _index.replace(cid, entries)
+    log.debug(f"Commodity index delta sync reloaded {len(changed)} markets.")
+
+
+def get_index(dbsession):
+    """
+    Gets this process' commodity index, loading, syncing or rebuilding it as needed.
+    :param dbsession: Database session
+    :return: A CommodityIndex
+    """
+    global _index, _loaded_at, _synced_at, _watermark
+    now = time.monotonic()
+    with _state_lock:
+        if _index is None or now - _loaded_at > refresh_interval:
+            start = time.monotonic()
+            _index, _watermark = _load(dbsession)
+            _loaded_at = _synced_at = now
+            log.info(f"Loaded {len(_index)} carrier markets into the commodity index in "
+                     f"{time.monotonic() - start:.3f}s.")
+        elif now - _synced_at > sync_interval:
+            _sync(dbsession)
+            _synced_at = now
+        return _index
+
+
+def record(dbsession, mycarrier, markets):
+    """
+    Notes that a carrier's market was replaced: stamps marketUpdated for other processes, and updates this
+    process' index when the transaction commits.
+    :param dbsession: Database session
+    :param mycarrier: The Carrier
+    :param markets: The carrier's new Market rows
+    """
+    mycarrier.marketUpdated = datetime.now()
+    entries = [entry(market) for market in markets if market.categoryname != 'NonMarketable']
+    dbsession.info.setdefault('commodities_changed', {})[mycarrier.id] = entries
+
+
+def stream(dbsession, mycarrier, markets):
+    """
+    Like record, for a market being streamed into the database: passes the Market rows through, keeping
+    only their index entries, so the whole market is never held as rows.
+    :param dbsession: Database session
+    :param mycarrier: The Carrier
+    :param markets: An iterable of the carrier's new Market rows
+    :return: A generator of the same rows, to feed to replace_rows
+    """
+    record(dbsession, mycarrier, [])
+    entries = dbsession.info['commodities_changed'][mycarrier.id]
+    for market in markets:
+        if market.categoryname != 'NonMarketable':
+            entries.append(entry(market))
+        yield market
+
+
+def nearest_offers(dbsession, commodity, point, mode='buy', quantity=1, price=None, k=25):
+    """
+    Finds the carriers closest to a point trading a commodity. Only carriers shown in search, with a public
+    market and a known position are listed.
+    :param dbsession: Database session
+    :param commodity: Commodity name or localised name
+    :param point: (x, y, z)
+    :param mode: 'buy' for carriers selling the commodity, 'sell' for carriers buying it
+    :param quantity: Least stock (buy) or demand (sell)
+    :param price: Highest buy price (buy) or lowest sell price (sell)
+    :param k: Most carriers to return
+    :return: A list of (distance, Carrier, Offer), closest first
+    """
+    offers = get_index(dbsession).find(commodity, mode, quantity, price)
+    positions = spatial.positions(dbsession, offers)
+    cids = list(positions)
+    if not cids:
+        return []
+    xyz = numpy.array([positions[cid] for cid in cids], dtype=float)
+    dist = numpy.sqrt(((xyz - numpy.asarray(point, dtype=float)) ** 2).sum(axis=1))
+    order = numpy.argsort(dist, kind='stable')
+    found = []
+    # A few carriers may hide their market; read them in chunks until there are enough.
+    for start in range(0, len(order), k * 2):
+        chunk = [cids[i] for i in order[start:start + k * 2]]
+        carriers = {c.id: c for c in dbsession.query(Carrier).filter(
+            Carrier.id.in_(chunk), or_(Carrier.showMarket == None, Carrier.showMarket == True))}
+        for i in order[start:start + k * 2]:
+            if cids[i] in carriers:
+                found.append((float(dist[i]), carriers[cids[i]], offers[cids[i]]))
+                if len(found) >= k:
+                    return found
+    return found
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply(session):
+    changed = session.info.pop('commodities_changed', None)
+    if changed and _index is not None:
+        for cid, entries in changed.items():
+            _index.replace(cid, entries)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard(session):
+    session.info.pop('commodities_changed', None)
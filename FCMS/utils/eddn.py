@@ -1,5 +1,6 @@
 import transaction
 import re
+from datetime import datetime
 
 
 from sqlalchemy.exc import DataError, IntegrityError
@@ -7,12 +8,25 @@ from sqlalchemy.exc import DataError, IntegrityError
 from FCMS.models import (
     Market, Carrier
 )
+from FCMS.utils import commodities, freshness, sapi
 
 
 carrier_rs = '^[A-Za-z0-9]{3}-[A-Za-z0-9]{3}$'
 carrier_r = re.compile(carrier_rs)
 
 
+def parse_timestamp(timestamp):
+    """
+    Turns an EDDN timestamp (ISO 8601, UTC) into a local datetime like the ones we store.
+    :param timestamp: The timestamp string
+    :return: A naive datetime, or now if the timestamp can't be read
+    """
+    try:
+        return datetime.fromisoformat(timestamp.replace('Z', '+00:00')).astimezone().replace(tzinfo=None)
+    except (AttributeError, ValueError):
+        return datetime.now()
+
+
 def process_eddn(session, data):
     new_carriers = 0
     new_commodities = 0
@@ -21,17 +35,21 @@ def process_eddn(session, data):
 
         oc = session.query(Carrier).filter(Carrier.callsign == data['stationName']).one_or_none()
         if oc:
+            freshness.record_eddn(session, oc.id)
             session.query(Market).filter(Market.carrier_id == oc.id).delete()
+            markets = []
             for commodity in data['commodities']:
                 nc = Market(carrier_id=oc.id, commodity_id=0, name=commodity['name'], stock=commodity['stock'],
                             buyPrice=commodity['buyPrice'], sellPrice=commodity['sellPrice'], demand=commodity['demand'])
                 session.add(nc)
+                markets.append(nc)
                 new_commodities = new_commodities+1
+            commodities.record(session, oc, markets)
             transaction.commit()
 
         else:
             newcarrier = Carrier(callsign=data['stationName'],
-                                 name="Unknown Name", lastUpdated=data['timestamp'],
+                                 name="Unknown Name", lastUpdated=parse_timestamp(data['timestamp']),
                                  currentStarSystem=data['systemName'],
                                  hasShipyard=False,
                                  hasOutfitting=False,
@@ -45,18 +63,28 @@ def process_eddn(session, data):
             session.flush()
             session.refresh(newcarrier)
             new_carriers = new_carriers + 1
+            markets = []
             for commodity in data['commodities']:
                 nc = Market(carrier_id=newcarrier.id, commodity_id=0, name=commodity['name'], stock=commodity['stock'],
                             buyPrice=commodity['buyPrice'], sellPrice=commodity['sellPrice'],
                             demand=commodity['demand'])
                 session.add(nc)
+                markets.append(nc)
                 new_commodities = new_commodities + 1
+            commodities.record(session, newcarrier, markets)
             session.flush()
     if 'event' in data:
         if data['event'] in {'Docked', 'CarrierJump'} and data['StationType'] == 'FleetCarrier':
+            approximate = False
+            if 'StarPos' not in data and 'SystemAddress' in data:
+                coords = sapi.coords_by_id(data['SystemAddress'], session)
+                data['StarPos'] = [coords['x'], coords['y'], coords['z']]
+                approximate = coords.get('approximate', False)
             try:
-                oldcarrier = session.query(Carrier).filter(Carrier.callsign == data['StationName'])
+                oldcarrier = session.query(Carrier).filter(Carrier.callsign == data['StationName']).one_or_none()
                 if oldcarrier:
+                    freshness.record_eddn(session, oldcarrier.id)
+                    moved = oldcarrier.currentStarSystem != data['StarSystem']
                     oldcarrier.currentStarSystem = data['StarSystem']
                     oldcarrier.hasShipyard = True if 'shipyard' in data['StationServices'] else False
                     oldcarrier.hasOutfitting = True if 'outfitting' in data[
@@ -66,14 +94,17 @@ def process_eddn(session, data):
                     oldcarrier.hasRefuel = True if 'refuel' in data['StationServices'] else False
                     oldcarrier.hasRepair = True if 'repair' in data['StationServices'] else False
                     oldcarrier.hasRearm = True if 'rearm' in data['StationServices'] else False
-                    oldcarrier.lastUpdated = data['timestamp']
-                    oldcarrier.x = data['StarPos'][0]
-                    oldcarrier.y = data['StarPos'][1]
-                    oldcarrier.z = data['StarPos'][2]
+                    # lastUpdated is when CAPI last refreshed the carrier, which decides when the next
+                    # refresh is due; the sighting itself is counted by record_eddn.
+                    # A boxel centre is no better than the position we have if the carrier hasn't moved.
+                    if not (approximate and oldcarrier.x is not None and not moved):
+                        oldcarrier.x = data['StarPos'][0]
+                        oldcarrier.y = data['StarPos'][1]
+                        oldcarrier.z = data['StarPos'][2]
                     updated_carriers = updated_carriers + 1
                 else:
                     newcarrier = Carrier(callsign=data['StationName'],
-                                         name="Unknown Name", lastUpdated=data['timestamp'],
+                                         name="Unknown Name", lastUpdated=parse_timestamp(data['timestamp']),
                                          currentStarSystem=data['StarSystem'],
                                          hasShipyard=True if 'shipyard' in data['StationServices']
                                          else False,
@@ -0,0 +1,162 @@
+# Per-carrier refresh intervals.
+# A carrier's CAPI data is refreshed when it is viewed and older than its refresh interval. The interval
+# shrinks for carriers whose payload keeps changing between refreshes, that show up on EDDN, or that
+# get a lot of views, and grows for parked carriers nobody looks at.
+import math
+from datetime import datetime, timedelta
+
+from pyramid import threadlocal
+from sqlalchemy.exc import IntegrityError
+
+from ..models import CarrierFreshness
+import logging
+
+log = logging.getLogger(__name__)
+
+settings = threadlocal.get_current_registry().settings or {}
+min_interval = int(settings.get('freshness_min_interval', 600))
+max_interval = int(settings.get('freshness_max_interval', 21600))
+default_interval = int(settings.get('freshness_default_interval', 900))
+alpha = float(settings.get('freshness_alpha', 0.3))
+view_halflife = int(settings.get('freshness_view_halflife', 86400))
+eddn_halflife = int(settings.get('freshness_eddn_halflife', 3600))
+
+# Keeps a carrier that never changes from being treated as if it could never change.
+MIN_CHANGE_RATE = 0.01
+
+
+def decay(score, since, now, halflife):
+    """
+    Exponentially decays a score.
+    :param score: The score at time since
+    :param since: When the score was last updated (None means never)
+    :param now: Current time
+    :param halflife: Half life in seconds
+    :return: The score at time now
+    """
+    if not score or not since:
+        return 0.0
+    return score * 0.5 ** (max(0.0, (now - since).total_seconds()) / halflife)
+
+
+def compute_interval(row, now=None):
+    """
+    Computes a carrier's refresh interval.
+
+    The base is min_interval divided by the change rate (how often successive payloads differed), so a
+    carrier that changes on every other refresh gets twice the minimum. Recent EDDN activity counts as
+    a change rate of up to 1, and views per day divide the result further on a log scale.
+    :param row: A CarrierFreshness row
+    :param now: Current time
+    :return: Interval in seconds, between min_interval and max_interval
+    """
+    now = now or datetime.now()
+    rate = max(row.changeRate if row.changeRate is not None else 1.0,
+               min(1.0, decay(row.eddnScore, row.eddnAt, now, eddn_halflife)),
+               MIN_CHANGE_RATE)
+    views = views_per_day(row, now)
+    interval = min_interval / rate / (1 + math.log10(1 + views))
+    return int(min(max_interval, max(min_interval, interval)))
+
+
+def views_per_day(row, now=None):
+    """
+    Estimates a carrier's current view rate from its decayed view score.
+    :param row: A CarrierFreshness row
+    :param now: Current time
+    :return: Views per day
+    """
+    score = decay(row.viewScore, row.viewsAt, now or datetime.now(), view_halflife)
+    return score * math.log(2) * 86400 / view_halflife
+
+
+def get_row(dbsession, cid, create=False):
+    """
+    Gets a carrier's freshness row.
+    :param dbsession: Database session
+    :param cid: Carrier ID
+    :param create: Create the row if missing
+    :return: A CarrierFreshness or None
+    """
+    row = dbsession.query(CarrierFreshness).filter(CarrierFreshness.carrier_id == cid).one_or_none()
+    if not row and create:
+        row = CarrierFreshness(carrier_id=cid, changeRate=1.0, refreshes=0, changes=0, viewScore=0.0,
+                               eddnScore=0.0, refreshInterval=default_interval)
+        try:
+            with dbsession.begin_nested():
+                dbsession.add(row)
+        except IntegrityError:
+            row = dbsession.query(CarrierFreshness).filter(CarrierFreshness.carrier_id == cid).one()
+    return row
+
+
+def _update(row, now):
+    row.refreshInterval = compute_interval(row, now)
+    row.updatedAt = now
+
+
+def record_refresh(dbsession, cid, changed):
+    """
+    Feeds the result of a CAPI refresh into the model.
+    :param dbsession: Database session
+    :param cid: Carrier ID
+    :param changed: Whether the payload differed from the previous one
+    """
+    now = datetime.now()
+    row = get_row(dbsession, cid, create=True)
+    row.changeRate = alpha * (1.0 if changed else 0.0) + (1 - alpha) * (row.changeRate or 0.0)
+    row.refreshes = (row.refreshes or 0) + 1
+    row.changes = (row.changes or 0) + (1 if changed else 0)
+    _update(row, now)
+    log.debug(f"Carrier {cid} refreshed, changed: {changed}. Interval now {row.refreshInterval}s.")
+
+
+def record_view(dbsession, cid):
+    """
+    Counts a carrier page view.
+    :param dbsession: Database session
+    :param cid: Carrier ID
+    """
+    now = datetime.now()
+    row = get_row(dbsession, cid, create=True)
+    row.viewScore = decay(row.viewScore, row.viewsAt, now, view_halflife) + 1
+    row.viewsAt = now
+    _update(row, now)
+
+
+def record_eddn(dbsession, cid):
+    """
+    Counts a sighting of the carrier on EDDN (market update, dock or jump).
+    :param dbsession: Database session
+    :param cid: Carrier ID
+    """
+    now = datetime.now()
+    row = get_row(dbsession, cid, create=True)
+    row.eddnScore = decay(row.eddnScore, row.eddnAt, now, eddn_halflife) + 1
+    row.eddnAt = now
+    _update(row, now)
+
+
+def refresh_interval(dbsession, cid):
+    """
+    Gets how old a carrier's data may get before a view triggers a refresh.
+    :param dbsession: Database session
+    :param cid: Carrier ID
+    :return: A timedelta
+    """
+    row = get_row(dbsession, cid)
+    if not row or not row.refreshInterval:
+        return timedelta(seconds=default_interval)
+    return timedelta(seconds=row.refreshInterval)
+
+
+def expected_calls(row, interval, now=None):
+    """
+    Estimates CAPI calls per day for a carrier. Refreshes only happen on views, so a carrier makes at
+    most one call per view, and at most one per interval.
+    :param row: A CarrierFreshness row
+    :param interval: Refresh interval in seconds
+    :param now: Current time
+    :return: Calls per day
+    """
+    return min(views_per_day(row, now), 86400 / interval)
@@ -0,0 +1,168 @@
+# Shared outbound HTTP layer. Every request to a third party (CAPI, Frontier auth, the systems API,
+# webhooks) goes through an InstrumentedAdapter, which adds pooled connections, a default timeout, retries
+# for idempotent requests, per-host latency and error metrics, the host's rate limit and its circuit breaker.
+import threading
+import time
+from urllib.parse import urlparse
+
+import requests
+from pyramid import threadlocal
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import breaker, metrics, ratelimit
+import logging
+
+log = logging.getLogger(__name__)
+
+settings = threadlocal.get_current_registry().settings or {}
+connect_timeout = float(settings.get('http_connect_timeout', 5))
+read_timeout = float(settings.get('http_read_timeout', 15))
+retries = int(settings.get('http_retries', 2))
+backoff = float(settings.get('http_backoff', 0.3))
+pool_size = int(settings.get('http_pool_size', 10))
+
+http_requests = metrics.counter('fcms_http_requests_total', 'Outbound HTTP requests by host, method and status')
+http_seconds = metrics.histogram('fcms_http_request_seconds', 'Outbound HTTP request latency by host')
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """
+    Raised instead of making a request while the host's circuit breaker is open.
+    """
+
+
+class RateLimitedError(requests.ConnectionError):
+    """
+    Raised instead of making a request when the host's rate limit would hold it up for too long.
+    """
+
+
+def retry_after(response):
+    """
+    Reads how long a host wants us to back off from a 429 response.
+    :param response: A requests.Response
+    :return: Seconds, or None if the host didn't say
+    """
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        pass
+    try:
+        # Discord puts it in the body.
+        return float(response.json()['retry_after'])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def retry_policy(read=None):
+    """
+    Retries connection failures for any request, and read errors and 502/503/504 responses only for
+    idempotent ones, with exponential backoff.
+    :param read: Retries after a read error (default: http_retries). Each one can wait out the whole read
+    timeout again, so hosts that are slow rather than flaky should get 0.
+    :return: A urllib3 Retry
+    """
+    kwargs = dict(total=retries, connect=retries, read=retries if read is None else read, status=retries,
+                  backoff_factor=backoff, status_forcelist=(502, 503, 504), raise_on_status=False)
+    methods = frozenset(['GET', 'HEAD', 'OPTIONS'])
+    try:
+        return Retry(allowed_methods=methods, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=methods, **kwargs)
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    def __init__(self, timeout=None, read_retries=None, **kwargs):
+        """
+        :param timeout: Default (connect, read) timeout for requests sent without one
+        :param read_retries: Retries after a read error (default: http_retries)
+        """
+        self.default_timeout = timeout or (connect_timeout, read_timeout)
+        kwargs.setdefault('max_retries', retry_policy(read=read_retries))
+        kwargs.setdefault('pool_maxsize', pool_size)
+        super(InstrumentedAdapter, self).__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        host = urlparse(request.url).netloc
+        # Ask the breaker first, so calls it would reject don't wait for (and spend) a rate limit token.
+        guard = breaker.get_breaker(host)
+        if not guard.allow():
+            http_requests.inc(host=host, method=request.method, status='circuit_open')
+            raise CircuitOpenError(f"Circuit open for {host}", request=request)
+        if not ratelimit.acquire(host):
+            guard.release()
+            http_requests.inc(host=host, method=request.method, status='rate_limited')
+            raise RateLimitedError(f"Rate limit for {host} exceeded", request=request)
+        start = time.monotonic()
+        try:
+            response = super(InstrumentedAdapter, self).send(request, timeout=timeout or self.default_timeout,
+                                                             **kwargs)
+        except Exception:
+            elapsed = time.monotonic() - start
+            guard.failure(elapsed)
+            http_requests.inc(host=host, method=request.method, status='error')
+            http_seconds.observe(elapsed, host=host)
+            raise
+        elapsed = time.monotonic() - start
+        if response.status_code >= 500:
+            guard.failure(elapsed)
+        else:
+            guard.success(elapsed)
+        if response.status_code == 429:
+            ratelimit.pause(host, retry_after(response) or 1)
+        http_requests.inc(host=host, method=request.method, status=response.status_code)
+        http_seconds.observe(elapsed, host=host)
+        return response
+
+
+def mount(session, timeout=None, read_retries=None):
+    """
+    Routes a session's requests (e.g. an OAuth2 client's) through the instrumented layer.
+    :param session: A requests.Session
+    :param timeout: Default timeout for the session
+    :param read_retries: Retries after a read error (default: http_retries)
+    :return: The session
+    """
+    adapter = InstrumentedAdapter(timeout=timeout, read_retries=read_retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url):
+    """
+    Gets the shared session for a URL's host. Each host gets its own session, so cookies and the
+    connection pool aren't shared between third parties.
+    :param url: Any URL on the host
+    :return: A requests.Session
+    """
+    parsed = urlparse(url)
+    key = f'{parsed.scheme}://{parsed.netloc}'
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = mount(requests.Session())
+        return _sessions[key]
+
+
+def request(method, url, **kwargs):
+    """
+    Makes an outbound request. Takes the same arguments as requests.request.
+    :param method: HTTP method
+    :param url: URL
+    :return: A requests.Response
+    """
+    return get_session(url).request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
@@ -0,0 +1,59 @@
+# Decoding of system id64s (SystemAddress) into approximate coordinates.
+# An id64 encodes the system's sector and its boxel (a cube of the galaxy, 10 * 2^masscode ly across)
+# within the sector. From the least significant bit up:
+#   masscode 3 | boxel z 7-mc | sector z 7 | boxel y 7-mc | sector y 6 | boxel x 7-mc | sector x 7 |
+#   system number in boxel 11+3*mc | body 9
+# The centre of the boxel is within half a boxel of the real position on each axis: 5 ly for mass code
+# a, 640 ly for h. Good enough to sort or filter by distance until we know the real coordinates.
+import numpy
+
+SECTOR_SIZE = 1280
+ORIGIN = (-49985, -40985, -24105)
+
+
+def _bits(value, shift, width):
+    """
+    Extracts bit fields. Shifts and widths may vary per element.
+    """
+    one = numpy.uint64(1)
+    return (value >> shift) & ((one << width) - one)
+
+
+def decode(id64s):
+    """
+    Decodes id64s into boxel centre coordinates. Takes a single id64 or an array.
+    :param id64s: An id64 or sequence of id64s
+    :return: A tuple of (x, y, z, masscode, boxel size); floats and ints for a single id64, arrays otherwise
+    """
+    scalar = numpy.ndim(id64s) == 0
+    value = numpy.atleast_1d(numpy.asarray(id64s, dtype=numpy.uint64))
+    mc = value & numpy.uint64(7)
+    boxel_bits = numpy.uint64(7) - mc
+    shift = numpy.full(value.shape, 3, dtype=numpy.uint64)
+    fields = []
+    for sector_bits in (7, 6, 7):
+        # z, then y, then x: each is a boxel index followed by a sector index.
+        boxel = _bits(value, shift, boxel_bits)
+        shift = shift + boxel_bits
+        sector = _bits(value, shift, numpy.uint64(sector_bits))
+        shift = shift + numpy.uint64(sector_bits)
+        fields.append((sector, boxel))
+    size = 10.0 * (1 << mc.astype(numpy.int64))
+    coords = []
+    for (sector, boxel), origin in zip(reversed(fields), ORIGIN):
+        coords.append(origin + sector.astype(numpy.float64) * SECTOR_SIZE + boxel.astype(numpy.float64) * size +
+                      size / 2)
+    x, y, z = coords
+    masscode = mc.astype(numpy.int64)
+    if scalar:
+        return float(x[0]), float(y[0]), float(z[0]), int(masscode[0]), float(size[0])
+    return x, y, z, masscode, size
+
+
+def approximate_coords(id64):
+    """
+    :param id64: A system's id64
+    :return: A dict of x, y and z (the centre of the system's boxel), plus half the boxel size as accuracy
+    """
+    x, y, z, masscode, size = decode(int(id64))
+    return {'x': x, 'y': y, 'z': z, 'accuracy': size / 2, 'approximate': True}
@@ -0,0 +1,202 @@
+# Background job queue. Jobs are rows in the jobs table; they're run by the job_runner script, or, with
+# jobs_run_in_process set, by a thread the web process starts once the response has gone out.
+import threading
+from datetime import datetime, timedelta
+
+from pyramid import threadlocal
+from pyramid.scripting import prepare
+from pyramid.settings import asbool
+from sqlalchemy.exc import IntegrityError
+
+from ..models import Job
+import logging
+
+log = logging.getLogger(__name__)
+
+settings = threadlocal.get_current_registry().settings or {}
+capi_timeout = int(settings.get('jobs_capi_timeout', 60))
+run_in_process = asbool(settings.get('jobs_run_in_process', True))
+max_attempts = int(settings.get('jobs_max_attempts', 3))
+stale_after = int(settings.get('jobs_stale_after', 600))
+
+handlers = {}
+
+
+def handler(job_type):
+    """
+    Registers a function as the handler for a job type. Handlers are called as handler(request, job)
+    inside a transaction, and return True on success.
+    :param job_type: The job type name
+    """
+    def register(func):
+        handlers[job_type] = func
+        return func
+    return register
+
+
+def get_active(dbsession, job_type, carrier_id):
+    """
+    Finds a queued or running job of a type for a carrier.
+    :param dbsession: Database session
+    :param job_type: The job type name
+    :param carrier_id: Carrier ID
+    :return: A Job or None
+    """
+    return dbsession.query(Job).filter(Job.job_type == job_type, Job.carrier_id == carrier_id,
+                                       Job.status.in_(['queued', 'running'])).first()
+
+
+def enqueue(request, job_type, carrier_id, user_id=None):
+    """
+    Queues a job, unless the same job is already queued or running for the carrier.
+    :param request: The request object
+    :param job_type: The job type name
+    :param carrier_id: Carrier ID
+    :param user_id: User the job runs on behalf of
+    :return: The new or already active Job
+    """
+    job = get_active(request.dbsession, job_type, carrier_id)
+    if job:
+        return job
+    job = Job(job_type=job_type, carrier_id=carrier_id, user_id=user_id, status='queued', progress=0,
+              attempts=0, createdAt=datetime.now())
+    try:
+        # jobs_active_index turns away a second active job; if another request queued one first, use that.
+        with request.dbsession.begin_nested():
+            request.dbsession.add(job)
+    except IntegrityError:
+        log.debug(f"{job_type} job for carrier {carrier_id} was queued concurrently.")
+        return get_active(request.dbsession, job_type, carrier_id)
+    if run_in_process:
+        job_id = job.id
+        request.add_finished_callback(lambda req: start_thread(req.registry, job_id))
+    log.debug(f"Queued {job_type} job {job.id} for carrier {carrier_id}")
+    return job
+
+
+def start_thread(registry, job_id):
+    """
+    Runs a job in a daemon thread, so the page that queued it isn't held up.
+    :param registry: The application registry
+    :param job_id: Job ID
+    """
+    threading.Thread(target=execute, args=(registry, job_id), name=f'job-{job_id}', daemon=True).start()
+
+
+def claim(dbsession, job_id):
+    """
+    Atomically moves a queued job to running. Safe against other runners claiming the same job.
+    :param dbsession: Database session
+    :param job_id: Job ID
+    :return: True if this caller got the job
+    """
+    return dbsession.query(Job).filter(Job.id == job_id, Job.status == 'queued'). \
+        update({'status': 'running', 'startedAt': datetime.now(), 'attempts': Job.attempts + 1},
+               synchronize_session=False) == 1
+
+
+def next_queued(dbsession, limit=10):
+    """
+    Lists the oldest queued job IDs.
+    :param dbsession: Database session
+    :param limit: Maximum number of IDs
+    :return: A list of job IDs
+    """
+    return [row.id for row in dbsession.query(Job.id).filter(Job.status == 'queued').
+            order_by(Job.createdAt).limit(limit)]
+
+
+def requeue_stale(dbsession):
+    """
+    Puts jobs whose runner died back in the queue, or fails them once they're out of attempts.
+    :param dbsession: Database session
+    :return: Number of jobs touched
+    """
+    cutoff = datetime.now() - timedelta(seconds=stale_after)
+    stale = dbsession.query(Job).filter(Job.status == 'running', Job.startedAt < cutoff).all()
+    for job in stale:
+        job.status = 'queued' if job.attempts < max_attempts else 'failed'
+        job.message = 'Runner went away.'
+    return len(stale)
+
+
+def set_progress(registry, job_id, progress, message=None):
+    """
+    Reports how far along a running job is. Written in a separate, immediately committed session, so
+    pages polling the job see it while the job's own transaction is still open. The job's transaction
+    must not have written the job row yet, or this waits on its lock.
+    :param registry: The application registry
+    :param job_id: Job ID
+    :param progress: Percentage done
+    :param message: What the job is doing now
+    """
+    dbsession = registry['dbsession_factory']()
+    try:
+        dbsession.query(Job).filter(Job.id == job_id). \
+            update({'progress': progress, 'message': message}, synchronize_session=False)
+        dbsession.commit()
+    except Exception as e:
+        dbsession.rollback()
+        log.warning(f"Could not record progress for job {job_id}: {e}")
+    finally:
+        dbsession.close()
+
+
+def reporter(request, job):
+    """
+    Makes a progress callback for a job, for handlers to pass to long running work.
+    :param request: The job's request object
+    :param job: The Job being run
+    :return: A function taking (progress, message)
+    """
+    job_id = job.id
+    if request.dbsession.bind.dialect.name == 'sqlite':
+        # SQLite has a single writer, and the job's transaction holds the lock, so a second session would
+        # only wait for it and fail. Note progress on the job itself; it shows once the job commits.
+        def report(progress, message=None):
+            job.progress = progress
+            job.message = message
+        return report
+
+    def report(progress, message=None):
+        set_progress(request.registry, job_id, progress, message)
+    return report
+
+
+def execute(registry, job_id):
+    """
+    Claims and runs a single job in its own request context and transaction.
+    :param registry: The application registry
+    :param job_id: Job ID
+    :return: The final job status, or None if someone else claimed it
+    """
+    env = prepare(registry=registry)
+    request = env['request']
+    try:
+        with request.tm:
+            if not claim(request.dbsession, job_id):
+                return None
+        try:
+            with request.tm:
+                job = request.dbsession.query(Job).get(job_id)
+                func = handlers.get(job.job_type)
+                if not func:
+                    log.error(f"No handler for job type {job.job_type}!")
+                    ok = False
+                else:
+                    ok = func(request, job)
+                job.status = 'done' if ok else 'failed'
+                if ok:
+                    job.progress = 100
+                    job.message = None
+                job.finishedAt = datetime.now()
+                return job.status
+        except Exception as e:
+            log.exception(f"Job {job_id} raised: {e}")
+            with request.tm:
+                job = request.dbsession.query(Job).get(job_id)
+                job.status = 'queued' if job.attempts < max_attempts else 'failed'
+                job.message = str(e)[:500]
+                return job.status
+    finally:
+        env['closer']()
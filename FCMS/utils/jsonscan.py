@@ -0,0 +1,177 @@
+# Selective JSON decoding for large CAPI payloads.
+# Skips over values it isn't asked for without building them, and hands out big arrays one element at a time.
+import json
+import re
+from json import JSONDecodeError
+
+_ws = re.compile(r'[ \t\n\r]*')
+_string = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+# Runs of anything but brackets, with strings (which may contain brackets) consumed whole.
+_filler = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+_scalar = re.compile(r'[^,\]}\s]+')
+_decoder = json.JSONDecoder()
+
+
+def skip_value(text, pos):
+    """
+    Finds the end of the JSON value starting at pos, without decoding it.
+    :param text: The JSON document
+    :param pos: Index of the first character of the value
+    :return: Index just past the value
+    """
+    if pos >= len(text):
+        raise JSONDecodeError('Expecting value', text, pos)
+    c = text[pos]
+    if c == '"':
+        m = _string.match(text, pos)
+        if not m:
+            raise JSONDecodeError('Unterminated string', text, pos)
+        return m.end()
+    if c in '{[':
+        depth = 0
+        start = pos
+        while True:
+            pos = _filler.match(text, pos).end()
+            if pos >= len(text) or text[pos] == '"':
+                raise JSONDecodeError('Unterminated container', text, start)
+            depth = depth + 1 if text[pos] in '{[' else depth - 1
+            pos = pos + 1
+            if depth == 0:
+                return pos
+    m = _scalar.match(text, pos)
+    if not m:
+        raise JSONDecodeError('Expecting value', text, pos)
+    return m.end()
+
+
+def _expect(text, pos, char):
+    pos = _ws.match(text, pos).end()
+    if pos >= len(text) or text[pos] != char:
+        raise JSONDecodeError(f"Expecting '{char}'", text, pos)
+    return pos + 1
+
+
+def iter_members(text, pos):
+    """
+    Walks the members of a JSON object, skipping the values.
+    :param text: The JSON document
+    :param pos: Index of the object's opening brace
+    :return: A generator of (key, value start, value end) tuples
+    """
+    pos = _ws.match(text, pos + 1).end()
+    if text[pos:pos + 1] == '}':
+        return
+    while True:
+        m = _string.match(text, pos)
+        if not m:
+            raise JSONDecodeError('Expecting property name', text, pos)
+        key = m.group()[1:-1]
+        if '\\' in key:
+            key = json.loads(m.group())
+        start = _ws.match(text, _expect(text, m.end(), ':')).end()
+        end = skip_value(text, start)
+        yield key, start, end
+        pos = _ws.match(text, end).end()
+        if text[pos:pos + 1] == ',':
+            pos = _ws.match(text, pos + 1).end()
+        elif text[pos:pos + 1] == '}':
+            return
+        else:
+            raise JSONDecodeError("Expecting ',' delimiter", text, pos)
+
+
+def iter_elements(text, pos):
+    """
+    Decodes the elements of a JSON array, or the values of a JSON object, one at a time.
+    :param text: The JSON document
+    :param pos: Index of the container's opening bracket
+    :return: A generator of decoded values
+    """
+    is_object = text[pos] == '{'
+    close = '}' if is_object else ']'
+    pos = _ws.match(text, pos + 1).end()
+    if text[pos:pos + 1] == close:
+        return
+    while True:
+        if is_object:
+            m = _string.match(text, pos)
+            if not m:
+                raise JSONDecodeError('Expecting property name', text, pos)
+            pos = _ws.match(text, _expect(text, m.end(), ':')).end()
+        value, pos = _decoder.raw_decode(text, pos)
+        yield value
+        pos = _ws.match(text, pos).end()
+        if text[pos:pos + 1] == ',':
+            pos = _ws.match(text, pos + 1).end()
+        elif text[pos:pos + 1] == close:
+            return
+        else:
+            raise JSONDecodeError("Expecting ',' delimiter", text, pos)
+
+
+class LazyJSON(object):
+    """
+    A JSON object that is only decoded where it is read. Indexing decodes a single top level member,
+    value() and iter_values() reach into nested members without decoding their siblings.
+    """
+
+    def __init__(self, raw):
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf8')
+        self.raw = raw
+        start = _ws.match(raw).end()
+        if raw[start:start + 1] != '{':
+            raise JSONDecodeError('Expecting object', raw, start)
+        self._index = {key: (s, e) for key, s, e in iter_members(raw, start)}
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __getitem__(self, key):
+        return _decoder.raw_decode(self.raw, self._index[key][0])[0]
+
+    def __bool__(self):
+        return True
+
+    def keys(self):
+        return self._index.keys()
+
+    def get(self, key, default=None):
+        return self[key] if key in self._index else default
+
+    def span(self, *path):
+        """
+        Locates a nested member.
+        :param path: Keys leading to the member
+        :return: (start, end) of the member's raw value
+        """
+        start, end = self._index[path[0]]
+        for key in path[1:]:
+            if self.raw[start] != '{':
+                raise KeyError(key)
+            for name, s, e in iter_members(self.raw, start):
+                if name == key:
+                    start, end = s, e
+                    break
+            else:
+                raise KeyError(key)
+        return start, end
+
+    def value(self, *path):
+        """
+        Decodes a nested member, e.g. value('market', 'id').
+        :param path: Keys leading to the member
+        :return: The decoded value
+        """
+        return _decoder.raw_decode(self.raw, self.span(*path)[0])[0]
+
+    def iter_values(self, *path):
+        """
+        Decodes the values of a nested array or object one at a time. CAPI sends empty objects as [],
+        so both are accepted; anything else (like null) yields nothing.
+        :param path: Keys leading to the member
+        :return: A generator of decoded values
+        """
+        start, end = self.span(*path)
+        if self.raw[start] in '[{':
+            yield from iter_elements(self.raw, start)
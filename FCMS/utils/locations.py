@@ -0,0 +1,107 @@
+# Last known location of each commander.
+# Search pages measure distances from where the commander is. Rather than asking CAPI for the profile and
+# the systems API for coordinates on every view, the location is kept in cmdr_locations, fed by journal
+# events posted to /api (which carry coordinates) and by CAPI profile fetches, and only looked up remotely
+# once it has gone stale.
+from datetime import datetime, timedelta
+
+from pyramid import threadlocal
+from sqlalchemy.exc import IntegrityError
+
+from . import capi, sapi
+from ..models import CmdrLocation
+import logging
+
+log = logging.getLogger(__name__)
+
+settings = threadlocal.get_current_registry().settings or {}
+max_age = int(settings.get('location_max_age', 900))
+
+# Journal events that report the commander's current system, with StarPos.
+JOURNAL_EVENTS = {'Location', 'FSDJump', 'CarrierJump'}
+
+
+def get(dbsession, user_id):
+    """
+    :param dbsession: Database session
+    :param user_id: User ID
+    :return: The user's CmdrLocation, or None
+    """
+    return dbsession.query(CmdrLocation).filter(CmdrLocation.user_id == user_id).one_or_none()
+
+
+def update(dbsession, user_id, system, coords=None, address=None, source=None, at=None):
+    """
+    Records a commander's current system. Known coordinates are kept if the system hasn't changed.
+    :param dbsession: Database session
+    :param user_id: User ID
+    :param system: System name
+    :param coords: A sequence of (x, y, z), if known
+    :param address: The system's id64, if known
+    :param source: Where the location came from (journal, capi)
+    :param at: When the commander was seen there (default: now)
+    :return: The CmdrLocation
+    """
+    row = get(dbsession, user_id)
+    if not row:
+        row = CmdrLocation(user_id=user_id)
+        try:
+            with dbsession.begin_nested():
+                dbsession.add(row)
+        except IntegrityError:
+            row = get(dbsession, user_id)
+    if row.systemName != system:
+        row.x = row.y = row.z = None
+        row.systemAddress = None
+    row.systemName = system
+    if address:
+        row.systemAddress = address
+    if coords:
+        row.x, row.y, row.z = (float(c) for c in coords)
+    row.source = source
+    row.updatedAt = at or datetime.now()
+    return row
+
+
+def record_journal(dbsession, user_id, event):
+    """
+    Feeds a journal event posted to /api into the location table.
+    :param dbsession: Database session
+    :param user_id: User ID
+    :param event: The journal event dict
+    :return: The CmdrLocation, or None if the event doesn't carry a location
+    """
+    if event.get('event') not in JOURNAL_EVENTS or not event.get('StarSystem'):
+        return None
+    return update(dbsession, user_id, event['StarSystem'], coords=event.get('StarPos'),
+                  address=event.get('SystemAddress'), source='journal')
+
+
+def _as_dict(row):
+    return {'name': row.systemName, 'x': row.x, 'y': row.y, 'z': row.z}
+
+
+def resolve(dbsession, user):
+    """
+    Gets a commander's current system and its coordinates. Served from the location table while it is
+    fresh, otherwise refreshed from the CAPI profile, with the systems API filling in coordinates.
+    :param dbsession: Database session
+    :param user: The user object
+    :return: A dict with name, x, y and z, with an error key if the location couldn't be determined
+    """
+    row = get(dbsession, user.id)
+    if row and row.x is not None and row.updatedAt and row.updatedAt > datetime.now() - timedelta(seconds=max_age):
+        return _as_dict(row)
+    profile = capi.get_cmdr(user)
+    if profile and 'lastSystem' in profile:
+        row = update(dbsession, user.id, profile['lastSystem']['name'], address=profile['lastSystem'].get('id'),
+                     source='capi')
+    elif not row:
+        return {'name': None, 'x': 0, 'y': 0, 'z': 0, 'error': 'Location unknown'}
+    if row.x is None:
+        coords = sapi.get_coords(row.systemName, dbsession, address=row.systemAddress)
+        if 'error' in coords:
+            log.debug(f"No coordinates for {row.systemName}: {coords['error']}")
+            return {'name': row.systemName, 'x': 0, 'y': 0, 'z': 0, 'error': coords['error']}
+        row.x, row.y, row.z = float(coords['x']), float(coords['y']), float(coords['z'])
+    return _as_dict(row)
@@ -142,6 +142,11 @@ def populate_sidebar(request):
             'link': '/search',
             'icon': 'inline_svgs/itinerary.jinja2'
         },
+        {
+            'name': 'Commodity Search',
+            'link': '/search/commodity',
+            'icon': 'inline_svgs/commodities.jinja2'
+        },
         {
             'name': 'Galaxy Map',
             'link': '/galmap',
@@ -0,0 +1,121 @@
+# Process-local metrics, rendered in the Prometheus text exposition format by the /metrics view.
+import threading
+
+_lock = threading.Lock()
+_metrics = {}
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key, extra=None):
+    pairs = list(key) + (extra or [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self.values = {}
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield f'{self.name}{_format_labels(key)} {value}'
+
+    def render(self):
+        with _lock:
+            lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.kind}']
+            lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[_label_key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with _lock:
+            counts, total, n = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] = counts[i] + 1
+            self.values[key] = (counts, total + value, n + 1)
+
+    def samples(self):
+        for key, (counts, total, n) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield f'{self.name}_bucket{_format_labels(key, [("le", bound)])} {count}'
+            yield f'{self.name}_bucket{_format_labels(key, [("le", "+Inf")])} {n}'
+            yield f'{self.name}_sum{_format_labels(key)} {total}'
+            yield f'{self.name}_count{_format_labels(key)} {n}'
+
+
+def _register(cls, name, doc):
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = cls(name, doc)
+        return _metrics[name]
+
+
+def counter(name, doc):
+    """
+    Gets or creates a counter.
+    :param name: Metric name
+    :param doc: Help text
+    :return: A Counter
+    """
+    return _register(Counter, name, doc)
+
+
+def gauge(name, doc):
+    """
+    Gets or creates a gauge.
+    :param name: Metric name
+    :param doc: Help text
+    :return: A Gauge
+    """
+    return _register(Gauge, name, doc)
+
+
+def histogram(name, doc):
+    """
+    Gets or creates a histogram.
+    :param name: Metric name
+    :param doc: Help text
+    :return: A Histogram
+    """
+    return _register(Histogram, name, doc)
+
+
+def render():
+    """
+    Renders all metrics.
+    :return: Prometheus text format
+    """
+    with _lock:
+        metrics = [_metrics[name] for name in sorted(_metrics)]
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
@@ -0,0 +1,187 @@
+# Substring search on carrier names.
+# Carrier names are stored hex encoded, so the model keeps a decoded, normalized copy in searchName. On
+# PostgreSQL that column has a trigram GIN index, which serves LIKE '%term%' without a table scan. Other
+# databases get an in-process trigram index instead: a posting set of carrier IDs per trigram, so a
+# search only checks the carriers having every trigram of the term. It follows names changed in this
+# process as they commit, and is rebuilt every name_index_refresh seconds for changes made elsewhere.
+#
+# Either way results are ranked the same: exact matches, then names starting with the term, then names
+# with a word starting with it, then the rest; shorter names first within each.
+import threading
+import time
+
+from pyramid import threadlocal
+from sqlalchemy import case, event, func, inspect
+from sqlalchemy.orm import Session
+
+from ..models import Carrier
+from ..models.carrier import normalize_name, search_name
+import logging
+
+log = logging.getLogger(__name__)
+
+settings = threadlocal.get_current_registry().settings or {}
+refresh_interval = int(settings.get('name_index_refresh', 600))
+limit = int(settings.get('name_search_limit', 50))
+
+N = 3
+
+
+def ngrams(text):
+    return {text[i:i + N] for i in range(len(text) - N + 1)}
+
+
+def rank(name, term):
+    """
+    :return: A sort key putting better matches of term in name first
+    """
+    if name == term:
+        tier = 0
+    elif name.startswith(term):
+        tier = 1
+    elif f' {term}' in name:
+        tier = 2
+    else:
+        tier = 3
+    return tier, len(name), name
+
+
+class NgramIndex(object):
+    def __init__(self):
+        self.names = {}
+        self.grams = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def update(self, key, name):
+        """
+        Adds or renames an entry. An entry without a name is removed.
+        :param key: Entry ID (carrier ID)
+        :param name: Normalized name
+        """
+        with self.lock:
+            old = self.names.pop(key, None)
+            if old:
+                for gram in ngrams(old):
+                    keys = self.grams[gram]
+                    keys.discard(key)
+                    if not keys:
+                        del self.grams[gram]
+            if name:
+                self.names[key] = name
+                for gram in ngrams(name):
+                    self.grams.setdefault(gram, set()).add(key)
+
+    def search(self, term, count=None):
+        """
+        Finds names containing a term.
+        :param term: Normalized search term
+        :param count: Most results to return (default: all)
+        :return: A list of keys, best match first
+        """
+        with self.lock:
+            grams = ngrams(term)
+            if grams:
+                postings = sorted((self.grams.get(gram, set()) for gram in grams), key=len)
+                candidates = set(postings[0]).intersection(*postings[1:])
+            else:
+                # Too short to have a trigram; look at every name.
+                candidates = self.names
+            found = sorted((rank(self.names[key], term), key) for key in candidates if term in self.names[key])
+        return [key for score, key in found[:count]]
+
+
+_index = None
+_loaded_at = 0.0
+_state_lock = threading.Lock()
+
+
+def get_index(dbsession):
+    """
+    Gets this process' name index, (re)building it if there is none or it's due.
+    :param dbsession: Database session
+    :return: An NgramIndex of carrier IDs
+    """
+    global _index, _loaded_at
+    now = time.monotonic()
+    with _state_lock:
+        if _index is None or now - _loaded_at > refresh_interval:
+            start = time.monotonic()
+            index = NgramIndex()
+            for row in dbsession.query(Carrier.id, Carrier.searchName).filter(Carrier.searchName != None):
+                index.update(row.id, row.searchName)
+            _index, _loaded_at = index, now
+            log.info(f"Loaded {len(index)} carrier names into the name index in {time.monotonic() - start:.3f}s.")
+        return _index
+
+
+def _escape(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search(dbsession, term, count=None):
+    """
+    Finds carriers whose name contains a term, ignoring case and spacing.
+    :param dbsession: Database session
+    :param term: Search term
+    :param count: Most carriers to return (default: name_search_limit)
+    :return: A list of Carrier, best match first
+    """
+    term = normalize_name(term)
+    count = count or limit
+    if not term:
+        return []
+    if dbsession.bind.dialect.name == 'postgresql':
+        pattern = _escape(term)
+        tier = case([(Carrier.searchName == term, 0),
+                     (Carrier.searchName.like(f'{pattern}%', escape='\\'), 1),
+                     (Carrier.searchName.like(f'% {pattern}%', escape='\\'), 2)], else_=3)
+        return dbsession.query(Carrier).filter(Carrier.searchName.like(f'%{pattern}%', escape='\\')). \
+            order_by(tier, func.length(Carrier.searchName), Carrier.searchName, Carrier.id).limit(count).all()
+    keys = get_index(dbsession).search(term, count)
+    if not keys:
+        return []
+    carriers = {c.id: c for c in dbsession.query(Carrier).filter(Carrier.id.in_(keys))}
+    return [carriers[key] for key in keys if key in carriers]
+
+
+def fill_names(dbsession):
+    """
+    Fills in searchName for carriers saved before the column existed.
+    :param dbsession: Database session
+    :return: Number of carriers updated
+    """
+    count = 0
+    for row in dbsession.query(Carrier).filter(Carrier.searchName == None, Carrier.name != None):
+        row.searchName = search_name(row.name)
+        count = count + 1
+    return count
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect(session, context):
+    """
+    Notes carriers whose name was written, to apply once the transaction commits.
+    """
+    for obj in session.new | session.dirty:
+        if isinstance(obj, Carrier) and (obj in session.new or
+                                         inspect(obj).attrs.searchName.history.has_changes()):
+            session.info.setdefault('names_changed', {})[obj.id] = obj.searchName
+    for obj in session.deleted:
+        if isinstance(obj, Carrier):
+            session.info.setdefault('names_changed', {})[obj.id] = None
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply(session):
+    changed = session.info.pop('names_changed', None)
+    if changed and _index is not None:
+        for key, name in changed.items():
+            _index.update(key, name)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard(session):
+    session.info.pop('names_changed', None)
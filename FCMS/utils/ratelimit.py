@@ -0,0 +1,178 @@
+# Per-host token buckets for outbound HTTP, shared by every FCMS process on the machine.
+# Each bucket is a small state file (tokens, last refill) updated under an exclusive fcntl lock, so
+# waitress threads, job runners and scripts all draw from the same allowance. A caller that finds the
+# bucket empty reserves the next token and sleeps until it is due, which queues callers in order instead
+# of letting them all hit the host's limit at once. Callers that would wait longer than max_wait are
+# turned away, and the HTTP layer fails the request like any other connection error.
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from pyramid import threadlocal
+from pyramid.settings import aslist
+
+from . import metrics
+import logging
+
+try:
+    import fcntl
+except ImportError:
+    # No fcntl (Windows): buckets are only shared between threads of one process.
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+settings = threadlocal.get_current_registry().settings or {}
+state_dir = settings.get('ratelimit_dir') or os.path.join(tempfile.gettempdir(), 'fcms-ratelimit')
+max_wait = float(settings.get('ratelimit_max_wait', 10))
+
+STATE = struct.Struct('dd')
+
+waited = metrics.histogram('fcms_ratelimit_wait_seconds', 'Time outbound requests waited for a rate limit token')
+rejected = metrics.counter('fcms_ratelimit_rejected_total', 'Outbound requests turned away by the rate limiter')
+
+
+def parse_limits(lines):
+    """
+    Parses the ratelimit_hosts setting.
+    :param lines: Lines of "host rate burst", rate in requests per second
+    :return: A dict of host: (rate, burst)
+    """
+    limits = {}
+    for line in lines:
+        parts = line.split()
+        try:
+            host, rate, burst = parts[0], float(parts[1]), float(parts[2])
+        except (IndexError, ValueError):
+            log.error(f"Bad ratelimit_hosts line: {line}")
+            continue
+        if rate <= 0 or burst < 1:
+            log.error(f"Rate limit for {host} must allow at least one request.")
+            continue
+        limits[host] = (rate, burst)
+    return limits
+
+
+limits = parse_limits(aslist(settings.get('ratelimit_hosts', ''), flatten=False))
+
+
+class TokenBucket(object):
+    def __init__(self, path, rate, burst, clock=time.time):
+        """
+        :param path: State file shared by all processes using this bucket
+        :param rate: Tokens added per second
+        :param burst: Most tokens the bucket holds
+        :param clock: Time source, for tests. Must be comparable across processes.
+        """
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.lock = threading.Lock()
+
+    def _update(self, change):
+        """
+        Reads the bucket state, applies change(tokens, now) to it and writes back the result, all under
+        the file lock.
+        :return: Whatever change returned as its second value
+        """
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if fcntl:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                now = self.clock()
+                data = os.pread(fd, STATE.size, 0)
+                if len(data) == STATE.size:
+                    tokens, last = STATE.unpack(data)
+                    tokens = min(self.burst, tokens + max(0.0, now - last) * self.rate)
+                else:
+                    tokens = self.burst
+                tokens, result = change(tokens, now)
+                os.pwrite(fd, STATE.pack(tokens, now), 0)
+                return result
+            finally:
+                os.close(fd)
+
+    def reserve(self, max_wait=None):
+        """
+        Takes a token, reserving the next one to come in if the bucket is empty.
+        :param max_wait: Don't reserve a token further out than this many seconds
+        :return: Seconds to wait before using the token, or None if it would take too long
+        """
+        def take(tokens, now):
+            wait = max(0.0, (1 - tokens) / self.rate)
+            if max_wait is not None and wait > max_wait:
+                return tokens, None
+            return tokens - 1, wait
+        return self._update(take)
+
+    def acquire(self, max_wait=None):
+        """
+        Waits for a token.
+        :param max_wait: Give up if the token is more than this many seconds away
+        :return: Seconds waited, or None if turned away
+        """
+        wait = self.reserve(max_wait)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """
+        Empties the bucket for a while, e.g. when the host answers 429 with a Retry-After.
+        :param seconds: Seconds until the host should be asked again
+        """
+        self._update(lambda tokens, now: (min(tokens, -seconds * self.rate), None))
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_bucket(host):
+    """
+    Gets the bucket for a host, if it has a limit configured in ratelimit_hosts.
+    :param host: Host name (with port, if not the default)
+    :return: A TokenBucket, or None if the host isn't limited
+    """
+    if host not in limits:
+        return None
+    with _buckets_lock:
+        if host not in _buckets:
+            rate, burst = limits[host]
+            os.makedirs(state_dir, exist_ok=True)
+            _buckets[host] = TokenBucket(os.path.join(state_dir, host.replace(':', '_') + '.bucket'), rate, burst)
+        return _buckets[host]
+
+
+def acquire(host):
+    """
+    Waits for the host's rate limit, if it has one.
+    :param host: Host name
+    :return: False if the request should not be made
+    """
+    bucket = get_bucket(host)
+    if not bucket:
+        return True
+    wait = bucket.acquire(max_wait)
+    if wait is None:
+        rejected.inc(host=host)
+        log.warning(f"Rate limit for {host} would hold this request up more than {max_wait}s, giving up.")
+        return False
+    waited.observe(wait, host=host)
+    return True
+
+
+def pause(host, seconds):
+    """
+    Holds off requests to a host that told us to slow down.
+    :param host: Host name
+    :param seconds: Seconds to hold off for
+    """
+    bucket = get_bucket(host)
+    if bucket:
+        log.warning(f"{host} asked us to back off for {seconds}s.")
+        bucket.pause(seconds)
@@ -1,6 +1,32 @@
 # TFRM Systems API helper code.
+# Star coordinates never change, so lookups are cached for good: in a per-process LRU, and in the systems
+# table when the caller has a database session. Systems the API doesn't know are cached as misses for
+# systems_negative_ttl seconds, since new discoveries do show up eventually. With a galaxy dump loaded
+# by import_systems, the systems table answers nearly everything and the API is only a fallback.
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from urllib.parse import urljoin
+
 import requests
+from pyramid import threadlocal
+from sqlalchemy.exc import IntegrityError
+
+from . import http, systemdb
+from .id64 import approximate_coords
+from ..models import StarSystem
+import logging
+
+log = logging.getLogger(__name__)
+
+settings = threadlocal.get_current_registry().settings or {}
+sapiURL = settings.get('sapiURL') or 'https://systems.api.fuelrats.com/api/'
+cache_size = int(settings.get('systems_cache_size', 4096))
+negative_ttl = int(settings.get('systems_negative_ttl', 86400))
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
 
 
 def query_sapi(endpoint, filter, query, includes):
@@ -12,27 +38,232 @@ def query_sapi(endpoint, filter, query, includes):
     :param query: The query string
     :return: SAPI's JSON response.
     """
-    url = 'https://systems.api.fuelrats.com/api/'
+    url = sapiURL
     if endpoint not in ['systems', 'populated_systems']:
         return None
-    r = requests.get(urljoin(url, f"{endpoint}"), params={f'filter[{filter}]': f'{query}', 'include': f'{includes}'})
+    r = http.get(urljoin(url, f"{endpoint}"), params={f'filter[{filter}]': f'{query}', 'include': f'{includes}'})
     r.raise_for_status()
     return r.json()
 
 
-def get_system_by_name(system):
+def as_response(row):
+    """
+    Wraps a systems table row like a systems API response, for callers of get_system_by_*.
+    :param row: A StarSystem, or None
+    :return: A dict in the systems API's JSON:API shape
+    """
+    if not row:
+        return {'data': []}
+    return {'data': [{'id': str(row.id64), 'type': 'systems',
+                      'attributes': {'name': row.name, 'id64': row.id64,
+                                     'coords': {'x': row.x, 'y': row.y, 'z': row.z}}}]}
+
+
+def get_system_by_name(system, dbsession=None):
+    """
+    Finds a system by name, in the systems table if there is a session, else (or if it isn't there)
+    on the systems API.
+    :param system: System name
+    :param dbsession: Database session
+    :return: A systems API style response
+    """
+    if dbsession:
+        row = dbsession.query(StarSystem).filter(StarSystem.nameLower == system.strip().lower(),
+                                                 StarSystem.x != None).one_or_none()
+        if row:
+            return as_response(row)
     return query_sapi('systems', 'name:eq', system, '')
 
 
-def get_system_by_id(system):
+def find_by_id(id64, dbsession=None):
+    """
+    Finds a system's exact coordinates by id64 without going to the network: in the systems table if there
+    is a session, then in the coordinate array (which has no names).
+    :param id64: System id64
+    :param dbsession: Database session
+    :return: A StarSystem (name is None if it came from the array; not added to the session), or None
+    """
+    id64 = int(id64)
+    if dbsession:
+        row = dbsession.query(StarSystem).filter(StarSystem.id64 == id64, StarSystem.x != None).first()
+        if row:
+            return row
+    local = systemdb.find_coords(id64)
+    if local is not None and local[0][0]:
+        x, y, z = (float(c) for c in local[1][0])
+        return StarSystem(id64=id64, name=None, x=x, y=y, z=z)
+    return None
+
+
+def get_system_by_id(system, dbsession=None):
+    """
+    Finds a system by id64, locally (see find_by_id), or failing that on the systems API.
+    :param system: System id64
+    :param dbsession: Database session
+    :return: A systems API style response
+    """
+    row = find_by_id(system, dbsession)
+    if row:
+        return as_response(row)
     return query_sapi('systems', 'id64:eq', system, '')
 
 
-def get_coords(system):
-    if system:
-        sys = get_system_by_name(system)
-        if sys['data']:
-            return sys['data'][0]['attributes']['coords']
+def _cached(key):
+    with _cache_lock:
+        if key not in _cache:
+            return False, None
+        value, expires = _cache[key]
+        if expires and expires < time.monotonic():
+            del _cache[key]
+            return False, None
+        _cache.move_to_end(key)
+        return True, value
+
+
+def _remember(key, value):
+    with _cache_lock:
+        _cache[key] = (value, None if value else time.monotonic() + negative_ttl)
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+
+
+def _as_dict(row):
+    return {'name': row.name, 'id64': row.id64, 'x': row.x, 'y': row.y, 'z': row.z}
+
+
+def _store(dbsession, key, found):
+    """
+    Writes a remote lookup result to the systems table.
+    :param dbsession: Database session
+    :param key: Lower case system name
+    :param found: A system dict, or None for a miss
+    """
+    row = dbsession.query(StarSystem).filter(StarSystem.nameLower == key).one_or_none()
+    if not row:
+        row = StarSystem(nameLower=key)
+        try:
+            with dbsession.begin_nested():
+                dbsession.add(row)
+        except IntegrityError:
+            row = dbsession.query(StarSystem).filter(StarSystem.nameLower == key).one()
+    if found:
+        row.name, row.id64 = found['name'], found['id64']
+        row.x, row.y, row.z = found['x'], found['y'], found['z']
+    row.checkedAt = datetime.now()
+
+
+def lookup(system, dbsession=None):
+    """
+    Looks up a system by name, case insensitively. Tries the process cache, then the systems table, and
+    only asks the systems API if neither knows the system (or the table's miss has expired).
+    :param system: System name
+    :param dbsession: Database session, to use and fill the systems table
+    :return: A dict with name, id64, x, y and z, or None if the system is unknown
+    """
+    system = system.strip()
+    key = system.lower()
+    hit, value = _cached(key)
+    if hit:
+        return value
+    if dbsession:
+        row = dbsession.query(StarSystem).filter(StarSystem.nameLower == key).one_or_none()
+        if row and row.x is not None:
+            value = _as_dict(row)
+            _remember(key, value)
+            return value
+        if row and row.checkedAt and row.checkedAt > datetime.now() - timedelta(seconds=negative_ttl):
+            _remember(key, None)
+            return None
+    data = get_system_by_name(system)
+    value = None
+    if data['data']:
+        entry = data['data'][0]
+        coords = entry['attributes']['coords']
+        value = {'name': entry['attributes'].get('name', system), 'id64': int(entry['id']),
+                 'x': float(coords['x']), 'y': float(coords['y']), 'z': float(coords['z'])}
+    if dbsession:
+        _store(dbsession, key, value)
+    _remember(key, value)
+    return value
+
+
+def lookup_many(systems, dbsession, remote_limit=0):
+    """
+    Looks up many systems at once: what the process cache doesn't have is read from the systems table
+    in one query, and at most remote_limit of the remaining systems are asked for on the systems API.
+    :param systems: System names
+    :param dbsession: Database session
+    :param remote_limit: Most systems to look up remotely
+    :return: A dict of lower case name: system dict (or None if unknown or not looked up)
+    """
+    result = {}
+    wanted = set()
+    names = {}
+    for system in systems:
+        if not system:
+            continue
+        key = system.strip().lower()
+        hit, value = _cached(key)
+        if hit:
+            result[key] = value
         else:
-            return {'x': 0, 'y': 0, 'z': 0, 'error': 'Not found'}
-    return {'x': 0, 'y': 0, 'z': 0, 'error': 'No system provided'}
+            wanted.add(key)
+            names.setdefault(key, system.strip())
+    if wanted:
+        now = datetime.now()
+        for row in dbsession.query(StarSystem).filter(StarSystem.nameLower.in_(wanted)):
+            if row.x is not None:
+                result[row.nameLower] = _as_dict(row)
+                _remember(row.nameLower, result[row.nameLower])
+                wanted.discard(row.nameLower)
+            elif row.checkedAt and row.checkedAt > now - timedelta(seconds=negative_ttl):
+                result[row.nameLower] = None
+                _remember(row.nameLower, None)
+                wanted.discard(row.nameLower)
+    for count, key in enumerate(sorted(wanted)):
+        if count >= remote_limit:
+            result[key] = None
+            continue
+        try:
+            result[key] = lookup(names[key], dbsession)
+        except (requests.RequestException, ValueError, KeyError) as e:
+            log.warning(f"Systems API lookup for {key} failed: {e}")
+            result[key] = None
+    return result
+
+
+def coords_by_id(id64, dbsession=None):
+    """
+    Gets a system's coordinates by id64 without going to the network: found locally (see find_by_id), or
+    failing that, from the boxel encoded in the id64 itself.
+    :param id64: System id64 (SystemAddress)
+    :param dbsession: Database session
+    :return: A dict of x, y and z. Approximate coordinates also have approximate and accuracy (ly) keys.
+    """
+    row = find_by_id(id64, dbsession)
+    if row:
+        return {'x': row.x, 'y': row.y, 'z': row.z}
+    return approximate_coords(int(id64))
+
+
+def get_coords(system, dbsession=None, address=None):
+    """
+    Gets a system's coordinates.
+    :param system: System name
+    :param dbsession: Database session, to use and fill the systems table
+    :param address: The system's id64, if known, to fall back on (see coords_by_id) when the name can't be found
+    :return: A dict of x, y and z, with an error key (and zeroes) if the system couldn't be found
+    """
+    found, error = None, 'No system provided'
+    if system:
+        try:
+            found = lookup(system, dbsession)
+            error = 'Not found'
+        except (requests.RequestException, ValueError, KeyError) as e:
+            log.warning(f"Systems API lookup for {system} failed: {e}")
+            error = 'Lookup failed'
+    if found:
+        return {'x': found['x'], 'y': found['y'], 'z': found['z']}
+    if address:
+        return coords_by_id(address, dbsession)
+    return {'x': 0, 'y': 0, 'z': 0, 'error': error}
@@ -0,0 +1,145 @@
+# Content-addressed store for raw CAPI payloads.
+# Payloads are zlib compressed and kept once per sha256; every fetch adds a cheap reference row, so
+# an unchanged carrier costs a few bytes per refresh and the fetch history stays around for debugging.
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from pyramid import threadlocal
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from ..models import Snapshot, SnapshotBlob
+from .jsonscan import LazyJSON
+import logging
+
+log = logging.getLogger(__name__)
+
+settings = threadlocal.get_current_registry().settings or {}
+compression_level = int(settings.get('snapshot_compression', 6))
+cache_size = int(settings.get('snapshot_cache_size', 64))
+keep_days = int(settings.get('snapshot_keep_days', 30))
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def content_hash(raw):
+    """
+    :param raw: Payload as str or bytes
+    :return: The payload's hex sha256
+    """
+    if isinstance(raw, str):
+        raw = raw.encode('utf8')
+    return hashlib.sha256(raw).hexdigest()
+
+
+def store(dbsession, endpoint, raw, carrier_id=None, user_id=None, fetched_at=None):
+    """
+    Records a CAPI fetch, storing the payload only if we haven't seen it before.
+    :param dbsession: Database session
+    :param endpoint: CAPI endpoint the payload came from
+    :param raw: Payload as str or bytes
+    :param carrier_id: Carrier the payload belongs to
+    :param user_id: User the payload was fetched for
+    :param fetched_at: Fetch time (default: now)
+    :return: The new Snapshot
+    """
+    if isinstance(raw, str):
+        raw = raw.encode('utf8')
+    sha = content_hash(raw)
+    blob = dbsession.query(SnapshotBlob).filter(SnapshotBlob.sha256 == sha).one_or_none()
+    if not blob:
+        blob = SnapshotBlob(sha256=sha, data=zlib.compress(raw, compression_level), size=len(raw),
+                            createdAt=datetime.now())
+        try:
+            with dbsession.begin_nested():
+                dbsession.add(blob)
+        except IntegrityError:
+            # Someone else stored the same payload in the meantime.
+            blob = dbsession.query(SnapshotBlob).filter(SnapshotBlob.sha256 == sha).one()
+    snapshot = Snapshot(blob_id=blob.id, endpoint=endpoint, carrier_id=carrier_id, user_id=user_id,
+                        fetchedAt=fetched_at or datetime.now())
+    dbsession.add(snapshot)
+    dbsession.flush()
+    return snapshot
+
+
+def latest(dbsession, endpoint, carrier_id=None, user_id=None):
+    """
+    Finds the most recent fetch of an endpoint for a carrier or user.
+    :param dbsession: Database session
+    :param endpoint: CAPI endpoint
+    :param carrier_id: Carrier ID
+    :param user_id: User ID (used if no carrier ID is given)
+    :return: A (sha256, fetchedAt) row, or None
+    """
+    query = dbsession.query(SnapshotBlob.sha256, Snapshot.fetchedAt). \
+        join(Snapshot, Snapshot.blob_id == SnapshotBlob.id)
+    if carrier_id is not None:
+        query = query.filter(Snapshot.carrier_id == carrier_id)
+    else:
+        query = query.filter(Snapshot.user_id == user_id)
+    return query.filter(Snapshot.endpoint == endpoint). \
+        order_by(Snapshot.fetchedAt.desc(), Snapshot.id.desc()).first()
+
+
+def load(dbsession, sha):
+    """
+    Decodes a payload, from the process-local LRU cache if we've seen it recently. Payloads are
+    immutable per hash, so cached entries never go stale.
+    :param dbsession: Database session
+    :param sha: Payload sha256
+    :return: A LazyJSON, or None
+    """
+    with _cache_lock:
+        if sha in _cache:
+            _cache.move_to_end(sha)
+            return _cache[sha]
+    blob = dbsession.query(SnapshotBlob.data).filter(SnapshotBlob.sha256 == sha).one_or_none()
+    if not blob:
+        return None
+    payload = LazyJSON(zlib.decompress(blob.data))
+    with _cache_lock:
+        _cache[sha] = payload
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    return payload
+
+
+def latest_payload(dbsession, endpoint, carrier_id=None, user_id=None, max_age=None):
+    """
+    Loads the most recent payload of an endpoint for a carrier or user.
+    :param dbsession: Database session
+    :param endpoint: CAPI endpoint
+    :param carrier_id: Carrier ID
+    :param user_id: User ID (used if no carrier ID is given)
+    :param max_age: Ignore fetches older than this many seconds
+    :return: A LazyJSON, or None
+    """
+    row = latest(dbsession, endpoint, carrier_id=carrier_id, user_id=user_id)
+    if not row:
+        return None
+    if max_age is not None and row.fetchedAt < datetime.now() - timedelta(seconds=max_age):
+        return None
+    return load(dbsession, row.sha256)
+
+
+def prune(dbsession, days=None):
+    """
+    Drops fetch history older than the retention period, keeping the newest fetch of every carrier
+    and user, then drops payloads nothing refers to any more.
+    :param dbsession: Database session
+    :param days: Days of history to keep (default: snapshot_keep_days)
+    :return: A tuple of (snapshots, blobs) deleted
+    """
+    cutoff = datetime.now() - timedelta(days=days if days is not None else keep_days)
+    newest = dbsession.query(func.max(Snapshot.id)).group_by(Snapshot.endpoint, Snapshot.carrier_id,
+                                                             Snapshot.user_id)
+    snapshots = dbsession.query(Snapshot).filter(Snapshot.fetchedAt < cutoff, ~Snapshot.id.in_(newest)). \
+        delete(synchronize_session=False)
+    used = dbsession.query(Snapshot.blob_id).distinct()
+    blobs = dbsession.query(SnapshotBlob).filter(~SnapshotBlob.id.in_(used)).delete(synchronize_session=False)
+    return snapshots, blobs
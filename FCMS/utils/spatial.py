@@ -0,0 +1,408 @@
+# In-memory spatial index of carrier positions, for the nearest-carrier searches.
+# Carriers are bucketed in a uniform grid of spatial_cell_size ly cubes. A nearest-k query walks outward
+# from the query point's cell one shell of cells at a time and stops once it has k carriers closer than
+# any unvisited cell could hold, so it only looks at the carriers around the point. Sparse regions (where
+# the shells would pass more empty cells than there are occupied ones) fall back to scanning the
+# occupied cells.
+#
+# Each process keeps its own index. Carriers moved in this process (update_carrier, process_eddn) are
+# applied once their transaction commits. Moves made by other processes (the EDDN client) are picked up
+# by a delta sync on searchUpdated every spatial_sync seconds, and the index is rebuilt from scratch every
+# spatial_refresh seconds as a backstop.
+#
+# With spatial_memory_index off, searches go to the database instead: carriers are filed under the grid
+# cell columns (cellX, cellY, cellZ, kept up to date by the Carrier model), and a search reads rings of
+# cells around the point through the cell index, doubling the ring each round, then ranks what it found
+# by exact distance. Later pages start at the first ring that can hold anything after the cursor.
+import heapq
+import math
+import threading
+import time
+from datetime import timedelta
+
+from pyramid import threadlocal
+from sqlalchemy import and_, event, func, inspect, not_, or_
+from sqlalchemy.orm import Session
+
+from ..models import Carrier
+from ..models.carrier import GRID_CELL, SEARCH_COLUMNS, grid_cell
+import logging
+
+log = logging.getLogger(__name__)
+
+settings = threadlocal.get_current_registry().settings or {}
+cell_size = float(settings.get('spatial_cell_size', 500))
+sync_interval = int(settings.get('spatial_sync', 15))
+refresh_interval = int(settings.get('spatial_refresh', 300))
+sync_slack = int(settings.get('spatial_sync_slack', 600))
+memory_index = settings.get('spatial_memory_index', 'true').lower() in ('true', 'yes', 'on', '1')
+
+
+class GridIndex(object):
+    def __init__(self, cell_size=500.0):
+        """
+        :param cell_size: Grid cell edge length in ly
+        """
+        self.cell_size = cell_size
+        self.cells = {}
+        self.points = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.points)
+
+    def cell(self, x, y, z):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size), math.floor(z / self.cell_size))
+
+    def update(self, key, x, y, z, data=None):
+        """
+        Adds or moves a point. A point without coordinates is removed.
+        :param key: Point ID (carrier ID)
+        :param x: X coordinate
+        :param y: Y coordinate
+        :param z: Z coordinate
+        :param data: Anything to keep with the point, for query predicates
+        """
+        with self.lock:
+            self.remove(key)
+            if x is None or y is None or z is None:
+                return
+            x, y, z = float(x), float(y), float(z)
+            cell = self.cell(x, y, z)
+            self.cells.setdefault(cell, set()).add(key)
+            self.points[key] = (x, y, z, data, cell)
+
+    def remove(self, key):
+        with self.lock:
+            point = self.points.pop(key, None)
+            if point:
+                members = self.cells[point[4]]
+                members.discard(key)
+                if not members:
+                    del self.cells[point[4]]
+
+    def _shell(self, centre, r):
+        """
+        Lists the occupied cells at Chebyshev distance r from a cell.
+        """
+        cx, cy, cz = centre
+        if r == 0:
+            return [centre] if centre in self.cells else []
+        found = []
+        for dx in range(-r, r + 1):
+            for dy in range(-r, r + 1):
+                if abs(dx) == r or abs(dy) == r:
+                    dzs = range(-r, r + 1)
+                else:
+                    dzs = (-r, r)
+                for dz in dzs:
+                    cell = (cx + dx, cy + dy, cz + dz)
+                    if cell in self.cells:
+                        found.append(cell)
+        return found
+
+    def _candidates(self, cells, point, predicate, after=None):
+        px, py, pz = point
+        for cell in cells:
+            for key in self.cells[cell]:
+                x, y, z, data, _ = self.points[key]
+                if predicate and not predicate(data):
+                    continue
+                entry = math.sqrt((x - px) ** 2 + (y - py) ** 2 + (z - pz) ** 2), key
+                if after is None or entry > after:
+                    yield entry
+
+    def nearest(self, point, k=None, predicate=None, max_distance=None, after=None):
+        """
+        Finds the points closest to a point.
+        :param point: (x, y, z)
+        :param k: Most points to return (default: all)
+        :param predicate: Only consider points for which predicate(data) is true
+        :param max_distance: Ignore points further away than this
+        :param after: Only return points ordered after this (distance, key), to page through results
+        :return: A list of (distance, key), closest first
+        """
+        point = tuple(float(c) for c in point)
+        with self.lock:
+            if k is None:
+                found = list(self._candidates(list(self.cells), point, predicate, after))
+            else:
+                centre = self.cell(*point)
+                heap = []
+                r = 0
+                if after is not None:
+                    # Every point in a cell r cells away is within (r + 1) * sqrt(3) cell sizes, so the
+                    # shells closer than that can't hold anything after the cursor.
+                    r = max(0, int(after[0] // (self.cell_size * math.sqrt(3))) - 1)
+                while True:
+                    if (2 * r + 1) ** 3 > 2 * len(self.cells):
+                        # Sparse: cheaper to look at every occupied cell we haven't covered yet.
+                        rest = [cell for cell in self.cells if
+                                max(abs(a - b) for a, b in zip(cell, centre)) >= r]
+                        self._push(heap, self._candidates(rest, point, predicate, after), k)
+                        break
+                    self._push(heap, self._candidates(self._shell(centre, r), point, predicate, after), k)
+                    # Everything within r cells of the point's cell has been seen, and any point in an
+                    # unvisited cell is at least r cell sizes away.
+                    covered = r * self.cell_size
+                    if len(heap) >= k and -heap[0][0] <= covered:
+                        break
+                    if max_distance is not None and covered > max_distance:
+                        break
+                    r = r + 1
+                found = [(-dist, key) for dist, key in heap]
+        if max_distance is not None:
+            found = [entry for entry in found if entry[0] <= max_distance]
+        found.sort()
+        return found[:k] if k is not None else found
+
+    @staticmethod
+    def _push(heap, candidates, k):
+        for dist, key in candidates:
+            if len(heap) < k:
+                heapq.heappush(heap, (-dist, key))
+            elif dist < -heap[0][0]:
+                heapq.heapreplace(heap, (-dist, key))
+
+    def within(self, point, radius, predicate=None):
+        """
+        Finds the points within a radius of a point.
+        :param point: (x, y, z)
+        :param radius: Radius in ly
+        :param predicate: Only consider points for which predicate(data) is true
+        :return: A list of (distance, key), closest first
+        """
+        point = tuple(float(c) for c in point)
+        with self.lock:
+            centre = self.cell(*point)
+            reach = int(math.ceil(radius / self.cell_size))
+            if (2 * reach + 1) ** 3 > len(self.cells):
+                cells = [cell for cell in self.cells if max(abs(a - b) for a, b in zip(cell, centre)) <= reach]
+            else:
+                cells = [cell for r in range(reach + 1) for cell in self._shell(centre, r)]
+            found = [entry for entry in self._candidates(cells, point, predicate) if entry[0] <= radius]
+        found.sort()
+        return found
+
+
+def flags(showSearch, isDSSA):
+    """
+    :return: The data kept with each carrier in the index
+    """
+    return {'search': showSearch is not False, 'dssa': bool(isDSSA)}
+
+
+def searchable(data):
+    return data['search']
+
+
+def dssa(data):
+    return data['dssa']
+
+
+_index = None
+_loaded_at = 0.0
+_synced_at = 0.0
+_watermark = None
+_state_lock = threading.Lock()
+
+
+def _load(dbsession):
+    index = GridIndex(cell_size)
+    watermark = None
+    for row in dbsession.query(Carrier.id, Carrier.x, Carrier.y, Carrier.z, Carrier.showSearch, Carrier.isDSSA,
+                               Carrier.searchUpdated):
+        index.update(row.id, row.x, row.y, row.z, flags(row.showSearch, row.isDSSA))
+        if row.searchUpdated and (not watermark or row.searchUpdated > watermark):
+            watermark = row.searchUpdated
+    return index, watermark
+
+
+def _sync(dbsession):
+    """
+    Applies carriers changed since the last sync, by other processes too.
+    """
+    global _watermark
+    query = dbsession.query(Carrier.id, Carrier.x, Carrier.y, Carrier.z, Carrier.showSearch, Carrier.isDSSA,
+                            Carrier.searchUpdated)
+    if _watermark:
+        # searchUpdated is stamped before commit, so look back a bit for transactions that committed late.
+        query = query.filter(Carrier.searchUpdated > _watermark - timedelta(seconds=sync_slack))
+    count = 0
+    for row in query:
+        _index.update(row.id, row.x, row.y, row.z, flags(row.showSearch, row.isDSSA))
+        if row.searchUpdated and (not _watermark or row.searchUpdated > _watermark):
+            _watermark = row.searchUpdated
+        count = count + 1
+    log.debug(f"Spatial index delta sync applied {count} carriers.")
+
+
+def get_index(dbsession):
+    """
+    Gets this process' carrier index, loading, syncing or rebuilding it as needed.
+    :param dbsession: Database session
+    :return: A GridIndex of carrier IDs
+    """
+    global _index, _loaded_at, _synced_at, _watermark
+    now = time.monotonic()
+    with _state_lock:
+        if _index is None or now - _loaded_at > refresh_interval:
+            start = time.monotonic()
+            _index, _watermark = _load(dbsession)
+            _loaded_at = _synced_at = now
+            log.info(f"Loaded {len(_index)} carriers into the spatial index in {time.monotonic() - start:.3f}s.")
+        elif now - _synced_at > sync_interval:
+            _sync(dbsession)
+            _synced_at = now
+        return _index
+
+
+# The SQL equivalents of the predicates, for nearest_sql.
+FILTERS = {
+    searchable: or_(Carrier.showSearch == None, Carrier.showSearch == True),
+    dssa: Carrier.isDSSA == True,
+}
+
+
+def _cube(centre, r):
+    cx, cy, cz = centre
+    return and_(Carrier.cellX.between(cx - r, cx + r), Carrier.cellY.between(cy - r, cy + r),
+                Carrier.cellZ.between(cz - r, cz + r))
+
+
+def nearest_sql(dbsession, point, k=None, predicate=searchable, after=None):
+    """
+    Finds the carriers closest to a point in the database, reading the cells around the point through the
+    cell index.
+    :param dbsession: Database session
+    :param point: (x, y, z)
+    :param k: Most carriers to return (default: all)
+    :param predicate: Which carriers to consider, one of the FILTERS keys
+    :param after: Only return carriers ordered after this (distance, carrier ID)
+    :return: A list of (distance, Carrier), closest first
+    """
+    px, py, pz = (float(c) for c in point)
+    query = dbsession.query(Carrier).filter(Carrier.cellX != None)
+    if predicate:
+        query = query.filter(FILTERS[predicate])
+
+    def ranked(rows):
+        found = [(math.sqrt((row.x - px) ** 2 + (row.y - py) ** 2 + (row.z - pz) ** 2), row) for row in rows]
+        return [(dist, row) for dist, row in found if after is None or (dist, row.id) > after]
+
+    if k is None:
+        found = ranked(query)
+    else:
+        centre = grid_cell(px, py, pz)
+        extent = query.with_entities(func.min(Carrier.cellX), func.max(Carrier.cellX), func.min(Carrier.cellY),
+                                     func.max(Carrier.cellY), func.min(Carrier.cellZ), func.max(Carrier.cellZ)).one()
+        if extent[0] is None:
+            return []
+        # The ring that takes in every carrier there is.
+        reach = max(abs(centre[axis] - extent[axis * 2 + end]) for axis in range(3) for end in range(2))
+        start = 0
+        if after is not None:
+            # As in GridIndex.nearest: every carrier r cells away is within (r + 1) * sqrt(3) cell sizes, so
+            # the rings closer than that can't hold anything after the cursor.
+            start = max(0, int(after[0] // (GRID_CELL * math.sqrt(3))) - 1)
+        if start:
+            found = ranked(query.filter(_cube(centre, start), not_(_cube(centre, start - 1))))
+        else:
+            found = ranked(query.filter(_cube(centre, 0)))
+        inner, r = start, max(1, start * 2)
+        while inner < reach:
+            found.extend(ranked(query.filter(_cube(centre, r), not_(_cube(centre, inner)))))
+            # Anything outside the cube read so far is at least r cells from the point.
+            if len(found) >= k and sorted(dist for dist, row in found)[k - 1] <= r * GRID_CELL:
+                break
+            inner, r = r, r * 2
+    found.sort(key=lambda entry: (entry[0], entry[1].id))
+    return found[:k] if k is not None else found
+
+
+def nearest_carriers(dbsession, point, k=None, predicate=searchable, after=None):
+    """
+    Finds the carriers closest to a point.
+    :param dbsession: Database session
+    :param point: (x, y, z)
+    :param k: Most carriers to return (default: all)
+    :param predicate: Which carriers to consider (default: those shown in search)
+    :param after: Only return carriers ordered after this (distance, carrier ID), for the next page
+    :return: A list of (distance, Carrier), closest first, ties by carrier ID
+    """
+    if not memory_index:
+        return nearest_sql(dbsession, point, k, predicate, after)
+    found = get_index(dbsession).nearest(point, k, predicate, after=after)
+    if not found:
+        return []
+    carriers = {c.id: c for c in dbsession.query(Carrier).filter(Carrier.id.in_([key for dist, key in found]))}
+    return [(dist, carriers[key]) for dist, key in found if key in carriers]
+
+
+def positions(dbsession, keys, predicate=searchable):
+    """
+    Gets the positions of some carriers, from this process' index or, with spatial_memory_index off, from
+    the database.
+    :param dbsession: Database session
+    :param keys: Carrier IDs
+    :param predicate: Which carriers to include, one of the FILTERS keys
+    :return: A dict of carrier ID: (x, y, z), for the carriers with a position
+    """
+    if memory_index:
+        index = get_index(dbsession)
+        with index.lock:
+            points = [(key, index.points.get(key)) for key in keys]
+        return {key: point[:3] for key, point in points if point and (not predicate or predicate(point[3]))}
+    keys = list(keys)
+    found = {}
+    for start in range(0, len(keys), 1000):
+        query = dbsession.query(Carrier.id, Carrier.x, Carrier.y, Carrier.z). \
+            filter(Carrier.id.in_(keys[start:start + 1000]), Carrier.x != None, Carrier.y != None, Carrier.z != None)
+        if predicate:
+            query = query.filter(FILTERS[predicate])
+        found.update((row.id, (row.x, row.y, row.z)) for row in query)
+    return found
+
+
+def fill_cells(dbsession):
+    """
+    Files carriers saved before the cell columns existed under their grid cells.
+    :param dbsession: Database session
+    :return: Number of carriers updated
+    """
+    count = 0
+    for row in dbsession.query(Carrier).filter(Carrier.cellX == None, Carrier.x != None):
+        row.cellX, row.cellY, row.cellZ = grid_cell(row.x, row.y, row.z)
+        count = count + 1
+    return count
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect(session, context):
+    """
+    Notes carriers whose position or search flags were written, to apply once the transaction commits.
+    """
+    moved = None
+    for obj in session.new | session.dirty:
+        if not isinstance(obj, Carrier):
+            continue
+        state = inspect(obj)
+        if obj in session.new or any(state.attrs[name].history.has_changes() for name in SEARCH_COLUMNS):
+            moved = moved if moved is not None else session.info.setdefault('spatial_moved', {})
+            moved[obj.id] = (obj.x, obj.y, obj.z, flags(obj.showSearch, obj.isDSSA))
+    for obj in session.deleted:
+        if isinstance(obj, Carrier):
+            session.info.setdefault('spatial_moved', {})[obj.id] = (None, None, None, None)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply(session):
+    moved = session.info.pop('spatial_moved', None)
+    if moved and _index is not None:
+        for key, (x, y, z, data) in moved.items():
+            _index.update(key, x, y, z, data)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard(session):
+    session.info.pop('spatial_moved', None)
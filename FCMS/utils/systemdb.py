@@ -0,0 +1,227 @@
+# Offline star system database.
+# The import_systems script streams a galaxy dump (gzipped or not; NDJSON as published by Spansh and EDSM,
+# or CSV of name, id64, x, y, z) into the systems table, which sapi reads before asking the systems API.
+# It also writes a coordinate array (id64 and x, y, z as float32, sorted by id64) that is memory mapped
+# by every process, so coordinates by id64 cost a binary search and no database round trip.
+import csv
+import gzip
+import io
+import json
+import threading
+from array import array
+from datetime import datetime
+
+import numpy
+from pyramid import threadlocal
+from sqlalchemy import bindparam
+
+from ..models import StarSystem
+import logging
+
+log = logging.getLogger(__name__)
+
+settings = threadlocal.get_current_registry().settings or {}
+coords_path = settings.get('systems_coords_path')
+
+COORD_DTYPE = numpy.dtype([('id64', '<u8'), ('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+
+_coords = None
+_coords_lock = threading.Lock()
+
+
+def open_dump(path):
+    """
+    Opens a dump file for reading as text, decompressing .gz files on the fly.
+    :param path: File path
+    :return: A text stream
+    """
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, 'rb'), encoding='utf8')
+    return open(path, encoding='utf8')
+
+
+def parse_ndjson(stream):
+    """
+    Reads systems from NDJSON. Also takes EDSM style dumps, which are one big JSON array with one system
+    per line.
+    :param stream: A text stream
+    :return: An iterator of (id64, name, x, y, z)
+    """
+    for line in stream:
+        line = line.strip().rstrip(',')
+        if not line or line in ('[', ']'):
+            continue
+        entry = json.loads(line)
+        coords = entry.get('coords') or entry
+        try:
+            yield int(entry['id64']), entry['name'], float(coords['x']), float(coords['y']), float(coords['z'])
+        except (KeyError, TypeError, ValueError):
+            log.debug(f"Skipping system without id64 or coordinates: {line[:100]}")
+
+
+def parse_csv(stream):
+    """
+    Reads systems from CSV with a header row naming the name, id64, x, y and z columns.
+    :param stream: A text stream
+    :return: An iterator of (id64, name, x, y, z)
+    """
+    for entry in csv.DictReader(stream):
+        try:
+            yield int(entry['id64']), entry['name'], float(entry['x']), float(entry['y']), float(entry['z'])
+        except (KeyError, TypeError, ValueError):
+            log.debug(f"Skipping bad CSV row: {entry}")
+
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _copy_batch(dbsession, batch, now):
+    """
+    Loads a batch through COPY into a staging table, then merges it into systems. PostgreSQL only.
+    """
+    cursor = dbsession.connection().connection.cursor()
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS systems_import '
+                   '(id64 bigint, name text, x double precision, y double precision, z double precision)')
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerows(batch)
+    buf.seek(0)
+    cursor.copy_expert('COPY systems_import (id64, name, x, y, z) FROM STDIN WITH (FORMAT csv)', buf)
+    # A dump can name a system twice; ON CONFLICT can't touch the same row twice in one statement.
+    cursor.execute('INSERT INTO systems (id64, name, "nameLower", x, y, z, "checkedAt") '
+                   'SELECT DISTINCT ON (lower(name)) id64, name, lower(name), x, y, z, %s FROM systems_import '
+                   'ON CONFLICT ("nameLower") DO UPDATE SET id64 = excluded.id64, name = excluded.name, '
+                   'x = excluded.x, y = excluded.y, z = excluded.z, "checkedAt" = excluded."checkedAt"', (now,))
+    cursor.execute('TRUNCATE systems_import')
+
+
+def _executemany_batch(dbsession, batch, now):
+    """
+    Loads a batch with executemany, updating systems we already have. For databases without COPY.
+    """
+    rows = {}
+    for id64, name, x, y, z in batch:
+        rows[name.lower()] = {'id64': id64, 'name': name, 'key': name.lower(), 'x': x, 'y': y, 'z': z,
+                              'checkedAt': now}
+    table = StarSystem.__table__
+    existing = {key for key, in dbsession.query(StarSystem.nameLower).filter(StarSystem.nameLower.in_(rows))}
+    updates = [row for key, row in rows.items() if key in existing]
+    inserts = [row for key, row in rows.items() if key not in existing]
+    if updates:
+        dbsession.execute(table.update().where(table.c.nameLower == bindparam('key')).
+                          values(id64=bindparam('id64'), name=bindparam('name'), x=bindparam('x'),
+                                 y=bindparam('y'), z=bindparam('z'), checkedAt=bindparam('checkedAt')), updates)
+    if inserts:
+        dbsession.execute(table.insert().values(nameLower=bindparam('key')), inserts)
+
+
+def load(dbsession, rows, batch_size=10000, commit=None, coords=None):
+    """
+    Bulk loads systems into the systems table.
+    :param dbsession: Database session
+    :param rows: An iterable of (id64, name, x, y, z)
+    :param batch_size: Rows per batch
+    :param commit: Called after each batch, e.g. to commit the transaction
+    :param coords: A CoordBuilder to feed, if building the coordinate array too
+    :return: Number of rows read
+    """
+    now = datetime.now()
+    copy = dbsession.bind.dialect.name == 'postgresql'
+    count = 0
+    for batch in batches(rows, batch_size):
+        if copy:
+            _copy_batch(dbsession, batch, now)
+        else:
+            _executemany_batch(dbsession, batch, now)
+        if coords:
+            coords.extend(batch)
+        count = count + len(batch)
+        if commit:
+            commit()
+        log.info(f"Loaded {count} systems.")
+    return count
+
+
+class CoordBuilder(object):
+    """
+    Collects coordinates in compact arrays while a dump streams past, then writes them out sorted.
+    """
+    def __init__(self):
+        self.ids = array('Q')
+        self.xyz = array('f')
+
+    def extend(self, batch):
+        for id64, name, x, y, z in batch:
+            self.ids.append(id64)
+            self.xyz.extend((x, y, z))
+
+    def build(self):
+        """
+        :return: A structured numpy array of COORD_DTYPE, sorted by id64, without duplicate id64s
+        """
+        ids = numpy.frombuffer(self.ids, dtype='<u8')
+        xyz = numpy.frombuffer(self.xyz, dtype='<f4').reshape(-1, 3)
+        # Stable sort, so the last occurrence of a duplicate id64 wins below.
+        order = numpy.argsort(ids, kind='stable')
+        ids, xyz = ids[order], xyz[order]
+        keep = numpy.append(ids[1:] != ids[:-1], True) if len(ids) else numpy.zeros(0, dtype=bool)
+        result = numpy.empty(int(keep.sum()), dtype=COORD_DTYPE)
+        result['id64'] = ids[keep]
+        result['x'], result['y'], result['z'] = xyz[keep].T
+        return result
+
+    def save(self, path):
+        """
+        Writes the coordinate array as a .npy file.
+        :param path: File path
+        :return: Number of systems written
+        """
+        result = self.build()
+        numpy.save(path, result)
+        return len(result)
+
+
+def get_coord_array():
+    """
+    Memory maps the coordinate array written by import_systems, if systems_coords_path is set.
+    :return: A structured numpy array sorted by id64, or None
+    """
+    global _coords
+    if _coords is None and coords_path:
+        with _coords_lock:
+            if _coords is None:
+                try:
+                    _coords = numpy.load(coords_path, mmap_mode='r')
+                except (OSError, ValueError) as e:
+                    log.error(f"Can't load system coordinates from {coords_path}: {e}")
+                    _coords = False
+    return _coords if _coords is not False else None
+
+
+def find_coords(id64s, coords=None):
+    """
+    Looks up coordinates by id64 in the coordinate array.
+    :param id64s: An id64 or array of id64s
+    :param coords: Coordinate array (default: the one at systems_coords_path)
+    :return: A tuple of (found mask, N x 3 float array), or None if there's no coordinate array
+    """
+    coords = coords if coords is not None else get_coord_array()
+    if coords is None:
+        return None
+    wanted = numpy.atleast_1d(numpy.asarray(id64s, dtype='<u8'))
+    pos = numpy.searchsorted(coords['id64'], wanted)
+    pos = numpy.minimum(pos, max(len(coords) - 1, 0))
+    found = coords['id64'][pos] == wanted if len(coords) else numpy.zeros(len(wanted), dtype=bool)
+    xyz = numpy.zeros((len(wanted), 3), dtype='<f4')
+    if len(coords):
+        hits = coords[pos[found]]
+        xyz[found] = numpy.column_stack((hits['x'], hits['y'], hits['z']))
+    return found, xyz
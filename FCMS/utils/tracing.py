@@ -0,0 +1,130 @@
+# Lightweight tracing of carrier refreshes.
+# A trace times a whole operation (a carrier refresh) and the spans inside it (token refresh, CAPI fetch,
+# decoding, coordinate lookup, each table rewrite), and collects attributes such as row counts along the
+# way. Finished traces are logged as one JSON record on the FCMS.trace logger; a sample of them is kept,
+# plus every trace slower than trace_slow. Span timings always go to the metrics endpoint.
+import functools
+import json
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+from pyramid import threadlocal
+
+from . import metrics
+import logging
+
+log = logging.getLogger(__name__)
+trace_log = logging.getLogger('FCMS.trace')
+
+settings = threadlocal.get_current_registry().settings or {}
+sample_rate = float(settings.get('trace_sample_rate', 0.1))
+slow_threshold = float(settings.get('trace_slow', 10))
+
+span_seconds = metrics.histogram('fcms_trace_span_seconds', 'Time spent in each traced stage')
+
+_local = threading.local()
+
+
+class Trace(object):
+    def __init__(self, name, attrs):
+        self.name = name
+        self.id = uuid.uuid4().hex[:16]
+        self.started = datetime.now()
+        self.start = time.perf_counter()
+        self.attrs = dict(attrs)
+        self.spans = []
+        self.stack = []
+
+    def record(self):
+        """
+        :return: The trace as a JSON serializable dict
+        """
+        return {'trace': self.name, 'id': self.id, 'started': self.started.isoformat(),
+                'duration_ms': round((time.perf_counter() - self.start) * 1000, 2),
+                'spans': self.spans, 'attrs': self.attrs}
+
+
+def current():
+    """
+    :return: The Trace active in this thread, or None
+    """
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def span(name):
+    """
+    Times a stage of the current trace. Spans nest, and are named by their path (fetch.token_refresh).
+    Only feeds the metrics if no trace is active.
+    :param name: Stage name
+    """
+    trace = current()
+    path = name
+    if trace:
+        trace.stack.append(name)
+        path = '.'.join(trace.stack)
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        span_seconds.observe(elapsed, trace=trace.name if trace else 'untraced', span=path)
+        if trace:
+            trace.stack.pop()
+            entry = {'name': path, 'offset_ms': round((start - trace.start) * 1000, 2),
+                     'duration_ms': round(elapsed * 1000, 2)}
+            if error:
+                entry['error'] = error
+            trace.spans.append(entry)
+
+
+def annotate(**attrs):
+    """
+    Adds attributes (row counts, IDs, outcomes) to the current trace, if any.
+    """
+    trace = current()
+    if trace:
+        trace.attrs.update(attrs)
+
+
+def traced(name):
+    """
+    Decorator that runs a function as a trace, or as a span if a trace is already active.
+    :param name: Trace name
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if current():
+                with span(name):
+                    return func(*args, **kwargs)
+            trace = _local.trace = Trace(name, {})
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                trace.attrs['error'] = type(e).__name__
+                raise
+            finally:
+                _local.trace = None
+                finish(trace)
+        return wrapper
+    return decorate
+
+
+def finish(trace):
+    """
+    Logs a finished trace if it was sampled or slow.
+    :param trace: The Trace
+    """
+    record = trace.record()
+    span_seconds.observe(record['duration_ms'] / 1000, trace=trace.name, span='total')
+    if record['duration_ms'] >= slow_threshold * 1000 or random.random() < sample_rate:
+        trace_log.info(json.dumps(record, default=str))
@@ -0,0 +1,142 @@
+# System name typeahead.
+# Names are kept in one UTF-8 blob, sorted case insensitively and separated by newlines, with a numpy array
+# of offsets into it. A prefix query is a binary search for the first name at or after the prefix and a
+# short scan from there, a few dozen string comparisons however many names there are. The index is built
+# from the systems table in a background thread, with carriers' current systems always included and the
+# rest added shortest name first until typeahead_max_bytes is reached, and rebuilt every
+# typeahead_refresh seconds to pick up newly seen systems.
+import threading
+import time
+
+import numpy
+from pyramid import threadlocal
+from sqlalchemy import func
+
+from ..models import Carrier, StarSystem
+import logging
+
+log = logging.getLogger(__name__)
+
+settings = threadlocal.get_current_registry().settings or {}
+max_bytes = int(settings.get('typeahead_max_bytes', 64 * 1024 * 1024))
+refresh = int(settings.get('typeahead_refresh', 3600))
+limit = int(settings.get('typeahead_limit', 10))
+
+
+class PrefixIndex(object):
+    def __init__(self, names, max_bytes=None):
+        """
+        :param names: Names to index, in order of priority. Duplicates (ignoring case) are dropped.
+        :param max_bytes: Stop adding names once the index would grow past this size
+        """
+        seen = set()
+        kept = []
+        size = 0
+        for name in names:
+            if not name:
+                continue
+            key = name.lower()
+            if key in seen:
+                continue
+            cost = len(name.encode('utf8')) + 1 + 8
+            if max_bytes and size + cost > max_bytes:
+                log.info(f"Typeahead index full at {len(kept)} names.")
+                break
+            seen.add(key)
+            kept.append(name)
+            size = size + cost
+        kept.sort(key=str.lower)
+        encoded = [name.encode('utf8') for name in kept]
+        self.blob = b'\n'.join(encoded) + b'\n'
+        self.offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.uint64)
+        numpy.cumsum([len(name) + 1 for name in encoded], out=self.offsets[1:])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        return len(self.blob) + self.offsets.nbytes
+
+    def name(self, i):
+        """
+        :param i: Position in sort order
+        :return: The name at that position
+        """
+        return self.blob[int(self.offsets[i]):int(self.offsets[i + 1]) - 1].decode('utf8')
+
+    def search(self, prefix, count=10):
+        """
+        Finds names starting with a prefix, ignoring case.
+        :param prefix: The prefix
+        :param count: Most names to return
+        :return: A list of names, in case insensitive order
+        """
+        prefix = prefix.lower()
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name(mid).lower() < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        result = []
+        while lo < len(self) and len(result) < count:
+            name = self.name(lo)
+            if not name.lower().startswith(prefix):
+                break
+            result.append(name)
+            lo = lo + 1
+        return result
+
+
+def load_names(dbsession):
+    """
+    Lists the names to index, most wanted first.
+    :param dbsession: Database session
+    :return: An iterator of names
+    """
+    for row in dbsession.query(Carrier.currentStarSystem).filter(Carrier.currentStarSystem != None).distinct():
+        yield row.currentStarSystem
+    # Named systems are shorter than procedurally generated ones, and more likely to be searched for.
+    for row in dbsession.query(StarSystem.name).filter(StarSystem.x != None). \
+            order_by(func.length(StarSystem.name), StarSystem.name).yield_per(10000):
+        yield row.name
+
+
+_index = None
+_built_at = None
+_building = threading.Lock()
+
+
+def build(session_factory):
+    """
+    Builds the index and swaps it in.
+    :param session_factory: Makes the database session to read names with
+    """
+    global _index, _built_at
+    dbsession = session_factory()
+    try:
+        start = time.monotonic()
+        index = PrefixIndex(load_names(dbsession), max_bytes)
+        _index, _built_at = index, time.monotonic()
+        log.info(f"Built typeahead index of {len(index)} names ({index.nbytes} bytes) in "
+                 f"{_built_at - start:.1f}s.")
+    except Exception as e:
+        log.exception(f"Failed to build typeahead index: {e}")
+    finally:
+        dbsession.close()
+        _building.release()
+
+
+def get_index(registry):
+    """
+    Gets the current index, starting a (re)build in the background if there is none or it's due.
+    :param registry: The application registry
+    :return: A PrefixIndex, or None while the first build is running
+    """
+    due = _built_at is None or time.monotonic() - _built_at > refresh
+    if due and _building.acquire(blocking=False):
+        threading.Thread(target=build, args=(registry['dbsession_factory'],), name='typeahead-build',
+                         daemon=True).start()
+    return _index
@@ -1,7 +1,4 @@
 # User data handler, as well as sidebar menu builder.
-import json
-from datetime import datetime
-
 from FCMS.utils.capi import capi, get_cmdr
 from ..models import User
 
@@ -27,10 +24,10 @@ def populate_user(request):
 
 
 def update_profile(request):
+    """
+    Forces a refresh of the cached CAPI profile for the logged in user.
+    :param request: The request object.
+    :return: The profile dict, or None if CAPI failed.
+    """
     if request.user:
-        ud = get_cmdr(request.user)
-        user = request.dbsession.query(User).filter(User.id == request.user.id).one_or_none()
-        user.cachedJson = json.dumps(ud)
-        user.lastUpdated = datetime.now()
-
-
+        return get_cmdr(request.user, max_age=0)
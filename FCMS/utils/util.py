@@ -10,7 +10,6 @@ log = logging.getLogger(__name__)
 
 
 def from_hex(mystr):
-    print(mystr)
     try:
         return bytes.fromhex(mystr).decode('utf-8')
     except TypeError:
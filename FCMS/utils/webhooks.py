@@ -1,19 +1,39 @@
 # Webhooks for carrier events. Can fire from EDDN hits or calendar create/delete events.
 
 from datetime import datetime, timedelta
-import requests
 from discord_webhook import DiscordWebhook, DiscordEmbed
 from humanfriendly import format_number
 from sqlalchemy import or_
 
 from ..models import Carrier, Calendar, CarrierExtra, Webhook, Market, User, Route, Region
 from ..models.routes import RouteCalendar
-from ..utils import util
+from ..utils import http, util
 import json
 import logging
 
 log = logging.getLogger(__name__)
 
+# Members of Discord's execute webhook body. DiscordWebhook keeps its client options (wait, timeout, ...)
+# alongside them, so its json property can't be sent as is.
+DISCORD_FIELDS = ('content', 'username', 'avatar_url', 'tts', 'embeds', 'allowed_mentions', 'flags',
+                  'thread_name')
+
+
+def discord_request(webhook):
+    """
+    Builds the body and query parameters for executing a Discord webhook, as DiscordWebhook.execute() would.
+    :param webhook: A DiscordWebhook
+    :return: A tuple of (JSON body dict, query parameter dict)
+    """
+    payload = {field: getattr(webhook, field) for field in DISCORD_FIELDS if getattr(webhook, field, None)}
+    payload['embeds'] = list(webhook.embeds)
+    params = {}
+    if webhook.thread_id:
+        params['thread_id'] = webhook.thread_id
+    if webhook.wait:
+        params['wait'] = 'true'
+    return payload, params
+
 
 def send_webhook(hookurl, message=None, hooktype='generic', myembed=None, refresh=True):
     """
@@ -28,10 +48,11 @@ def send_webhook(hookurl, message=None, hooktype='generic', myembed=None, refres
         webhook = DiscordWebhook(url=hookurl)
         if myembed:
             webhook.add_embed(myembed)
-            return webhook.execute()
-        return webhook.execute()
+        # Post the webhook ourselves rather than with execute(), to go through the shared HTTP layer.
+        payload, params = discord_request(webhook)
+        return http.post(hookurl, json=payload, params=params)
     else:
-        r = requests.post(url=hookurl, data=message)
+        r = http.post(url=hookurl, data=message)
         return r
 
 
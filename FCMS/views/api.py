@@ -6,10 +6,10 @@ from pyramid.view import view_config
 import pyramid.httpexceptions as exc
 from pyramid_storage.exceptions import FileNotAllowed
 
-from ..models import carrier, CarrierExtra, Calendar, Webhook, User, Carrier
+from ..models import carrier, CarrierExtra, Calendar, Webhook, User, Carrier, Job
 from ..models.routes import RouteCalendar, Route
 
-from ..utils import carrier_data
+from ..utils import carrier_data, locations
 from ..utils import menu, user as usr, webhooks
 from humanfriendly import format_timespan
 import logging
@@ -41,6 +41,9 @@ def api_view(request):
         raise exc.HTTPBadRequest(detail='Data not for correct CMDR.')
     else:
         data = pvars['data']
+        if data['event'] in locations.JOURNAL_EVENTS:
+            locations.record_journal(request.dbsession, user.id, data)
+            return {'status': 'OK'}
         mycarrier = request.dbsession.query(Carrier).filter(Carrier.owner == user.id).one_or_none()
         if data['event'] == 'CarrierJumpRequest':
             hooks = webhooks.get_webhooks(request, mycarrier.id)
@@ -99,3 +102,27 @@ def api_view(request):
                         log.debug(f"Hook result: {res}")
 
     return {'Status': 'Maybe OK?'}
+
+
+@view_config(route_name='carrier_status', renderer='json')
+def carrier_status_view(request):
+    """
+    Refresh status for a carrier, polled by pages that were rendered while a refresh job was pending.
+    """
+    cid = request.matchdict['cid']
+    mycarrier = request.dbsession.query(Carrier).filter(Carrier.callsign == cid).one_or_none()
+    if not mycarrier:
+        raise exc.HTTPNotFound(detail='No such carrier.')
+    data = {'callsign': mycarrier.callsign,
+            'last_updated': mycarrier.lastUpdated.isoformat() if mycarrier.lastUpdated else None,
+            'job': None}
+    if 'job' in request.params:
+        try:
+            job = request.dbsession.query(Job).filter(Job.id == int(request.params['job']),
+                                                      Job.carrier_id == mycarrier.id).one_or_none()
+        except ValueError:
+            raise exc.HTTPBadRequest(detail='Invalid job ID.')
+        if job:
+            data['job'] = {'id': job.id, 'type': job.job_type, 'status': job.status, 'progress': job.progress,
+                           'message': job.message}
+    return data
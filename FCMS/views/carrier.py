@@ -1,7 +1,7 @@
 from datetime import datetime, timedelta
 from pyramid.view import view_config
 from ..models import user, carrier
-from ..utils import util, carrier_data, menu, user as usr
+from ..utils import util, capi, carrier_data, freshness, menu, user as usr
 import logging
 
 from ..utils.util import from_hex
@@ -71,13 +71,16 @@ def carrier_view(request):
         log.debug(f"Last update for carrier {cid}: {last}")
         if not last:
             last = datetime.now() - timedelta(minutes=20)  # Cheap hack to sort out missing lastUpdated.
-        if last < datetime.now() - timedelta(minutes=15):
-            log.debug(f"Refreshing data for {cid}")
-            jcarrier = carrier_data.update_carrier(request, mycarrier.id, user)
-            if not jcarrier:
-                log.warning(f"Carrier update failed for CID {cid}. Presenting old data.")
-                return carrier_data.populate_view(request, mycarrier.id, user)
-        return carrier_data.populate_view(request, mycarrier.id, user)
+        freshness.record_view(request.dbsession, mycarrier.id)
+        job = None
+        if last < datetime.now() - freshness.refresh_interval(request.dbsession, mycarrier.id) and \
+                mycarrier.owner and capi.available():
+            log.debug(f"Scheduling refresh for {cid}")
+            job = carrier_data.deferred_update_carrier(request, mycarrier.id, request.user)
+        data = carrier_data.populate_view(request, mycarrier.id, user)
+        if job:
+            data['refresh_job'] = job.id
+        return data
 
     else:
         log.warning(f"Attempt to call carrier view with an invalid carrier reference {cid}")
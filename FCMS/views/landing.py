@@ -8,7 +8,7 @@ from ..models import Carrier
 class Search(colander.MappingSchema):
     system = colander.SchemaNode(colander.String(),
                                  widget=widget.AutocompleteInputWidget(
-                                     values='https://system.api.fuelrats.com/typeahead', min_length=3,
+                                     values='/typeahead', min_length=3,
                                  style='width:100%', css_class='textinput numberpi', attributes={'placeholder': 'Search by System'}))
 
 
@@ -1,4 +1,3 @@
-import json
 import os
 import smtplib
 import urllib
@@ -12,7 +11,7 @@ from pyramid.security import remember, forget
 from sqlalchemy.exc import IntegrityError
 
 from ..models import user, carrier, ResetToken
-from ..utils import capi, sapi, util
+from ..utils import capi, carrier_data, snapshots, util
 from ..utils.encryption import pwd_context
 import logging
 
@@ -135,9 +134,7 @@ def oauth_callback(request):
         return {'project': 'Error: You should be logged in before completing Oauth!'}
     state = request.params['state']
     token = capi.get_token(request.url, state=state)
-    user.access_token = str(dict(token))
-    user.refresh_token = token['refresh_token']
-    user.token_expiration = token['expires_at']
+    capi.store_token(user, token)
     log.info(f"User {user.username} has completed OAuth authentication.")
     return exc.HTTPFound(location=request.route_url('oauth_finalize'))
 
@@ -163,9 +160,9 @@ def oauth_finalize(request):
                            'should now be fixed.',
                 'meta': {'refresh': True, 'target': request.route_url('my_carrier'), 'delay': 5}}
     else:
-        jcarrier = capi.get_carrier(request.user)
+        jcarrier = capi.fetch_carrier_payload(request.user)
         if jcarrier:
-            cs = jcarrier['name']['callsign']
+            cs = jcarrier.value('name', 'callsign')
             oc = request.dbsession.query(carrier.Carrier).filter(
                 carrier.Carrier.callsign == cs).one_or_none()
             if oc:
@@ -188,47 +185,34 @@ def oauth_finalize(request):
 
         log.debug(f"We should be confident we're dealing with a new carrier at this point. Add for {request.user.username}")
         try:
-            services = jcarrier['market']['services']
-            coords = sapi.get_coords(jcarrier['currentStarSystem'])
-            if not coords:
-                coords = {"x": 0, "y": 0, "z": 0}
-            newcarrier = carrier.Carrier(owner=request.user.id, callsign=jcarrier['name']['callsign'],
-                                         name=jcarrier['name']['vanityName'],
+            # Only create the carrier row here; locating the carrier and importing its itinerary, market
+            # and outfitting happens in an import job, so the user isn't kept waiting on the callback. Until
+            # then it has no position, which keeps it out of the nearest carrier searches.
+            name = jcarrier['name']
+            finance = jcarrier['finance']
+            newcarrier = carrier.Carrier(owner=request.user.id, callsign=name['callsign'],
+                                         name=name['vanityName'],
                                          currentStarSystem=jcarrier['currentStarSystem'], balance=jcarrier['balance'],
                                          fuel=jcarrier['fuel'], state=jcarrier['state'], theme=jcarrier['theme'],
                                          dockingAccess=jcarrier['dockingAccess'],
                                          notoriousAccess=jcarrier['notoriousAccess'],
-                                         totalDistanceJumped=jcarrier['itinerary']['totalDistanceJumpedLY'],
-                                         currentJump=jcarrier['itinerary']['currentJump'],
-                                         taxation=jcarrier['finance']['taxation'], coreCost=jcarrier['finance']['coreCost'],
-                                         servicesCost=jcarrier['finance']['servicesCost'],
-                                         jumpsCost=jcarrier['finance']['jumpsCost'],
-                                         numJumps=jcarrier['finance']['numJumps'], hasCommodities=True,
+                                         taxation=finance['taxation'], coreCost=finance['coreCost'],
+                                         servicesCost=finance['servicesCost'],
+                                         jumpsCost=finance['jumpsCost'],
+                                         numJumps=finance['numJumps'], hasCommodities=True,
                                          hasCarrierFuel=True,
-                                         hasRearm=True if services['rearm'] == 'ok' else False,
-                                         hasRepair=True if services['repair'] == 'ok' else False,
-                                         hasRefuel=True if services['refuel'] == 'ok' else False,
-                                         hasShipyard=True if services['shipyard'] == 'ok' else False,
-                                         hasOutfitting=True if services['outfitting'] == 'ok' else False,
-                                         hasBlackMarket=True if services['blackmarket'] == 'ok' else False,
-                                         hasVoucherRedemption=True if services['voucherredemption'] == 'ok' else False,
-                                         hasExploration=True if services['exploration'] == 'ok' else False,
-                                         marketId=jcarrier['market']['id'],
-                                         cachedJson=json.dumps(jcarrier),
-                                         x=coords['x'],
-                                         y=coords['y'],
-                                         z=coords['z'],
-                                         trackedOnly=False,
-                                         lastUpdated=datetime.now())
+                                         trackedOnly=False)
             request.user.no_carrier = False
             request.dbsession.add(newcarrier)
             request.dbsession.flush()
             request.dbsession.refresh(newcarrier)
             request.user.carrierid = newcarrier.id
-            # TODO: Inject rest of the data too.
-            # TODO: Redirect to my_carrier after delay.
-            return {'project': 'OAuth flow completed. Carrier added.',
-                    'meta': {'refresh': True, 'target': '/my_carrier', 'delay': 5}}
+            # The import job picks the payload up from the snapshot store rather than asking CAPI again.
+            snapshots.store(request.dbsession, '/fleetcarrier', jcarrier.raw, carrier_id=newcarrier.id,
+                            user_id=request.user.id)
+            carrier_data.deferred_import_carrier(request, newcarrier.id, request.user)
+            return {'project': 'OAuth flow completed. Carrier added, importing the rest of its data.',
+                    'meta': {'refresh': True, 'target': '/my_carrier', 'delay': 1}}
 
         except AttributeError as e:
             request.user.no_carrier = True
@@ -0,0 +1,22 @@
+from pyramid.response import Response
+from pyramid.view import view_config
+import pyramid.httpexceptions as exc
+
+from ..utils import metrics
+import logging
+
+log = logging.getLogger(__name__)
+
+
+@view_config(route_name='metrics')
+def metrics_view(request):
+    """
+    Prometheus scrape endpoint. Metrics are per process, so scrape each worker.
+    """
+    allowed = request.registry.settings.get('metrics_allow', '127.0.0.1 ::1').split()
+    if request.client_addr not in allowed:
+        log.warning(f"Metrics request from disallowed address {request.client_addr}")
+        raise exc.HTTPForbidden()
+    # Make sure the CAPI and breaker metrics are registered even before the first CAPI call.
+    from ..utils import capi  # noqa: F401
+    return Response(metrics.render(), content_type='text/plain', charset='utf-8')
@@ -14,7 +14,7 @@ from pyramid_storage.exceptions import FileNotAllowed
 from ..models import carrier, CarrierExtra, Calendar, Webhook, Region, Route
 from ..models.routes import RouteCalendar
 
-from ..utils import carrier_data
+from ..utils import capi, carrier_data, freshness, jobs
 from ..utils import menu, user as usr, webhooks
 from humanfriendly import format_timespan
 import logging
@@ -214,7 +214,7 @@ def carrier_subview(request):
         class WaypointSchema(colander.Schema):
             system = colander.SchemaNode(colander.String(),
                                          widget=widget.AutocompleteInputWidget(
-                                             values='https://system.api.fuelrats.com/typeahead', min_length=3
+                                             values='/typeahead', min_length=3
                                          ), id='systemfield')
             duration = colander.SchemaNode(colander.Time(),
                                            widget=widget.TimeInputWidget(),
@@ -242,7 +242,7 @@ def carrier_subview(request):
                                               ), title="Starting Region")
             startSystem = colander.SchemaNode(colander.String(),
                                               widget=widget.AutocompleteInputWidget(
-                                                  values='https://system.api.fuelrats.com/typeahead', min_length=3
+                                                  values='/typeahead', min_length=3
                                               ), title="Starting system", id='startingsystem')
             waypoints = WaypointSequence(title='Waypoints')
             endRegion = colander.SchemaNode(colander.String(),
@@ -254,7 +254,7 @@ def carrier_subview(request):
                                             ), title="Ending Region")
             endSystem = colander.SchemaNode(colander.String(),
                                             widget=widget.AutocompleteInputWidget(
-                                                values='https://system.api.fuelrats.com/typeahead', min_length=3
+                                                values='/typeahead', min_length=3
                                             ), title="Destination System", id='destinationsystem')
             description = colander.SchemaNode(colander.String(),
                                               widget=widget.TextInputWidget(), title='Route description',
@@ -401,11 +401,15 @@ def mycarrier_view(request):
         # log.debug(f"Last update for carrier {cid}: {last}")
         if not last:
             last = datetime.now() - timedelta(minutes=20)  # Cheap hack to sort out missing lastUpdated.
-        if last < datetime.now() - timedelta(minutes=15):
-            log.debug(f"Refreshing data for {mycarrier.callsign}")
-            jcarrier = carrier_data.update_carrier(request, mycarrier.id, request.user)
-            if not jcarrier:
-                log.warning(f"Carrier update failed for CID {mycarrier.callsign}. Presenting old data.")
+        freshness.record_view(request.dbsession, mycarrier.id)
+        # A newly added carrier is still being imported; show how far along that is instead of refreshing.
+        job = jobs.get_active(request.dbsession, 'import_carrier', mycarrier.id)
+        # Without any cached data, get_finances below fetches eagerly instead.
+        if not job and last < datetime.now() - freshness.refresh_interval(request.dbsession, mycarrier.id) and \
+                capi.available() and \
+                carrier_data.cached_payload(request, mycarrier):
+            log.debug(f"Scheduling refresh for {mycarrier.callsign}")
+            job = carrier_data.deferred_update_carrier(request, mycarrier.id, request.user)
         if not request.user.apiKey:
             request.user.apiKey = hexlify(os.urandom(64)).decode()
         finances = carrier_data.get_finances(request, mycarrier.id)
@@ -417,6 +421,9 @@ def mycarrier_view(request):
         if modal_data:
             data['modal'] = modal_data
 
+        if job:
+            data['refresh_job'] = job.id
+            data['refresh_import'] = job.job_type == 'import_carrier'
         data['view'] = 'My Carrier'
         data['finance'] = finances
         data['calendar'] = True
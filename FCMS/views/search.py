@@ -1,15 +1,17 @@
+import functools
+
 import colander
 import numpy
-from deform import widget, Form
+from deform import widget, Form, ValidationFailure
 from pyramid.view import view_config
 from pyramid.response import Response
 import pyramid.httpexceptions as exc
 from pyramid.security import remember, forget
-from sqlalchemy import text
+from sqlalchemy import func
 
 from ..models import user, carrier
 from ..models import Region
-from ..utils import capi, sapi, util, menu
+from ..utils import commodities, locations, namesearch, sapi, spatial, util, menu
 from ..utils import user as myuser
 import re
 import logging
@@ -20,67 +22,109 @@ log = logging.getLogger(__name__)
 class Search(colander.MappingSchema):
     system = colander.SchemaNode(colander.String(),
                                  widget=widget.AutocompleteInputWidget(
-                                     values='https://system.api.fuelrats.com/typeahead', min_length=3))
+                                     values='/typeahead', min_length=3))
+
+
+class CommoditySearch(colander.MappingSchema):
+    commodity = colander.SchemaNode(colander.String(), title='Commodity')
+    mode = colander.SchemaNode(colander.String(), title='I want to',
+                               widget=widget.SelectWidget(values=[('buy', 'Buy it from a carrier'),
+                                                                  ('sell', 'Sell it to a carrier')]),
+                               validator=colander.OneOf(commodities.MODES), default='buy')
+    quantity = colander.SchemaNode(colander.Integer(), title='Tons', validator=colander.Range(min=1),
+                                   missing=1, default=1)
+    price = colander.SchemaNode(colander.Integer(), title='Price limit', missing=None,
+                                description='Highest price when buying, lowest when selling')
+    system = colander.SchemaNode(colander.String(), title='Near system', missing='',
+                                 description='Leave empty to search from your location',
+                                 widget=widget.AutocompleteInputWidget(values='/typeahead', min_length=3))
+
+
+# Carriers listed by the nearest-carrier searches.
+RESULTS = 25
+
+# Most systems looked up on the systems API per result page. Everything else comes from the systems
+# table, so once the systems on a page have been seen, rendering it makes no outbound calls.
+REMOTE_LOOKUPS = 5
+
+
+def distances(candidates, source):
+    """
+    Distances from a point to each candidate, in one go.
+    :param candidates: Carriers
+    :param source: Numpy array of the source coordinates
+    :return: A numpy array of distances, 99999 for carriers without a position
+    """
+    coords = numpy.array([(row.x, row.y, row.z) if row.x is not None and row.y is not None and
+                          row.z is not None else (numpy.nan,) * 3 for row in candidates],
+                         dtype=float).reshape(-1, 3)
+    dist = numpy.sqrt(((coords - numpy.asarray(source, dtype=float)) ** 2).sum(axis=1))
+    return numpy.where(numpy.isnan(dist), 99999, dist.round(2))
+
+
+SERVICES = [('hasShipyard', 'inline_svgs/shipyard.jinja2', 'Shipyard {} available'),
+            ('hasOutfitting', 'inline_svgs/outfitting.jinja2', 'Outfitting {} available'),
+            ('hasRepair', 'inline_svgs/repair.jinja2', 'Repair {} available'),
+            ('hasRefuel', 'inline_svgs/refuel.jinja2', 'Refueling {} available'),
+            ('hasRearm', 'inline_svgs/rearm.jinja2', 'Rearming {} available'),
+            ('hasExploration', 'inline_svgs/exploration.jinja2', 'Interstellar Cartography {} available'),
+            ('hasVoucherRedemption', 'inline_svgs/voucher_redemption.jinja2', 'Interstellar Factor {}  available'),
+            ('hasBlackMarket', 'inline_svgs/blackmarket.jinja2', 'Black Market {} available'),
+            ('notoriousAccess', 'inline_svgs/notorious_access.jinja2', 'Notorious Commanders can {} dock')]
+
+
+@functools.lru_cache(maxsize=None)
+def service_badges(flags):
+    """
+    :param flags: Tuple of the SERVICES flags
+    :return: The badges for those services
+    """
+    return tuple({'color': '#00A000' if flag else '#FF0000', 'svg': svg, 'title': title.format("" if flag else "NOT")}
+                 for flag, (name, svg, title) in zip(flags, SERVICES))
+
+
+@functools.lru_cache(maxsize=64)
+def docking_badge(dockingAccess):
+    return {'color': '#00A000' if dockingAccess == 'all' else '#dad55e', 'svg': 'inline_svgs/docking_access.jinja2',
+            'title': f'Docking available for '
+                     f'{"Squadron and Friends" if dockingAccess == "squadronfriends" else dockingAccess}'}
+
+
+@functools.lru_cache(maxsize=128)
+def tax_badge(taxation):
+    if taxation:
+        taxcolor = "#00AA000" if taxation == 0 else "#DAD55E" if 25 > taxation > 0 \
+            else "#FFC4505F" if 50 > taxation > 26 else "#FF0000"
+    else:
+        taxcolor = "#555555"
+    return {'color': taxcolor, 'svg': 'inline_svgs/taxation.jinja2', 'title': f'Taxation is {taxation}%'}
+
+
+def services(row):
+    """
+    Puts together a carrier's service badges from templates built once per combination of services, docking
+    access and tax rate. The badge dicts are shared between rows, so don't modify them.
+    :param row: Carrier
+    :return: A list of badge dicts for the search templates
+    """
+    return [*service_badges(tuple(bool(getattr(row, name)) for name, svg, title in SERVICES)),
+            docking_badge(row.dockingAccess), tax_badge(row.taxation)]
 
 
-def fill_data(candidates, source):
+def fill_data(request, candidates, source):
+    candidates = list(candidates)
+    log.debug(f"Source is {source}")
+    systems = sapi.lookup_many([row.currentStarSystem for row in candidates], request.dbsession,
+                               remote_limit=REMOTE_LOOKUPS)
     items = []
-    for row in candidates:
-        log.debug(f"Source is {source}")
-        try:
-            if row.x and row.y and row.z:
-                target = numpy.array((row.x, row.y, row.z))
-                dist = numpy.linalg.norm(source - target)
-            else:
-                dist = 99999
-            system = sapi.get_system_by_name(row.currentStarSystem)
-        except TypeError:
-            log.debug(f"Failed to get a distance, row x: {row.x} system: {row.currentStarSystem}")
-            dist = 99999
-            system = sapi.get_system_by_name(row.currentStarSystem)
-        if row.taxation:
-            taxcolor = "#00AA000" if row.taxation == 0 else "#DAD55E" if 25 > row.taxation > 0 \
-                else "#FFC4505F" if 50 > row.taxation > 26 else "#FF0000"
-        else:
-            taxcolor = "#555555"
+    for row, dist in zip(candidates, distances(candidates, source).tolist()):
+        system = systems.get(row.currentStarSystem.strip().lower()) if row.currentStarSystem else None
         items.append({'col1_svg': 'inline_svgs/state.jinja2', 'col1': util.from_hex(row.name),
-                      'systemid': system['data'][0]['id'] if system['data'] else None,
+                      'systemid': system['id64'] if system else None,
                       'col2': row.callsign,
                       'is_DSSA': row.isDSSA,
-                      'col3': row.currentStarSystem, 'col4': round(dist, 2),
-                      'services': [{'color': '#00A000' if row.hasShipyard else '#FF0000',
-                                    'svg': 'inline_svgs/shipyard.jinja2',
-                                    'title': f'Shipyard {"" if row.hasShipyard else "NOT"} available'},
-                                   {'color': '#00A000' if row.hasOutfitting else '#FF0000',
-                                    'svg': 'inline_svgs/outfitting.jinja2',
-                                    'title': f'Outfitting {"" if row.hasOutfitting else "NOT"} available'},
-                                   {'color': '#00A000' if row.hasRepair else '#FF0000',
-                                    'svg': 'inline_svgs/repair.jinja2',
-                                    'title': f'Repair {"" if row.hasRepair else "NOT"} available'},
-                                   {'color': '#00A000' if row.hasRefuel else '#FF0000',
-                                    'svg': 'inline_svgs/refuel.jinja2',
-                                    'title': f'Refueling {"" if row.hasRefuel else "NOT"} available'},
-                                   {'color': '#00A000' if row.hasRearm else '#FF0000',
-                                    'svg': 'inline_svgs/rearm.jinja2',
-                                    'title': f'Rearming {"" if row.hasRearm else "NOT"} available'},
-                                   {'color': '#00A000' if row.hasExploration else '#FF0000',
-                                    'svg': 'inline_svgs/exploration.jinja2',
-                                    'title': f'Interstellar Cartography {"" if row.hasExploration else "NOT"} available'},
-                                   {'color': '#00A000' if row.hasVoucherRedemption else '#FF0000',
-                                    'svg': 'inline_svgs/voucher_redemption.jinja2',
-                                    'title': f'Interstellar Factor {"" if row.hasVoucherRedemption else "NOT"}  available'},
-                                   {'color': '#00A000' if row.hasBlackMarket else '#FF0000',
-                                    'svg': 'inline_svgs/blackmarket.jinja2',
-                                    'title': f'Black Market {"" if row.hasBlackMarket else "NOT"} available'},
-                                   {'color': '#00A000' if row.notoriousAccess else '#FF0000',
-                                    'svg': 'inline_svgs/notorious_access.jinja2',
-                                    'title': f'Notorious Commanders can {"" if row.notoriousAccess else "NOT"} dock'},
-                                   {'color': '#00A000' if row.dockingAccess == 'all' else '#dad55e',
-                                    'svg': 'inline_svgs/docking_access.jinja2',
-                                    'title': f'Docking available for {"Squadron and Friends" if row.dockingAccess == "squadronfriends" else row.dockingAccess}'},
-                                   {'color': taxcolor, 'svg': 'inline_svgs/taxation.jinja2',
-                                    'title': f'Taxation is {row.taxation}%'}
-                                   ]})
+                      'col3': row.currentStarSystem, 'col4': dist,
+                      'services': services(row)})
     return items
 
 
@@ -106,7 +150,9 @@ def dssa_view(request):
     mymenu = menu.populate_sidebar(request)
     if request.user:
         userdata = myuser.populate_user(request)
-        sys = sapi.get_coords(capi.get_cmdr(request.user)['lastSystem']['name'])
+        sys = locations.resolve(request.dbsession, request.user)
+        if 'error' in sys:
+            sys['name'] = f"{sys['name'] or 'Sol'} (Location unknown)"
     else:
         log.debug(f"In DSSA for unauthenticated user.")
         userdata = {'cmdr_name': 'Not logged in', 'cmdr_image': '/static/dist/img/avatar.png', 'link': '/login'}
@@ -115,13 +161,8 @@ def dssa_view(request):
     y = sys['y']
     z = sys['z']
     source = numpy.array((sys['x'], sys['y'], sys['z']))
-    candidates = request.dbsession.query(carrier.Carrier).from_statement(
-        text(f"SELECT *, (sqrt((cast(carriers.x AS FLOAT) - {x}"
-             f")^2 + (cast(carriers.y AS FLOAT) - {y}"
-             f")^2 + (cast(carriers.z AS FLOAT) - {z}"
-             f")^2)) as Distance from carriers where"
-             f" carriers.\"isDSSA\" is TRUE order by Distance"))
-    items = fill_data(candidates, source)
+    candidates = [row for dist, row in spatial.nearest_carriers(request.dbsession, (x, y, z), predicate=spatial.dssa)]
+    items = fill_data(request, candidates, source)
     return {'view': 'DSSA Carriers', 'user': userdata, 'col1_header': 'Carrier', 'col2_header': 'Callsign',
             'col3_header': 'System',
             'col4_header': 'Distance', 'items': items, 'result_header': f'DSSA Carriers',
@@ -145,7 +186,7 @@ def system_view(request):
     else:
         term = request.params['term'] if 'term' in request.params else None
     if term:
-        coords = sapi.get_coords(term)
+        coords = sapi.get_coords(term, request.dbsession)
         if 'error' in coords:
             return {'error': 'Source system is not in system database.', 'sidebar': mymenu, 'view': 'Carrier Search',
                     'user': userdata}
@@ -153,19 +194,9 @@ def system_view(request):
         y = coords['y']
         z = coords['z']
         source = numpy.array((x, y, z))
-        cube = 5000
         if coords:
-            cand = request.dbsession.query(carrier.Carrier).from_statement(
-                text(f"SELECT *, (sqrt((cast(carriers.x AS FLOAT) - {x}"
-                     f")^2 + (cast(carriers.y AS FLOAT) - {y}"
-                     f")^2 + (cast(carriers.z AS FLOAT) - {z}"
-                     f")^2)) as Distance from carriers where cast(carriers.x AS FLOAT) BETWEEN "
-                     f"{str(float(x) - cube)} AND {str(float(x) + cube)}"
-                     f" AND cast(carriers.y AS FLOAT) BETWEEN {str(float(y) - cube)} AND {str(float(y) + cube)}"
-                     f" AND cast(carriers.z as FLOAT) BETWEEN {str(float(z) - cube)} AND {str(float(z) + cube)}"
-                     f" AND carriers.\"showSearch\" IS TRUE"
-                     f" order by Distance LIMIT 25")).all()
-            items = fill_data(cand, source)
+            cand = [row for dist, row in spatial.nearest_carriers(request.dbsession, (x, y, z), RESULTS)]
+            items = fill_data(request, cand, source)
             return {'user': userdata, 'col1_header': 'Carrier', 'col2_header': 'Callsign', 'col3_header': 'System',
                     'col4_header': 'Distance', 'items': items, 'result_header': f'carriers near {term}',
                     'carrier_search': True, 'sidebar': mymenu, 'view': 'Carrier Search'}
@@ -177,45 +208,76 @@ def system_view(request):
 def closest_view(request):
     extra = None
     if request.user:
-        usr = capi.get_cmdr(request.user)
+        coords = locations.resolve(request.dbsession, request.user)
         log.debug(f"In search.py for user {request.user.cmdr_name}")
         userdata = myuser.populate_user(request)
-        if not usr:
-            sys = 'Sol'
-            extra = 'Couldn\'t get your last known system from CAPI. Showing results relative to Sol.'
-        else:
-            sys = usr['lastSystem']['name']
+        if 'error' in coords:
+            coords = {'name': 'Sol', 'x': 0, 'y': 0, 'z': 0}
+            extra = 'Couldn\'t get your last known location. Showing results relative to Sol.'
     else:
-        sys = 'Sol'
+        coords = {'name': 'Sol', 'x': 0, 'y': 0, 'z': 0}
         extra = 'You are not logged in. Showing results relative to Sol.'
         log.debug(f"In search.py for unauthenticated user.")
         userdata = {'cmdr_name': 'Not logged in', 'cmdr_image': '/static/dist/img/avatar.png', 'link': '/login'}
     mymenu = menu.populate_sidebar(request)
-    coords = sapi.get_coords(sys)
-    if 'error' in coords:
-        log.debug("Failed to get coords for unknown user.")
-    coords = sapi.get_coords(sys)
+    sys = coords['name']
     x = coords['x']
     y = coords['y']
     z = coords['z']
-    cube = 5000
     source = numpy.array((x, y, z))
-    candidates = request.dbsession.query(carrier.Carrier).from_statement(
-        text(f"SELECT *, (sqrt((cast(carriers.x AS FLOAT) - {x}"
-             f")^2 + (cast(carriers.y AS FLOAT) - {y}"
-             f")^2 + (cast(carriers.z AS FLOAT) - {z}"
-             f")^2)) as Distance from carriers where cast(carriers.x AS FLOAT) BETWEEN "
-             f"{str(float(x) - cube)} AND {str(float(x) + cube)}"
-             f" AND cast(carriers.y AS FLOAT) BETWEEN {str(float(y) - cube)} AND {str(float(y) + cube)}"
-             f" AND cast(carriers.z as FLOAT) BETWEEN {str(float(z) - cube)} AND {str(float(z) + cube)}"
-             f" AND carriers.\"showSearch\" IS TRUE"
-             f" order by Distance LIMIT 25"))
-    items = fill_data(candidates, source)
+    candidates = [row for dist, row in spatial.nearest_carriers(request.dbsession, (x, y, z), RESULTS)]
+    items = fill_data(request, candidates, source)
     return {'user': userdata, 'col1_header': 'Carrier', 'col2_header': 'Callsign', 'col3_header': 'System',
             'col4_header': 'Distance', 'items': items, 'result_header': f'carriers near {sys}',
             'carrier_search': True, 'sidebar': mymenu, 'view': 'Closest Carriers', 'extra': extra if extra else None}
 
 
+@view_config(route_name='commodity_search', renderer='../templates/search.jinja2')
+def commodity_view(request):
+    mymenu = menu.populate_sidebar(request)
+    if request.user:
+        userdata = myuser.populate_user(request)
+    else:
+        userdata = {'cmdr_name': 'Not logged in', 'cmdr_image': '/static/dist/img/avatar.png', 'link': '/login'}
+    searchform = Form(CommoditySearch(), buttons=('submit',), method='GET', action='/search/commodity')
+    if 'commodity' not in request.params:
+        return {'searchform': searchform.render(), 'user': userdata, 'sidebar': mymenu, 'deform': True,
+                'view': 'Commodity Search'}
+    try:
+        appstruct = searchform.validate(request.params.items())
+    except ValidationFailure as e:
+        return {'searchform': e.render(), 'user': userdata, 'sidebar': mymenu, 'deform': True,
+                'view': 'Commodity Search'}
+    extra = None
+    if appstruct['system']:
+        coords = sapi.get_coords(appstruct['system'], request.dbsession)
+        if 'error' in coords:
+            return {'error': 'Source system is not in system database.', 'sidebar': mymenu,
+                    'view': 'Commodity Search', 'user': userdata}
+        coords['name'] = appstruct['system']
+    elif request.user:
+        coords = locations.resolve(request.dbsession, request.user)
+        if 'error' in coords:
+            coords = {'name': 'Sol', 'x': 0, 'y': 0, 'z': 0}
+            extra = 'Couldn\'t get your last known location. Showing results relative to Sol.'
+    else:
+        coords = {'name': 'Sol', 'x': 0, 'y': 0, 'z': 0}
+        extra = 'You are not logged in. Showing results relative to Sol.'
+    source = numpy.array((coords['x'], coords['y'], coords['z']))
+    buying = appstruct['mode'] == 'buy'
+    found = commodities.nearest_offers(request.dbsession, appstruct['commodity'], source, appstruct['mode'],
+                                       appstruct['quantity'], appstruct['price'], RESULTS)
+    items = fill_data(request, [row for dist, row, offer in found], source)
+    for item, (dist, row, offer) in zip(items, found):
+        item['col5'] = f"{offer.stock:,} t at {offer.buyPrice:,} cr" if buying else \
+            f"{offer.demand:,} t wanted at {offer.sellPrice:,} cr"
+    name = found[0][2].name if found else appstruct['commodity']
+    return {'user': userdata, 'col1_header': 'Carrier', 'col2_header': 'Callsign', 'col3_header': 'System',
+            'col4_header': 'Distance', 'col5_header': 'Stock' if buying else 'Demand', 'items': items,
+            'result_header': f'carriers {"selling" if buying else "buying"} {name} near {coords["name"]}',
+            'carrier_search': True, 'sidebar': mymenu, 'view': 'Commodity Search', 'extra': extra}
+
+
 # This shit is nuts and needs to die in a fire. FIX IT!
 # This shit is slightly less shit now.
 @view_config(route_name='search', renderer='../templates/search.jinja2')
@@ -244,33 +306,35 @@ def search_view(request):
         res = request.dbsession.query(carrier.Carrier).filter(carrier.Carrier.callsign == term.upper()).one_or_none()
         if res:
             raise exc.HTTPFound(request.route_url(f'carrier', cid=term.upper()))
-    res = request.dbsession.query(user.User).filter(user.User.cmdr_name.ilike(term))
+    # One round trip for the commanders with this name and their carriers, if they have any.
+    res = request.dbsession.query(user.User.id, user.User.cmdr_name, carrier.Carrier.callsign, carrier.Carrier.name,
+                                  carrier.Carrier.currentStarSystem). \
+        outerjoin(carrier.Carrier, carrier.Carrier.owner == user.User.id). \
+        filter(func.lower(user.User.cmdr_name) == term.strip().lower()). \
+        order_by(user.User.cmdr_name, user.User.id).all()
     if res:
-        if res.count() == 1:
+        if len({row.id for row in res}) == 1:
             # Single CMDR name hit, go to their carrier.
-            row = res.one()
-            cx = request.dbsession.query(carrier.Carrier).filter(carrier.Carrier.owner == row.id).one_or_none()
-            if cx:
-                raise exc.HTTPFound(request.route_url(f'carrier', cid=cx.callsign))
+            row = res[0]
+            if row.callsign:
+                raise exc.HTTPFound(request.route_url(f'carrier', cid=row.callsign))
             else:
                 return {'error': 'Player does not have a carrier.'}
-        elif res.count() > 1:
+        else:
             for row in res:
-                cx = request.dbsession.query(carrier.Carrier).filter(carrier.Carrier.owner == row.id).one_or_none()
-                if cx:
-                    items.append({'col1_svg': 'inline_svgs/state.jinja2', 'col1': row.cmdr_name, 'col2': cx.callsign,
-                                  'col3': util.from_hex(cx.name), 'col4': cx.currentStarSystem})
+                if row.callsign:
+                    items.append({'col1_svg': 'inline_svgs/state.jinja2', 'col1': row.cmdr_name, 'col2': row.callsign,
+                                  'col3': util.from_hex(row.name), 'col4': row.currentStarSystem})
             return {'user': userdata, 'col1_header': 'CMDR', 'col2_header': 'Callsign', 'col3_header': 'Carrier name',
                     'col4_header': 'Current System', 'items': items, 'result_header': f'carrier owners matching {term}',
                     'carrier_search': True, 'sidebar': mymenu, 'view': 'Carrier Search'}
 
-    res = request.dbsession.query(carrier.Carrier). \
-        filter(carrier.Carrier.name.like(f'%{util.to_hex(term.upper()).decode("utf8")}%'))
+    res = namesearch.search(request.dbsession, term)
     if res:
-        if res.count() == 1:
-            row = res.one()
+        if len(res) == 1:
+            row = res[0]
             raise exc.HTTPFound(request.route_url(f'carrier', cid=row.callsign))
-        elif res.count() > 1:
+        elif len(res) > 1:
             for row in res:
                 items.append(
                     {'col1_svg': 'inline_svgs/state.jinja2', 'col1': util.from_hex(row.name), 'col2': row.callsign,
@@ -0,0 +1,142 @@
+import base64
+import json
+
+from pyramid.response import Response
+from pyramid.view import view_config
+import pyramid.httpexceptions as exc
+from sqlalchemy import or_, tuple_
+
+from ..models import Carrier
+from ..models.carrier import normalize_name
+from ..utils import sapi, spatial, util
+from .search import SERVICES
+import logging
+
+log = logging.getLogger(__name__)
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+ORDERS = ('distance', 'name')
+
+
+def encode_cursor(state):
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(',', ':')).encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Reads a cursor from a previous page. Cursors carry the whole query (order, origin, filter) and the sort
+    key of the last result returned.
+    :param cursor: The cursor string
+    :return: The cursor state dict
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if state['order'] not in ORDERS or len(state['after']) != 2:
+            raise ValueError(state['order'])
+        if state['order'] == 'distance' and len(state['origin']) != 3:
+            raise ValueError(state['origin'])
+        return state
+    except (ValueError, TypeError, KeyError, UnicodeError) as e:
+        log.debug(f"Bad search cursor {cursor}: {e}")
+        raise exc.HTTPBadRequest(detail='Invalid cursor.')
+
+
+def serialize(row, dist=None):
+    """
+    Turns a carrier into a plain dict while the session is still open, so the page can be written out
+    after the transaction has ended.
+    """
+    result = {'callsign': row.callsign, 'name': util.from_hex(row.name), 'system': row.currentStarSystem,
+              'dssa': bool(row.isDSSA), 'dockingAccess': row.dockingAccess,
+              'services': [name for name, svg, title in SERVICES if getattr(row, name)]}
+    if dist is not None:
+        result['distance'] = round(dist, 2)
+    return result
+
+
+def stream(results, cursor):
+    """
+    Writes a page of results as JSON, one result at a time.
+    """
+    yield b'{"results":['
+    for i, result in enumerate(results):
+        yield (',' if i else '').encode('utf8') + json.dumps(result).encode('utf8')
+    yield f'],"next":{json.dumps(cursor)}}}'.encode('utf8')
+
+
+def query_from_params(request):
+    """
+    Builds the cursor state for a first page from the request parameters.
+    """
+    params = request.params
+    name = normalize_name(params.get('name', ''))
+    if 'system' in params:
+        coords = sapi.get_coords(params['system'], request.dbsession)
+        if 'error' in coords:
+            raise exc.HTTPBadRequest(detail='Source system is not in system database.')
+        origin = [coords['x'], coords['y'], coords['z']]
+    elif all(axis in params for axis in 'xyz'):
+        try:
+            origin = [float(params[axis]) for axis in 'xyz']
+        except ValueError:
+            raise exc.HTTPBadRequest(detail='Invalid coordinates.')
+    else:
+        origin = None
+    order = params.get('order', 'distance' if origin else 'name')
+    if order not in ORDERS:
+        raise exc.HTTPBadRequest(detail=f'Order must be one of {", ".join(ORDERS)}.')
+    if order == 'distance' and not origin:
+        raise exc.HTTPBadRequest(detail='Ordering by distance needs a system or x, y and z.')
+    if order == 'distance' and name:
+        raise exc.HTTPBadRequest(detail='Name filters can only be ordered by name.')
+    return {'order': order, 'origin': origin, 'name': name, 'after': None}
+
+
+def distance_page(request, state, size):
+    after = tuple(state['after']) if state['after'] else None
+    found = spatial.nearest_carriers(request.dbsession, state['origin'], size + 1, after=after)
+    page = found[:size]
+    results = [serialize(row, dist) for dist, row in page]
+    last = [page[-1][0], page[-1][1].id] if len(found) > size else None
+    return results, last
+
+
+def name_page(request, state, size):
+    query = request.dbsession.query(Carrier).filter(
+        Carrier.searchName != None, or_(Carrier.showSearch == None, Carrier.showSearch == True))
+    if state['name']:
+        pattern = state['name'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.filter(Carrier.searchName.like(f'%{pattern}%', escape='\\'))
+    if state['after']:
+        query = query.filter(tuple_(Carrier.searchName, Carrier.id) > tuple_(*state['after']))
+    found = query.order_by(Carrier.searchName, Carrier.id).limit(size + 1).all()
+    page = found[:size]
+    results = [serialize(row) for row in page]
+    last = [page[-1].searchName, page[-1].id] if len(found) > size else None
+    return results, last
+
+
+@view_config(route_name='search_api')
+def search_api_view(request):
+    """
+    Pages through carriers as JSON, nearest first (system=..., or x, y and z) or by name (order=name,
+    optionally filtered with name=...). Each page ends with a next cursor to pass back as cursor=... for
+    the following page, or null on the last page. Pages are found by their sort key rather than an offset,
+    so nothing is counted and a late page doesn't read the results before it: name pages seek the name
+    index, and distance pages start at the grid cells as far out as the cursor.
+    """
+    try:
+        size = min(max(int(request.params.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        raise exc.HTTPBadRequest(detail='Invalid limit.')
+    if 'cursor' in request.params:
+        state = decode_cursor(request.params['cursor'])
+    else:
+        state = query_from_params(request)
+    if state['order'] == 'distance':
+        results, last = distance_page(request, state, size)
+    else:
+        results, last = name_page(request, state, size)
+    cursor = encode_cursor(dict(state, after=last)) if last else None
+    return Response(app_iter=stream(results, cursor), content_type='application/json', charset='utf-8')
@@ -0,0 +1,22 @@
+from pyramid.view import view_config
+
+from ..utils import typeahead
+import logging
+
+log = logging.getLogger(__name__)
+
+
+@view_config(route_name='typeahead', renderer='json')
+def typeahead_view(request):
+    """
+    System name suggestions for the autocomplete widgets. Takes the prefix as term, like the Fuel Rats
+    typeahead it replaces, and returns a list of names.
+    """
+    term = request.params.get('term', '').strip()
+    if len(term) < 3:
+        return []
+    index = typeahead.get_index(request.registry)
+    if not index:
+        log.debug("Typeahead index not built yet.")
+        return []
+    return index.search(term, typeahead.limit)
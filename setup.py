@@ -75,6 +75,15 @@ setup(
             'initialize_FCMS_db=FCMS.scripts.initialize_db:main',
             'eddn_client=FCMS.scripts.eddn_client:main',
             'load_regions=FCMS.scripts.load_regions:main',
+            'refresh_tokens=FCMS.scripts.refresh_tokens:main',
+            'fake_capi=FCMS.scripts.fake_capi:main',
+            'capi_loadtest=FCMS.scripts.capi_loadtest:main',
+            'job_runner=FCMS.scripts.job_runner:main',
+            'prune_snapshots=FCMS.scripts.prune_snapshots:main',
+            'freshness_report=FCMS.scripts.freshness_report:main',
+            'import_systems=FCMS.scripts.import_systems:main',
+            'bench_fill_data=FCMS.scripts.bench_fill_data:main',
+            'fill_search_columns=FCMS.scripts.fill_search_columns:main',
         ],
     },
 )